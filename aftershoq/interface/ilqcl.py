@@ -8,6 +8,7 @@ Created on 16 Mar 2018
 from aftershoq.interface import Interface
 from aftershoq.structure import Structure
 import aftershoq.utils.systemutil as su
+import aftershoq.utils.resultstore as rs
 from aftershoq.numerics.runplatf import Local
 import time
 import aftershoq.utils.debug as dbg
@@ -123,10 +124,15 @@ class Ilqcl(Interface):
         the base path "path". This method dispatches all processes and returns
         the user has to wait for processes to finish before accessing results.
 
-        Stores started processes in self.processes
+        If calcStates is True, lqcl is started for each structure as soon as
+        the calcWS program for that structure has finished.
+
+        Stores started processes in self.processes. Since lqcl processes are
+        added as the calcWS processes finish, use waitforproc() to wait for
+        all of them.
         '''
 
-        local = Local()
+        calcws = []
         for ss in structures:
             spath = Path.joinpath( path, str(ss.dirname) )
             su.mkdir(spath)
@@ -135,25 +141,46 @@ class Ilqcl(Interface):
                 #proc = su.dispatch(self.progWS, "",spath)
                 proc = self.pltfm.submitjob(self.progWS,[],spath,1,"00:10")
                 self.processes.append(proc)
+                calcws.append((proc, spath))
         if calcStates:
             dbg.debug("Starting calcWS program.....\n",dbg.verb_modes["verbose"],self)
             dbg.flush()
-        # TODO do not wait for all processes-start each strucrure when ready!
-        self.waitforproc(1)
-        dbg.debug("Starting lqcl.....\n",dbg.verb_modes["verbose"],self)
-        dbg.flush()
-        #del processes
-        #processes = []
-        for ss in structures:
-            spath = Path.joinpath( path , str(ss.dirname) )
+            self.pltfm.flush()
+            for (proc, spath) in calcws:
+                self.pltfm.on_complete(proc,
+                                       lambda p, spath=spath: self.startLqcl(spath))
+        else:
+            dbg.debug("Starting lqcl.....\n",dbg.verb_modes["verbose"],self)
+            dbg.flush()
+            for ss in structures:
+                self.startLqcl( Path.joinpath( path , str(ss.dirname) ) )
+        self.pltfm.flush()
+        return self.processes
 
-            proc = self.pltfm.submitjob(self.proglqcl,[],Path.joinpath(spath,self.datpath) )
+    def startLqcl(self, spath):
+        '''Start lqcl in spath/self.datpath. The started process is appended
+        to self.processes and returned.
+        '''
 
-            self.processes.append(proc)
-        return self.processes
+        proc = self.pltfm.submitjob(self.proglqcl,[],Path.joinpath(spath,self.datpath) )
+
+        self.processes.append(proc)
+        return proc
 
 
 
+    async def runStructureAsync(self, structure, path, calcStates = True):
+        '''Coroutine which runs calcWS and lqcl for a single structure,
+        awaiting each stage through the platform's asyncio layer.
+        '''
+        spath = Path.joinpath( path, str(structure.dirname) )
+        su.mkdir(spath)
+        if calcStates:
+            self.initdir(structure, spath)
+            await self.pltfm.submitjob_async(self.progWS,[],spath,1,"00:10")
+        await self.pltfm.submitjob_async(self.proglqcl,[],
+                                         Path.joinpath(spath,self.datpath) )
+
     def checkactive(self):
         pactive = False
         for p in self.processes:
@@ -169,28 +196,19 @@ class Ilqcl(Interface):
         each Structure object in the list structures.
         '''
 
-        if(pathresults is None):
-            pathresults = pathwd
+        pathresults = self.resultspath(pathwd, pathresults)
 
+        store = self.resultstore(pathresults)
         with open(pathresults+'/results.log','a') as f:
-            f.write('# Results for structures:\nID | merit | \
-            N times layer width | Ndop times (zi, zf, nvol) | N times x \n')
+            f.write(rs.header)
             for ss in structures:
                 spath = Path.joinpath( pathwd , str(ss.dirname) )
 
                 ss.merit = self.getMerit(ss, pathwd)
 
-                f.write(str(ss.dirname) + " ")
-                f.write(str(ss.merit) + " " )
-                for layer in ss.layers:
-                    f.write(str(layer.width)+" ")
-                for doping in ss.dopings:
-                    for val in doping:
-                        f.write( str(val) +" ")
-                for layer in ss.layers:
-                    f.write(str(layer.material.x)+" ")
-
-                f.write("\n")
+                record = rs.structrecord(ss, ss.dirname)
+                store.add([record])
+                f.write(rs.formatrecord(record))
                 if self.merit == self.merits["Chi2"]:
                     su.mkdir(pathresults + ss.dirname)
                     with open(pathresults + ss.dirname+"/chi2.log", 'w') as chif:
@@ -202,16 +220,9 @@ class Ilqcl(Interface):
         '''
 
         # First try to see if results were already evaluated:
-        # assumes structure for results.log:
-        # sid | merit | ...
-
-        if 'results.log' in su.ls(path):
-            with open(path + '/results.log') as f:
-                found = False
-                for line in f:
-                    line = line.split()
-                    if line[0] == str(structure.sid):
-                        return line[1]
+        merit = self.storedMerit(structure, path)
+        if merit is not None:
+            return merit
 
         path = path + "/" + structure.dirname + self.datpath
 
@@ -8,6 +8,8 @@ Created on 16 Mar 2018
 from aftershoq.interface import Interface
 from aftershoq.structure import Structure
 import aftershoq.utils.systemutil as su
+import aftershoq.utils.resultstore as rs
+import aftershoq.utils.merits as mf
 from aftershoq.numerics.runplatf import Local
 import time
 import aftershoq.utils.debug as dbg
@@ -17,7 +19,10 @@ import numpy as np
 from aftershoq.utils import const
 from aftershoq.materials import GaAs
 from scipy.interpolate import interp1d
+from concurrent import futures
 import threading
+import collections
+import shutil
 import os.path
 
 class Inegf(Interface):
@@ -61,12 +66,25 @@ class Inegf(Interface):
     # index of data in negft.dat
     idat = {"eFd":0,"omega":1,"eFacd":2,"j":3,"gain":4,"dk":5,"konv":6,"errdyn":7,"ierror":8}
 
+    transient = Interface.transient + ("pools", "poollock")
+
     def __init__(self,binpath="",pltfm=Local(),wellmaterial=GaAs(),einspath = "./"):
         '''
         Constructor. Subclass specific parameters:
         wellmaterial: Material of the well of the structure (used for
         dielectric and phonon properties).
         einspath: Path to eins-files used for accelerating convergence.
+
+        To start the NEGF program from the converged state of the nearest
+        structure which has been simulated before, set
+
+            model.warmstart = WarmStart(sgenerator)
+
+        (see aftershoq.utils.warmstart). model.warmstart.report() returns the
+        wall time saved.
+
+        To split the bias sweep of each structure into N jobs running in
+        parallel, set model.Nchunks = N (see startChunks()).
         '''
 
         super(Inegf,self).__init__(binpath, pltfm)
@@ -89,64 +107,327 @@ class Inegf(Interface):
         self.einspath = einspath
         self.datpath = "Run"
         self.target = None
+        # WarmStart of the NEGF program (None for cold starts)
+        self.warmstart = None
+        # NegftMonitor of the running NEGF jobs (None for no early termination)
+        self.monitor = None
+        # number of parallel jobs each bias sweep is split into, see
+        # startChunks()
+        self.Nchunks = 1
 
     def __str__(self):
         return "Inegf"
 
+    def initsync(self):
+        super(Inegf,self).initsync()
+        # thread pools of runStructSeq() and gatherResults(), see threadpool()
+        self.pools = {}
+        self.poollock = threading.Lock()
+
+    def threadpool(self, name, max_workers):
+        '''Returns the thread pool "name" of this instance, with max_workers
+        threads. It is created on first use and reused by later calls, so
+        that its threads are not started again for each call (it is only
+        replaced when max_workers changes).
+        '''
+        with self.poollock:
+            (size, pool) = self.pools.get(name, (None, None))
+            if size != max_workers:
+                if pool is not None:
+                    # already submitted tasks still run to completion
+                    pool.shutdown(wait = False)
+                pool = futures.ThreadPoolExecutor(max_workers = max_workers,
+                                                  thread_name_prefix = name)
+                self.pools[name] = (max_workers, pool)
+            return pool
+
+    def programs(self):
+        return [self.progwann, self.prognegft, self.proghdiag,
+                self.progbandplot]
+
+    def cachekey(self, structure):
+        # the well material is written to the input files as well
+        return self.simcache.key(structure, self.numpar, self.programs(),
+                                 [self.wellmat.name, self.wellmat.params])
+
     def initdir(self,ss,path):
         '''Initialize the dierctory for Structure s, with base path "path".'''
         pathNegf=os.path.join(path,self.datpath)
         su.mkdir(pathNegf)
         self.writeWannier(ss,path)
         self.writeMaterial(self.wellmat, "# "+str(self.wellmat.name),path)
-        self.writeNegftInp(su.abspath(path), self.einspath ,pathNegf)
+        self.writeNegftRun(ss, path)
+
+    def writeNegftRun(self, ss, spath):
+        '''Write the NEGF input for Structure ss in spath/self.datpath. If
+        self.warmstart is set and a converged neighbour of ss is known, the
+        NEGF program starts from the neighbour's eins files at the bias
+        closest to numpar["efield0"] (see warmsource()), otherwise from
+        self.einspath. The eins folder used is kept in ss.warmfrom.
+        '''
+        ss.warmfrom = self.warmsource(ss)
+        if ss.warmfrom is None:
+            self.writeNegftInp(os.path.abspath(os.path.join(spath, self.datpath)),
+                               self.einspath, os.path.join(spath, self.datpath))
+        else:
+            dbg.debug("Warm start of " + str(ss.sid) + " from " + ss.warmfrom +
+                      "\n", dbg.verb_modes["chatty"], self)
+            self.writeNegftInp(os.path.abspath(os.path.join(spath, self.datpath)),
+                               ss.warmfrom, os.path.join(spath, self.datpath),
+                               dict(self.numpar, boolEins = True))
+
+    def warmsource(self, ss, efield0 = None):
+        '''Returns the absolute path of the eins folder of the nearest
+        converged neighbour of Structure ss in self.warmstart, at the bias
+        closest to efield0 (defaults to numpar["efield0"]), or None.
+        '''
+        if self.warmstart is None:
+            return None
+        if efield0 is None:
+            efield0 = self.numpar["efield0"]
+        nearest = self.warmstart.nearest(ss)
+        if nearest is None:
+            return None
+        return nearesteins(nearest[0], efield0)
+
+    def finishNEGF(self, ss, spath, walltime, datpath = None, numpar = None):
+        '''Called when the NEGF program for Structure ss in spath/datpath
+        (datpath defaults to self.datpath) has finished after walltime
+        seconds. Converged structures are added to self.warmstart. If a warm
+        started run has not converged at any bias, the input is rewritten
+        for a cold start with numpar (defaults to self.numpar) and True is
+        returned, so that the caller starts the NEGF program again (unless
+        it was killed by self.monitor).
+        '''
+        if datpath is None: datpath = self.datpath
+        if getattr(ss, "censored", False):
+            return False
+        try:
+            data = readnegft(os.path.join(spath, datpath, "negft.dat"))
+            converged = bool(np.any(data["conv"]))
+        except (OSError, ValueError):
+            converged = False
+        warm = getattr(ss, "warmfrom", None) is not None
+        if converged:
+            self.warmstart.record("warm" if warm else "cold", walltime)
+            self.warmstart.add(ss, os.path.join(spath, datpath, "eins"))
+            return False
+        if not warm:
+            return False
+        dbg.debug("Warm start of " + str(ss.sid) + " did not converge, " +
+                  "starting from scratch\n", dbg.verb_modes["verbose"], self)
+        self.warmstart.record("failed", walltime)
+        ss.warmfrom = None
+        self.writeNegftInp(os.path.abspath(os.path.join(spath, datpath)),
+                           self.einspath, os.path.join(spath, datpath),
+                           numpar)
+        negftfile = os.path.join(spath, datpath, "negft.dat")
+        if os.path.exists(negftfile):
+            os.remove(negftfile)
+        return True
 
     def runStructures(self, structures, path, runwannier = True):
         '''Run simulations for all structures in the given structure list with
         the base path "path". This method dispatches all processes and returns
         the user has to wait for processes to finish before accessing results.
 
-        Stores started processes in self.processes
+        If runwannier is True, the NEGF program for each structure is started
+        as soon as the Wannier program for that structure has finished,
+        independently of the other structures.
+
+        Stores started processes in self.processes. Since NEGF processes are
+        added as the Wannier processes finish, use waitforproc() to wait for
+        all of them.
+
+        Structures whose outputs are in self.simcache are restored instead of
+        being run (see Interface.restoreCached()). If self.warmstart is set,
+        the NEGF program is started from the converged state of the nearest
+        structure which has finished so far (see writeNegftRun()).
         '''
 
-        local = Local()
+        wannier = []
+        torun = []
         for ss in structures:
             spath = os.path.join(path,str(ss.dirname))
             su.mkdir(spath)
+            if self.restoreCached(ss, spath):
+                continue
+            torun.append(ss)
             self.initdir(ss, spath)
             if runwannier:
                 proc = self.pltfm.submitjob(self.progwann,[],spath,1,"00:10")
                 self.processes.append(proc)
+                wannier.append((proc, spath, ss))
         if runwannier:
             dbg.debug("Starting Wannier program.....\n",dbg.verb_modes["verbose"],self)
             dbg.flush()
-            # TODO do not wait for all processes-start each strucrure when ready!
-            self.waitforproc(1)
-        dbg.debug("Starting negf....\n",dbg.verb_modes["verbose"],self)
-        dbg.flush()
-        #del processes
-        #processes = []
-        for ss in structures:
-            spath = os.path.join( path, str(ss.dirname) )
-            if not runwannier:
-                self.writeNegftInp(su.abspath(spath), self.einspath ,
-                                   os.path.join(spath,self.datpath))
-            # replacing default value of Nper in scatt3.inp
-            proc = local.submitandwait("sed",['-i',"--in-place=''",'2s/1/'+str(self.numpar["Nper"])+'/', "scatt3.inp"],spath)
-            # to make sure file is closed:
-            out, err = proc.communicate()
-            proc = local.submitandwait("cp",["scatt3.inp","gw.inp",os.path.join(".",self.datpath)], spath)
-            out, err = proc.communicate()
-
-            proc = self.pltfm.submitjob(self.prognegft,[],os.path.join(spath, self.datpath))
-
-            self.processes.append(proc)
+            self.pltfm.flush()
+            for (proc, spath, ss) in wannier:
+                self.pltfm.on_complete(proc, lambda p, spath=spath, ss=ss:
+                                       self.startNEGF(spath, ss))
+        else:
+            dbg.debug("Starting negf....\n",dbg.verb_modes["verbose"],self)
+            dbg.flush()
+            for ss in torun:
+                spath = os.path.join( path, str(ss.dirname) )
+                self.startNEGF(spath, ss)
+        self.pltfm.flush()
         return self.processes
 
+    def startNEGF(self, spath, structure = None):
+        '''Copy the output of the Wannier program in spath to the NEGF
+        execution directory spath/self.datpath, and start the NEGF program
+        there. The started process is appended to self.processes and returned.
+        If self.warmstart is set, finishNEGF() is called for structure when
+        the process has finished. If self.monitor is set, the process is
+        watched by the NegftMonitor.
+
+        If self.Nchunks > 1, the sweep is split with startChunks() instead,
+        and the list of started processes is returned. The chunks are not
+        watched by self.monitor.
+        '''
+
+        dbg.debug("Starting negf in " + str(spath) + "\n",dbg.verb_modes["chatty"],self)
+        self.stageNEGF(spath)
+
+        t0 = time.time()
+        def finished(p):
+            if self.warmstart is not None and structure is not None and \
+                self.finishNEGF(structure, spath, time.time() - t0):
+                self.startNEGF(spath, structure)
+                self.pltfm.flush()
+
+        if self.Nchunks > 1 and self.numpar["Nefield"] > 1:
+            if self.monitor is not None:
+                dbg.debug("Warning: the chunks of " + str(spath) + " are not " +
+                          "watched by the monitor\n", dbg.verb_modes["verbose"],
+                          self)
+            return self.startChunks(spath, structure, finished)
+
+        proc = self.pltfm.submitjob(self.prognegft,[],os.path.join(spath, self.datpath))
+
+        self.processes.append(proc)
+        if self.monitor is not None and structure is not None:
+            self.monitor.watch(structure, os.path.dirname(os.path.normpath(spath)),
+                               proc)
+        if self.warmstart is not None and structure is not None:
+            self.pltfm.on_complete(proc, finished)
+        return proc
+
+    def startChunks(self, spath, structure = None, callback = None):
+        '''Start the bias sweep of self.numpar for the structure in spath as
+        self.Nchunks parallel jobs, each computing a contiguous part of the
+        efield range (see runBiasPoints()). When the last one has finished,
+        their outputs are merged into spath/self.datpath with mergeRuns(),
+        and callback(process) is called. Thus the results can be read as
+        for a single NEGF run as soon as all jobs are done. The jobs are
+        appended to self.processes, and returned as a list.
+        '''
+        Nefield = self.numpar["Nefield"]
+        Nchunks = min(self.Nchunks, Nefield)
+        sizes = [Nefield//Nchunks + (1 if k < Nefield % Nchunks else 0)
+                 for k in range(Nchunks)]
+        starts = [self.numpar["efield0"] + sum(sizes[:k])*self.numpar["defield"]
+                  for k in range(Nchunks)]
+        warmfrom = getattr(structure, "warmfrom", None)
+
+        runs = self.runBiasPoints(spath, starts, self.numpar, self.datpath,
+                                  [warmfrom]*Nchunks, sizes)
+        procs = [proc for (_, proc) in runs]
+        self.processes.extend(procs)
+
+        lock = threading.Lock()
+        remaining = [len(procs)]
+        def done(p):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.mergeRuns(spath, [rundir for (rundir, _) in runs])
+                if callback is not None:
+                    callback(p)
+        [self.pltfm.on_complete(proc, done) for proc in procs]
+        return procs
+
+    def stageNEGF(self, spath, datpath = None, numpar = None):
+        '''Prepare the Wannier program output in spath (scatt3.inp and gw.inp)
+        for the NEGF program executing in spath/datpath. The default value of
+        Nper (1) on the second line of scatt3.inp is replaced by
+        numpar["Nper"] in the copy in spath/datpath, and gw.inp is linked
+        (or copied), as are the other output files of the Wannier program.
+        The files in spath are not modified, so that several stages can be
+        prepared from them. The NEGF input (negft7.inp) must therefore point
+        to spath/datpath for the Wannier output (pathwann in
+        writeNegftInp()).
+        '''
+        if datpath is None: datpath = self.datpath
+        if numpar is None: numpar = self.numpar
 
-    def runStructSeq(self, structures, path, seq = None, runwannier = True):
+        dest = os.path.join(spath, datpath)
+        with open(os.path.join(spath, "scatt3.inp"), 'r') as f:
+            lines = f.readlines()
+        # replacing default value of Nper in scatt3.inp
+        if len(lines) > 1:
+            lines[1] = lines[1].replace("1", str(numpar["Nper"]), 1)
+        if os.path.lexists(os.path.join(dest, "scatt3.inp")):
+            os.remove(os.path.join(dest, "scatt3.inp"))
+        with open(os.path.join(dest, "scatt3.inp"), 'w') as f:
+            f.writelines(lines)
+        su.linkorcopy(os.path.join(spath, "gw.inp"), os.path.join(dest, "gw.inp"))
+        for name in os.listdir(spath):
+            src = os.path.join(spath, name)
+            if os.path.isfile(src) and \
+                not os.path.lexists(os.path.join(dest, name)):
+                su.linkorcopy(src, os.path.join(dest, name))
+
+    async def runStructureAsync(self, structure, path, runwannier = True):
+        '''Coroutine which runs the Wannier and NEGF programs for a single
+        structure, awaiting each stage through the platform's asyncio layer.
+        '''
+        spath = os.path.join(path,str(structure.dirname))
+        su.mkdir(spath)
+        if self.restoreCached(structure, spath):
+            return
+        self.initdir(structure, spath)
+        if runwannier:
+            await self.pltfm.submitjob_async(self.progwann,[],spath,1,"00:10")
+        self.stageNEGF(spath)
+        t0 = time.time()
+        await self.submitNEGF_async(structure, spath)
+        if self.warmstart is not None and \
+            self.finishNEGF(structure, spath, time.time() - t0):
+            t0 = time.time()
+            await self.submitNEGF_async(structure, spath)
+            self.finishNEGF(structure, spath, time.time() - t0)
+
+    async def submitNEGF_async(self, structure, spath):
+        '''Coroutine which runs the NEGF program in spath/self.datpath, and
+        watches it with self.monitor (if set), or runs the sweep in
+        self.Nchunks parallel jobs (see startChunks()).
+        '''
+        dirpath = os.path.join(spath, self.datpath)
+        if self.Nchunks > 1 and self.numpar["Nefield"] > 1:
+            if self.monitor is not None:
+                dbg.debug("Warning: the chunks of " + str(spath) + " are not " +
+                          "watched by the monitor\n", dbg.verb_modes["verbose"],
+                          self)
+            procs = self.startChunks(spath, structure)
+            await self.pltfm.waitall_async(procs)
+            return procs
+        if self.monitor is None:
+            return await self.pltfm.submitjob_async(self.prognegft, [], dirpath)
+        proc = self.pltfm.submitjob(self.prognegft, [], dirpath)
+        self.monitor.watch(structure, os.path.dirname(os.path.normpath(spath)),
+                           proc)
+        self.pltfm.flush()
+        return await self.pltfm.waitjob_async(proc)
+
+
+    def runStructSeq(self, structures, path, seq = None, runwannier = True,
+                     max_workers = None, adaptive = False):
         """Run NEGF sequentially, two times with (possibly) different parameters.
-        Generates one Thread for each structure.
+        The sequences of the structures are run concurrently by a thread pool,
+        with at most max_workers sequences running at the same time.
 
         Parameters:
 
@@ -160,25 +441,35 @@ class Inegf(Interface):
             be used in order.
         runwannier : boolean
             Specifies whether the wannier program will be run. Defaults to True.
-
-        Returns: list[Thread]
-            A list with the started threads. The calling function may implement
-
-                for tt in threads: tt.join()
-
-            in order to wait for all threads to complete.
+        max_workers : int
+            (Optional) Maximum number of sequences running at the same time.
+            Defaults to the number of jobs the platform can run concurrently
+            (Platform.maxjobs()), or to the number of structures if the
+            platform has no limit.
+        adaptive : boolean or dictionary
+            (Optional) See runSequence().
+
+        Returns: list[concurrent.futures.Future]
+            One future per structure, in the same order as structures. The
+            result of each future is the return value of runSequence(), i.e.
+            (negft_iv, negft_gain), or False if the simulation failed.
+            Results can be consumed as they finish with
+
+                for f in concurrent.futures.as_completed(futures): f.result()
         """
 
-        threads = []
-        for ss in structures:
-            t = threading.Thread(target=self.runSequence
-                                 , args = (ss, path, seq, runwannier) )
-            t.start()
-            threads.append(t)
+        if max_workers is None:
+            max_workers = self.pltfm.maxjobs()
+        if max_workers is None:
+            max_workers = max(1, len(structures))
 
-        return threads
+        executor = self.threadpool("sequences", max_workers)
+        return [executor.submit(self.runSequence, ss, path, seq, runwannier,
+                                adaptive)
+                for ss in structures]
 
-    def runSequence(self, structure, path, seq = None, runwannier = True):
+    def runSequence(self, structure, path, seq = None, runwannier = True,
+                    adaptive = False):
         """Run NEGF sequentially for a single structure on a single Thread.
 
         Parameters:
@@ -193,27 +484,66 @@ class Inegf(Interface):
             be used in order.
         runwannier : boolean
             Specifies whether the wannier program will be run. Defaults to True.
+        adaptive : boolean or dictionary
+            (Optional) If True, the IV sweep is refined adaptively around the
+            maximum current with runAdaptive(), instead of computing all
+            Nefield points. A dictionary is passed as keyword arguments to
+            runAdaptive(). Defaults to False.
 
         Returns: numpy.Array, numpy.Array
             negft_iv, negft_gain contains the results for the IV and gain simulations
             on matrix form.
 
+        If self.simcache is set, the outputs of both stages are restored from
+        it if the same sequence has been run for the structure before, and
+        are stored in it otherwise. If self.warmstart is set, the IV stage
+        starts from the converged state of the nearest structure at
+        seq[0]["efield0"] (see finishNEGF()). self.monitor does not watch the
+        sequence, since the merit is evaluated from the gain stage, of which
+        the IV sweep gives no partial merit.
+
         """
         if seq is None:
-            numpar = self.numpar.copy
+            numpar = self.numpar.copy()
             seq = [numpar,numpar]
 
         spath = os.path.join(path,str(structure.dirname))
         su.mkdir(spath)
+        if self.monitor is not None:
+            dbg.debug("Warning: the sequence of " + str(spath) + " is not " +
+                      "watched by the monitor\n", dbg.verb_modes["verbose"], self)
+        key = None
+        if self.simcache is not None:
+            key = self.simcache.key(structure, seq, self.programs(),
+                                    [self.wellmat.name, self.wellmat.params,
+                                     adaptive])
+            if self.restoreCached(structure, spath, key):
+                return (self.getresults(structure, path, datpath="IV"),
+                        self.getresults(structure, path))
         self.initdir(structure, spath)
         if runwannier:
             # Wannier program
             proc = self.pltfm.submitjob(self.progwann, [], spath, 1, "00:10")
             print(f"sid={structure.sid} running Wannier...")
-            while self.pltfm.jobstatus(proc):
-                time.sleep(1)
+            self.pltfm.waitjob(proc)
+
+        def runIV(einspath):
+            numpar = seq[0] if einspath is None else dict(seq[0], boolEins = True)
+            if adaptive:
+                kwargs = adaptive if isinstance(adaptive, dict) else {}
+                self.runAdaptive(spath, numpar, "IV", einspath = einspath,
+                                 **kwargs)
+            else:
+                self.runNEGF(spath, einspath, "IV", numpar)
 
-        self.runNEGF(spath, numpar=seq[0], datpath= "IV")
+        structure.warmfrom = self.warmsource(structure, seq[0]["efield0"])
+        t0 = time.time()
+        runIV(structure.warmfrom)
+        if self.warmstart is not None and \
+            self.finishNEGF(structure, spath, time.time() - t0, "IV", seq[0]):
+            t0 = time.time()
+            runIV(None)
+            self.finishNEGF(structure, spath, time.time() - t0, "IV", seq[0])
 
         try:
             negft_iv = self.getresults(structure, path, datpath="IV")
@@ -230,7 +560,8 @@ class Inegf(Interface):
         i = np.argmax(negft_iv[:,3])
         print(f"sid={structure.sid}: jmax = {negft_iv[i,3]}, vmax = {negft_iv[i,0]}")
 
-        numpar = seq[1]
+        # copy, since the sequence is shared between concurrent structures
+        numpar = seq[1].copy()
 
         numpar["efield0"] = x[imax]
 
@@ -240,6 +571,8 @@ class Inegf(Interface):
         self.runNEGF(spath, numpar=numpar, einspath=einspath)
 
         negft_gain = self.getresults(structure, path)
+        if key is not None:
+            self.simcache.store(key, spath, {"sequence": True})
 
         return negft_iv, negft_gain
 
@@ -261,28 +594,159 @@ class Inegf(Interface):
         if datpath is None: datpath = self.datpath
         if numpar is None: numpar = self.numpar
 
-        local = Local()
         su.mkdir(os.path.join(spath,datpath))
 
-        self.writeNegftInp(su.abspath(spath), einspath ,
+        self.writeNegftInp(os.path.abspath(os.path.join(spath,datpath)), einspath,
                            os.path.join(spath,datpath), numpar=numpar)
-        # replacing default value of Nper in scatt3.inp
-        proc = local.submitandwait("sed",['-i',"--in-place=''",
-                                          '2s/1/'+str(numpar["Nper"])+'/',
-                                          "scatt3.inp"],spath)
-        # to make sure file is closed:
-        out, err = proc.communicate()
-        proc = local.submitandwait("cp",["scatt3.inp","gw.inp",
-                                         os.path.join(".",datpath)], spath)
-        out, err = proc.communicate()
+        self.stageNEGF(spath, datpath, numpar)
 
         proc = self.pltfm.submitjob(self.prognegft,[],os.path.join(spath,datpath))
 
         print(f"Running NEGF in {spath}/{datpath}...")
-        while self.pltfm.jobstatus(proc):
-            time.sleep(1)
+        self.pltfm.waitjob(proc)
         print(f"Finished NEGF in {spath}/{datpath}!")
 
+    def runBiasPoints(self, spath, efields, numpar = None, datpath = None,
+                      einspaths = None, Nefield = 1):
+        '''Start the NEGF program for the bias ranges which begin at each
+        field in efields, with Nefield points each (spaced by
+        numpar["defield"]; Nefield may also be a list with the number of
+        points of each range), as parallel jobs. The job for efields[i] runs in
+        spath/datpath/bias/<efields[i] in mV>, and starts from the eins
+        files in einspaths[i] (or self.einspath, if einspaths[i] is None).
+        Returns the list of (directory, process) of the jobs. The outputs
+        are combined in spath/datpath with mergeRuns().
+        '''
+        if datpath is None: datpath = self.datpath
+        if numpar is None: numpar = self.numpar
+        if einspaths is None: einspaths = [None]*len(efields)
+        if not isinstance(Nefield, list): Nefield = [Nefield]*len(efields)
+
+        runs = []
+        for efield, einspath, N in zip(efields, einspaths, Nefield):
+            rundir = os.path.join(datpath, "bias", "{:.3f}".format(efield*1000))
+            if not os.path.isdir(os.path.join(spath, rundir)):
+                su.mkdir(os.path.join(spath, rundir))
+            runpar = dict(numpar, efield0 = efield, Nefield = N)
+            if einspath is None:
+                einspath = self.einspath
+            else:
+                runpar["boolEins"] = True
+            self.writeNegftInp(os.path.abspath(os.path.join(spath, rundir)),
+                               einspath, os.path.join(spath, rundir),
+                               numpar = runpar)
+            self.stageNEGF(spath, rundir, runpar)
+            proc = self.pltfm.submitjob(self.prognegft, [],
+                                        os.path.join(spath, rundir))
+            runs.append((os.path.join(spath, rundir), proc))
+        self.pltfm.flush()
+        return runs
+
+    def mergeRuns(self, spath, rundirs, datpath = None):
+        '''Combine the outputs of the NEGF runs in the directories rundirs in
+        spath/datpath, as if they were computed by a single run there: the
+        points of their negft.dat are written to spath/datpath/negft.dat,
+        sorted by bias, and their eins folders are linked into
+        spath/datpath/eins. Points and folders of later runs replace those
+        of earlier runs at the same bias.
+        '''
+        if datpath is None: datpath = self.datpath
+        dest = os.path.join(spath, datpath)
+        einsdest = os.path.join(dest, "eins")
+        if not os.path.isdir(einsdest):
+            su.mkdir(einsdest)
+
+        header = None
+        points = {}
+        for rundir in rundirs:
+            try:
+                with open(os.path.join(rundir, "negft.dat")) as f:
+                    lines = f.read().splitlines()
+            except (OSError, IOError):
+                continue
+            if header is None:
+                header = [l for l in lines if '#' in l]
+            for l in lines:
+                try:
+                    # eFd, omega, eFacd
+                    key = tuple([float(c) for c in l.split()[:3]])
+                except ValueError:
+                    continue # comment or incomplete line
+                if len(key) == 3:
+                    points[key] = l
+
+            try:
+                folders = su.listdirs(os.path.join(rundir, "eins"))
+            except (OSError, IOError):
+                folders = []
+            for folder in folders:
+                link = os.path.join(einsdest, folder)
+                if os.path.islink(link):
+                    os.remove(link)
+                elif os.path.isdir(link):
+                    shutil.rmtree(link)
+                os.symlink(os.path.relpath(os.path.join(rundir, "eins", folder),
+                                           einsdest), link)
+
+        tmp = os.path.join(dest, ".negft.dat.tmp")
+        with open(tmp, 'w') as f:
+            [f.write(l + "\n") for l in (header or [])]
+            [f.write(points[k] + "\n") for k in sorted(points)]
+        os.replace(tmp, os.path.join(dest, "negft.dat"))
+
+    def runAdaptive(self, spath, numpar = None, datpath = None, Ncoarse = 5,
+                    tol = None, maxrounds = 10, column = "j", einspath = None):
+        '''Run the bias sweep of numpar (efield0, defield, Nefield) in
+        spath/datpath adaptively. Ncoarse evenly spaced points of the sweep
+        are computed first, as parallel jobs (see runBiasPoints()), starting
+        from the eins files in einspath (defaults to self.einspath). Then, in
+        each round, the points halfway between the maximum of column ("j"
+        for the current density, or "gain") and its neighbours are computed,
+        until they are closer than tol (defaults to numpar["defield"]), or
+        after maxrounds rounds. Each new point starts from the eins files
+        of the nearest computed bias. The results are merged into
+        spath/datpath (see mergeRuns()), so that they can be read with
+        getresults() as for a uniform sweep.
+
+        Returns the sorted list of the fields computed.
+        '''
+        if datpath is None: datpath = self.datpath
+        if numpar is None: numpar = self.numpar
+        if tol is None: tol = numpar["defield"]
+
+        efieldf = numpar["efield0"] + (numpar["Nefield"] - 1)*numpar["defield"]
+        efields = list(np.linspace(numpar["efield0"], efieldf,
+                                   max(2, min(Ncoarse, numpar["Nefield"]))))
+        einspaths = None if einspath is None else [einspath]*len(efields)
+        done = []
+        rundirs = []
+        einsdir = os.path.join(spath, datpath, "eins")
+        for _ in range(maxrounds):
+            runs = self.runBiasPoints(spath, efields, numpar, datpath, einspaths)
+            self.pltfm.waitall([proc for (_, proc) in runs])
+            rundirs += [rundir for (rundir, _) in runs]
+            done = sorted(done + efields)
+            self.mergeRuns(spath, rundirs, datpath)
+
+            try:
+                data = readnegft(os.path.join(spath, datpath, "negft.dat"))
+            except (OSError, ValueError):
+                break
+            data = data[data["conv"]]
+            if len(data) == 0:
+                break
+            emax = data["eFd"][np.argmax(data[column])]
+            i = int(np.argmin(np.abs(np.array(done) - emax)))
+            efields = [(done[i] + done[j])/2 for j in (i-1, i+1)
+                       if 0 <= j < len(done) and abs(done[j] - done[i]) > tol]
+            if len(efields) == 0:
+                break
+            einspaths = [nearesteins(einsdir, e) for e in efields]
+        dbg.debug("Adaptive sweep in " + str(spath) + ": " + str(len(done)) +
+                  " points instead of " + str(numpar["Nefield"]) + "\n",
+                  dbg.verb_modes["verbose"], self)
+        return done
+
     def checkactive(self):
         pactive = False
         for p in self.processes:
@@ -291,67 +755,59 @@ class Inegf(Interface):
         return pactive
 
 
-    def gatherResults(self, structures, pathwd, pathresults = None, runhdiag = True, runbandplot = True):
+    def gatherResults(self, structures, pathwd, pathresults = None, runhdiag = True, runbandplot = True,
+                      max_workers = None):
         '''Write results to pathresults/results.log and run hdiag and bandplot
         in pathwd/s.dirname/self.datpath/eins/x/ for each i and x. Stores WS
         resutls as a new attribute levels[directory][WS level][data field] in
         each Structure object in the list structures.
+
+        The folders of all structures are post-processed in parallel by
+        max_workers threads (defaults to the number of cores of this
+        machine, where hdiag and bandplot run, whatever the platform of the
+        simulations). The results of each
+        structure are written as soon as all its folders are done, and its
+        outputs are stored in self.simcache (if set).
         '''
 
-        if(pathresults is None):
-            pathresults = pathwd
+        pathresults = self.resultspath(pathwd, pathresults)
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
 
+        executor = self.threadpool("postprocess", max_workers)
+        tasks = {}
+        for ss in structures:
+            spath = pathwd + "/" + str(ss.dirname)
+            try:
+                dirlist = su.listdirs(os.path.join(spath,self.datpath,"eins"))
+            except (OSError, IOError):
+                print("WARNING: could not find directory: " + os.path.join(spath,self.datpath,"eins"))
+                continue
+            tasks[ss] = [executor.submit(self.postprocess, ss,
+                                         os.path.join(spath,self.datpath,"eins",folder),
+                                         runhdiag, runbandplot)
+                         for folder in dirlist]
+
+        store = self.resultstore(pathresults)
         with open(pathresults+'/results.log','a') as f:
-            f.write('# Results for structures:\nID | merit | \
-            N times layer width | Ndop times (zi, zf, nvol) | N times x \n')
+            f.write(rs.header)
             for ss in structures:
+                if ss not in tasks:
+                    continue
                 ss.wslevels = []
                 ss.dipoles = []
-                spath = pathwd + "/" + str(ss.dirname)
-                try:
-                    dirlist = su.listdirs(os.path.join(spath,self.datpath,"eins"))
-                except (OSError, IOError):
-                    print("WARNING: could not find directory: " + os.path.join(spath,self.datpath,"eins"))
-                    continue
-                dirs = dirlist
-                for folder in dirs:
-                    einspath = os.path.join(spath,self.datpath,"eins",folder)
-                    omega0 = self.numpar["fgr_omega0"]
-                    omegaf = self.numpar["fgr_omegaf"]
-                    Nomega = self.numpar["fgr_Nomega"]
-                    gamma  = self.numpar["fgr_gamma"]
-                    if runhdiag:
-                        self.runHdiag(einspath,omega0=omega0,omegaf=omegaf, Nomega = Nomega, gamma=gamma)
-
-                        # Check if daigolalization failed, try zshift_trial times with zshift:
-                        zshift = 0.
-                        for _ in range(self.hdiag_numpar["zshift_trials"]-1):
-                            if self.checkWSdens(einspath) == False:
-                                zshift += ss.length/self.hdiag_numpar["zshift_trials"]
-                                self.runHdiag(einspath,zshift=zshift, omega0=omega0,omegaf=omegaf,
-                                          Nomega = Nomega, gamma=gamma)
-                            else:
-                                break
-                        if runbandplot:
-                            self.runBandplot(einspath, ss)
-
-                    (levels, dipoles) = self.getWSdata(einspath)
+                # in the order of the folders, while later ones are running
+                for task in tasks[ss]:
+                    (levels, dipoles) = task.result()
                     ss.wslevels.append(levels)
                     ss.dipoles.append(dipoles)
 
                 ss.merit = self.getMerit(ss, pathwd)
+                self.storeCached(ss, pathwd + "/" + str(ss.dirname))
 
-                f.write(str(ss.dirname) + " ")
-                f.write(str(ss.merit) + " " )
-                for layer in ss.layers:
-                    f.write(str(layer.width)+" ")
-                for doping in ss.dopings:
-                    for val in doping:
-                        f.write( str(val) +" ")
-                for layer in ss.layers:
-                    f.write(str(layer.material.x)+" ")
-
-                f.write("\n")
+                record = rs.structrecord(ss, ss.dirname)
+                store.add([record])
+                f.write(rs.formatrecord(record))
                 if self.merit == self.merits["Chi2"]:
                     su.mkdir(pathresults + ss.dirname)
                     with open(pathresults + ss.dirname+"/chi2.log", 'w') as chif:
@@ -378,6 +834,32 @@ class Inegf(Interface):
                                             + "\n")
 
 
+    def postprocess(self, ss, einspath, runhdiag = True, runbandplot = True):
+        '''Run hdiag (and bandplot) in einspath for the Structure ss, and
+        return its (WS levels, dipoles). If the diagonalization fails, hdiag
+        is run again with zshift up to zshift_trials times.
+        '''
+        omega0 = self.numpar["fgr_omega0"]
+        omegaf = self.numpar["fgr_omegaf"]
+        Nomega = self.numpar["fgr_Nomega"]
+        gamma  = self.numpar["fgr_gamma"]
+        if runhdiag:
+            self.runHdiag(einspath,omega0=omega0,omegaf=omegaf, Nomega = Nomega, gamma=gamma)
+
+            # Check if daigolalization failed, try zshift_trial times with zshift:
+            zshift = 0.
+            for _ in range(self.hdiag_numpar["zshift_trials"]-1):
+                if self.checkWSdens(einspath) == False:
+                    zshift += ss.length/self.hdiag_numpar["zshift_trials"]
+                    self.runHdiag(einspath,zshift=zshift, omega0=omega0,omegaf=omegaf,
+                              Nomega = Nomega, gamma=gamma)
+                else:
+                    break
+            if runbandplot:
+                self.runBandplot(einspath, ss)
+
+        return self.getWSdata(einspath)
+
     def runHdiag(self, path, zshift=0, omega0=0, omegaf=1, Nomega = 1000,
                   Nper=1, gamma = 0.0001, Nk = 0, dEk = 0.001, Ek = -1):
         '''Run hdiag8 program in path "path" to diagonalize the basis for a
@@ -401,8 +883,10 @@ class Inegf(Interface):
             commands += str(dEk) + "\n"
         commands += str(Ek)
 
-        proc = su.dispatch(self.proghdiag, [], path, infile = subprocess.PIPE, outfile = subprocess.PIPE, errfile = subprocess.PIPE)
-        out, err = proc.communicate(commands)
+        # account for the core used by hdiag on platforms with a core budget
+        with self.pltfm.reserve(1) as cpus:
+            proc = su.dispatch(self.proghdiag, [], path, infile = subprocess.PIPE, outfile = subprocess.PIPE, errfile = subprocess.PIPE, cpus = cpus)
+            out, err = proc.communicate(commands)
         dbg.debug("from hdiag: " + str(out) + str(", ") + str(err), dbg.verb_modes["chatty"], self.__class__)
         su.waitforproc(proc, 0.1)
         return proc
@@ -495,8 +979,9 @@ class Inegf(Interface):
             raise Exception("mpameter not valid: plot local data = "+localdata)
         commands += str(zmin) + "\n" + str(zmax) + "\n" + str(pmin) + "\n" + str(pmax) + "\n" + str(square) + "\n" + str(renorm) + "\n"
 
-        proc = su.dispatch(self.progbandplot, [], path, infile = subprocess.PIPE)
-        proc.communicate(commands)
+        with self.pltfm.reserve(1) as cpus:
+            proc = su.dispatch(self.progbandplot, [], path, infile = subprocess.PIPE, cpus = cpus)
+            proc.communicate(commands)
         return proc
 
     def getMerit(self,structure,path, only_conv = True):
@@ -505,77 +990,26 @@ class Inegf(Interface):
         '''
 
         # First try to see if results were already evaluated:
-        # assumes structure for results.log:
-        # sid | merit | ...
-
-        if 'results.log' in su.ls(path):
-            with open(path + '/results.log') as f:
-                found = False
-                for line in f:
-                    line = line.split()
-                    if line[0] == str(structure.sid):
-                        return line[1]
+        merit = self.storedMerit(structure, path)
+        if merit is not None:
+            return merit
 
         path = os.path.join( path , structure.dirname , self.datpath )
 
-        results = []
-
         try:
-            with open(path+"/negft.dat",'r') as f:
-                for line in f:
-                    try:
-                        if '#' in line or only_conv and (line.split()[Inegf.idat.get("ierror")].endswith('1')\
-                                or line.split()[Inegf.idat.get("konv")] == 'NaN'):
-                            continue
-                    except(IndexError): # missing # in negft.dat, with intel compiler
-                        continue
-                    results.append(line.split())
-                if results == []:
-                    return "NO CONV"
-            f.closed
-
+            data = readnegft(os.path.join(path, "negft.dat"))
         except (OSError, IOError):
             print("\nWARNING: Could not find directory: " + path)
             return "ERROR"
         except ValueError:
             print("\nWarning: Error when getting results from: " + path)
             return "ERROR"
+        if only_conv:
+            data = data[data["conv"]]
+        if len(data) == 0:
+            return "NO CONV"
 
-        values = []
-        for i in range(0, len(Inegf.idat)):
-            datval = []
-            for row in results:
-                datval.append(float(row[i]))
-            values.append(datval)
-
-        if self.merit == Interface.merits.get("max gain") :
-            # interpolate results:
-            iom = Inegf.idat["omega"]
-            igain=Inegf.idat["gain"]
-            try:
-                if len(values[1]) > 2:
-                    if len(values[1]) > 3:
-                        kind = "cubic"
-                    elif len(values[1]) == 3:
-                        kind = "quadratic"
-                    x = np.linspace(values[iom][0],values[iom][-1])
-                    f = interp1d(values[iom], values[igain], kind=kind)
-                    np.savetxt(os.path.join(path,'gain_interp.dat'),list(zip(x,f(x))))
-                    out = np.max(f(x))
-                else:
-                    out = np.max(values[igain])
-            except ValueError:
-                return "ERROR"
-
-        elif self.merit == Interface.merits.get("(max gain)/(current density)"):
-
-            gain = values[Inegf.idat.get("gain")]
-            j = values[Inegf.idat.get("j")]
-            gainj = []
-            [gainj.append(gain[i]/j[i]) for i in range(0,len(gain))]
-            out = max(gainj)
-
-        elif self.merit == self.merits.get("estimated gain") :
+        if self.merit == self.merits.get("estimated gain") :
             try:
                 dirlist = su.listdirs(os.path.join(path,"eins"))
             except (OSError, IOError):
@@ -593,7 +1027,7 @@ class Inegf(Interface):
                             except( IndexError ):
                                 pass
 
-            out = max(maxgain)
+            return max(maxgain)
 
         elif self.merit == self.merits["Chi2"]:
 
@@ -616,39 +1050,64 @@ class Inegf(Interface):
                 return "ERROR"
             else:
                 return chi2
+
+        try:
+            out = self.meritFromData(data, path)
+        except (IndexError, ValueError):
+            return "ERROR"
+        if out is None:
+            print("No such merit function!")
+
+        return out
+
+    def meritFromData(self, data, path = None):
+        '''Returns the merit function evaluated for the points of data (an
+        array returned by readnegft()), for the merits which only depend on
+        negft.dat: "max gain", "(max gain)/(current density)",
+        "photocurrent", "gain integral" and "gain FWHM". Returns None for
+        the other merits. Raises ValueError or IndexError if the merit
+        cannot be evaluated.
+
+        For "max gain", the gain of a frequency sweep is interpolated, and
+        written to path/gain_interp.dat if path is given. This is used both
+        by getMerit() and for the partial merits of NegftMonitor.
+        '''
+
+        if self.merit == Interface.merits.get("max gain") :
+            # interpolate results (of a single frequency sweep):
+            omega = data["omega"]
+            if len(omega) > 2 and len(np.unique(omega)) == len(omega):
+                if len(omega) > 3:
+                    kind = "cubic"
+                else:
+                    kind = "quadratic"
+                x = np.linspace(omega[0],omega[-1])
+                f = interp1d(omega, data["gain"], kind=kind)
+                if path is not None:
+                    np.savetxt(os.path.join(path,'gain_interp.dat'),list(zip(x,f(x))))
+                return np.max(f(x))
+            return np.max(data["gain"])
+
+        elif self.merit == Interface.merits.get("(max gain)/(current density)"):
+
+            return mf.maxgainj(data["gain"], data["j"])
+
         elif self.merit == self.merits["photocurrent"]:
             omegat = self.target[0]
             if len(self.target) > 1:
                 a = self.target[1]
             else:
                 a = 0.010 # eV
-            currlist = np.abs( values[Inegf.idat.get("j")] )
+            currlist = np.abs( data["j"] )
             imax = np.argmax(currlist)
             jmax = currlist[imax]
-            omegamax = values[Inegf.idat.get("omega")][imax]
+            omegamax = data["omega"][imax]
 
             return jmax*np.exp(-np.abs(omegamax - omegat)/a)
 
         elif self.merit == self.merits["gain integral"]:
             # Optimize the area under the gain curve
-
-            gain = values[Inegf.idat.get("gain")]
-            omega = values[Inegf.idat.get("omega")]
-            efd = values[Inegf.idat.get("eFd")]
-
-            sum = 0.
-            sums = []
-            efd0 = efd[0]
-            domega = omega[1] - omega[0]
-            for i in range(len(gain)):
-                if efd[i] != efd0:
-                    sums.append(sum)
-                    sum  = 0.
-                    efd0 = efd[i]
-                sum = sum + gain[i]*domega
-            sums.append(sum)
-            # Scaling output to prevent sharp narrow peaks
-            return np.max(sums)/np.max(np.abs(gain))
+            return mf.gainintegral(data["eFd"], data["omega"], data["gain"])
 
         elif self.merit == self.merits["gain FWHM"]:
             # Opitmize the width of the gain peak
@@ -658,43 +1117,9 @@ class Inegf(Interface):
             else:
                 losses = 0.
 
-            gain = values[Inegf.idat.get("gain")]
-            omega = values[Inegf.idat.get("omega")]
-            efd = values[Inegf.idat.get("eFd")]
-            efd0 = efd[0]
-            FWHMs = []
-            omega_efd = []
-            gain_efd = []
-            for i in range(len(gain)):
-                omega_efd.append(omega[i])
-                gain_efd.append(gain[i])
-                if efd[i] != efd0 or i == len(gain) -1:
-                    efd0 = efd[i]
-                    # end of eFd period
-                    om0 = None
-                    om1 = None
-                    for j in range(len(omega_efd)-1):
-                        if (gain[j]-losses)*(gain[j+1]-losses) < 0:
-                            f = interp1d([gain[j], gain[j+1]],
-                                         [omega[j], omega[j+1]])
-                            om0 = f(losses)
-                        if (gain[j]-losses)*(gain[j+1]-losses) < 0 and om0 is not None:
-                            f = interp1d([gain[j], gain[j+1]],
-                                         [omega[j], omega[j+1]])
-                            om1 = f(losses)
-                    if om0 is None or om1 is None or np.max(gain_efd) < 0:
-                        FWHMs.append(0.)
-                    else:
-                        FWHMs.append(abs(om1-om0))
-                    omega_efd = []
-                    gain_efd = []
-                    om1, om0 = None, None
-
-                    out = np.max(FWHMs)
-        else:
-            print("No such merit function!")
+            return mf.gainfwhm(data["eFd"], data["omega"], data["gain"], losses)
 
-        return out
+        return None
 
     def writeMaterial(self,material,nametag,dirpath = None):
         '''Writes the material.inp input file.'''
@@ -885,18 +1310,10 @@ class Inegf(Interface):
         else:
             path = path + "/" + structure.dirname + "/" + datpath + "/negft.dat"
 
-        negft = []
-        with open(path, "r") as file:
-            for l in file:
-                row = []
-                try:
-                    row = [ float( l.split()[i] ) for i in range(5) ]
-                except (ValueError, IndexError):
-                    # These are commented lines
-                    continue
-                negft.append(row)
-        negft = np.array(negft)
-        negft = negft[negft[:,0].argsort()]
+        data = readnegft(path)
+        names = sorted(Inegf.idat, key = Inegf.idat.get)
+        negft = np.column_stack([data[n] for n in names[:5]])
+        negft = negft[negft[:,0].argsort(kind = "stable")]
 
         return negft
 
@@ -1048,18 +1465,7 @@ class Inegf(Interface):
 
 
         if ydata == 'Current':
-            negft = []
-            with open(path + "/../negft.dat", "r") as file:
-                for l in file:
-                    row = []
-                    try:
-                        row = [ float( l.split()[i] ) for i in range(5) ]
-                    except (ValueError, IndexError):
-                        # These are commented lines
-                        continue
-                    negft.append(row)
-            negft = np.array(negft)
-            negft = negft[negft[:,0].argsort()]
+            negft = self.getresults(None, path + "/..")
 
         for dir in dirlist:
             try:
@@ -1291,3 +1697,319 @@ class Inegf(Interface):
         self.chi2 = chi2
 
         return np.abs( chi2 )
+
+
+class NegftMonitor(object):
+    '''
+    Monitor of running NEGF jobs, which tails their negft.dat and kills the
+    jobs whose merit cannot become competitive any more. At each check, the
+    merit of the converged bias points computed so far (the partial merit)
+    is evaluated from the parsed negft.dat (see partialmerit()) with the
+    same formula as getMerit() (see Inegf.meritFromData()), without
+    writing any file. This is possible for the merits which only depend on
+    negft.dat; jobs of models with other merits are never killed.
+
+    Only the jobs started by Inegf.startNEGF() (or runStructures()) for a
+    single bias sweep are watched. Sweeps split into chunks (Nchunks > 1,
+    see Inegf.startChunks()) and the sequences of runSequence() run to
+    completion.
+
+    An optimistic bound of the final merit is the partial merit plus
+    optimism times the largest of the following increases over the
+    remaining bias points:
+    - the increase at the largest rate per bias point of the job so far,
+    - the increase over the same bias points in the full sweeps of the
+      watched jobs which have finished,
+    - mingrowth*|best| over a full sweep, as a floor for flat stretches.
+    A job is killed through Platform.killjob() when this bound falls below
+    best - (1 - fraction)*|best|, that is below fraction*best for a positive
+    best. Larger merits are assumed to be better.
+
+    The merit of a killed structure is its partial merit, a lower bound of
+    the merit of the full sweep (a censored value). It is kept in
+    structure.merit, and evaluated again by gatherResults() from the
+    truncated negft.dat, and structure.censored is set to True, which is stored with the result
+    (see aftershoq.utils.resultstore).
+
+    Parameters:
+    model: Inegf running the jobs. Set model.monitor to the monitor to watch
+        all NEGF jobs started by the model.
+    fraction (optional): Fraction of the best merit below which jobs are
+        killed. Defaults to 0.5.
+    best (optional): Best merit so far. It is raised by the merits of the
+        watched jobs which finish, and by update().
+    minpoints (optional): Number of bias points a job must have computed
+        before it can be killed. Defaults to 3.
+    optimism (optional): Factor of the increase of the bound. Defaults
+        to 2.
+    interval (optional): Seconds between checks. Defaults to 10.
+    mingrowth (optional): Smallest increase of the merit over a full sweep
+        assumed by the bound, as a fraction of |best|. Defaults to 0.2.
+    '''
+
+    # number of full sweeps kept for the bound
+    maxprofiles = 100
+
+    def __init__(self, model, fraction = 0.5, best = None, minpoints = 3,
+                 optimism = 2., interval = 10., mingrowth = 0.2):
+        self.model = model
+        self.fraction = fraction
+        self.best = best
+        self.minpoints = minpoints
+        self.optimism = optimism
+        self.interval = interval
+        self.mingrowth = mingrowth
+        self.lock = threading.Lock()
+        self.jobs = []
+        # (number of points, partial merit) of the finished sweeps
+        self.profiles = collections.deque(maxlen = self.maxprofiles)
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def watch(self, structure, path, proc):
+        '''Watch the NEGF job proc of structure, with base path "path",
+        until it has finished. The checks run on a background thread.
+        '''
+        structure.censored = False
+        job = {"structure": structure, "path": path, "proc": proc,
+               "history": [], "killed": False}
+        with self.lock:
+            self.jobs.append(job)
+            if self.thread is None:
+                self.stopped.clear()
+                self.thread = threading.Thread(target = self.run, daemon = True)
+                self.thread.start()
+        self.model.pltfm.on_complete(proc, lambda p: self.finished(job))
+
+    def update(self, merit):
+        '''Raise the best merit to merit, if it is larger.'''
+        try:
+            merit = float(merit)
+        except (TypeError, ValueError):
+            return
+        with self.lock:
+            if self.best is None or merit > self.best:
+                self.best = merit
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        '''Stop the background checks.'''
+        self.stopped.set()
+        with self.lock:
+            self.thread = None
+
+    def check(self):
+        '''Check all watched jobs once, and kill the uncompetitive ones.'''
+        with self.lock:
+            jobs = list(self.jobs)
+        for job in jobs:
+            try:
+                self.checkjob(job)
+            except Exception as e:
+                dbg.debug("Error while checking " + str(job["path"]) + ": " +
+                          str(e) + "\n", dbg.verb_modes["verbose"], self)
+
+    def partialmerit(self, data):
+        '''Returns the merit of the converged points of data (an array
+        returned by readnegft()), evaluated as by getMerit() (see
+        Inegf.meritFromData()), or NaN if there are none or the merit of
+        the model cannot be evaluated from negft.dat alone.
+        '''
+        data = data[data["conv"]]
+        if len(data) == 0:
+            return np.nan
+        try:
+            merit = self.model.meritFromData(data)
+        except (IndexError, TypeError, ValueError):
+            return np.nan
+        if merit is None:
+            return np.nan
+        return float(merit)
+
+    def growth(self, history, remaining, total, best):
+        '''Returns the optimistic increase of the partial merit of a job
+        with history [(number of points, partial merit), ...] over its
+        remaining bias points, out of total (see NegftMonitor), before the
+        factor optimism.
+        '''
+        npoints = history[-1][0]
+        rate = max([0.] + [(history[i][1] - history[i-1][1]) /
+                           (history[i][0] - history[i-1][0])
+                           for i in range(1, len(history))])
+        growth = max(rate*remaining, self.mingrowth*abs(best)*remaining/total)
+        with self.lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            before = [m for n, m in profile if n <= npoints]
+            start = before[-1] if len(before) > 0 else profile[0][1]
+            growth = max(growth, profile[-1][1] - start)
+        return growth
+
+    def readjob(self, job):
+        '''Returns the parsed negft.dat of job, see readnegft().'''
+        return readnegft(os.path.join(job["path"], job["structure"].dirname,
+                                      self.model.datpath, "negft.dat"))
+
+    def checkjob(self, job):
+        ss = job["structure"]
+        numpar = self.model.numpar
+        try:
+            data = self.readjob(job)
+        except (OSError, ValueError):
+            return
+        npoints = len(data)
+        history = job["history"]
+        if job["killed"] or (len(history) > 0 and history[-1][0] == npoints):
+            return
+        merit = self.partialmerit(data)
+        if np.isnan(merit):
+            return # nothing converged yet
+        history.append((npoints, merit))
+
+        total = numpar["Nefield"]*numpar["Nomega"]*numpar["Nefac"]
+        remaining = total - npoints
+        with self.lock:
+            best = self.best
+        if best is None or remaining <= 0 or npoints < self.minpoints or \
+            len(history) < 2:
+            return
+        bound = merit + self.optimism*self.growth(history, remaining, total,
+                                                  best)
+        threshold = best - (1. - self.fraction)*abs(best)
+        if bound < threshold:
+            dbg.debug("Killing NEGF for structure " + str(ss.sid) +
+                      " after " + str(npoints) + " points, bound " +
+                      str(bound) + " < " + str(threshold) + "\n",
+                      dbg.verb_modes["verbose"], self)
+            job["killed"] = True
+            ss.merit = merit
+            ss.censored = True
+            self.model.pltfm.killjob(job["proc"])
+
+    def finished(self, job):
+        with self.lock:
+            if job in self.jobs:
+                self.jobs.remove(job)
+        if job["killed"]:
+            return
+        self.update(self.model.getMerit(job["structure"], job["path"]))
+        try:
+            data = self.readjob(job)
+        except (OSError, ValueError):
+            return
+        merit = self.partialmerit(data)
+        if not np.isnan(merit):
+            with self.lock:
+                self.profiles.append(job["history"] + [(len(data), merit)])
+
+
+def nearesteins(einsdir, efield):
+    '''Returns the absolute path (ending with /) of the folder in the eins
+    directory einsdir with the bias closest to efield, or None if there is
+    none.
+    '''
+    folders = {}
+    try:
+        for folder in su.listdirs(einsdir):
+            try:
+                # folders are named eFd_omega_eFacd, in mV
+                folders[folder] = float(folder.split("_")[0])/1000
+            except ValueError:
+                continue
+    except OSError:
+        return None
+    if len(folders) == 0:
+        return None
+    folder = min(folders, key=lambda f: abs(folders[f] - efield))
+    return os.path.join(os.path.abspath(einsdir), folder) + "/"
+
+
+# parsed negft.dat files: {filename: (mtime, size, data, inode, offset,
+# last complete line, data of the complete lines)}, of the negftcachesize
+# files read last
+negftcache = collections.OrderedDict()
+negftcachesize = 64
+negftlock = threading.Lock()
+
+def readnegft(filename):
+    '''Returns the contents of the negft.dat file filename as a numpy
+    structured array, with one float field for each column in Inegf.idat,
+    and the boolean field "conv" which is False for points which did not
+    converge (ierror ending with 1, or konv NaN). Comment lines, and lines
+    with missing columns, are skipped.
+
+    The result is cached until the modification time or size of the file
+    changes (for the negftcachesize files read last), and must not be
+    modified by the caller. If the file has grown
+    since the last call (while the NEGF program is running), only the new
+    lines are parsed. Raises OSError if the file cannot be read, and
+    ValueError if it cannot be parsed.
+    '''
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    with negftlock:
+        cached = negftcache.get(filename)
+        if cached is not None:
+            negftcache.move_to_end(filename)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+
+    offset, last, old = 0, b"", None
+    with open(filename, 'rb') as f:
+        if cached is not None and cached[3] == st.st_ino and \
+            st.st_size > cached[1]:
+            # appended to, unless the last complete line has changed
+            f.seek(cached[4] - len(cached[5]))
+            if f.read(len(cached[5])) == cached[5]:
+                offset, last, old = cached[4], cached[5], cached[6]
+        f.seek(offset)
+        text = f.read()
+
+    # the last line may not be complete yet
+    end = text.rfind(b"\n") + 1
+    if end > 0:
+        last = text[text.rfind(b"\n", 0, end - 1) + 1:end]
+    complete = parsenegft(text[:end].decode(errors = "replace"))
+    if old is not None:
+        complete = np.concatenate((old, complete))
+    data = complete
+    if end < len(text):
+        data = np.concatenate((complete,
+                               parsenegft(text[end:].decode(errors = "replace"))))
+
+    with negftlock:
+        negftcache[filename] = (st.st_mtime_ns, st.st_size, data, st.st_ino,
+                                offset + end, last, complete)
+        negftcache.move_to_end(filename)
+        while len(negftcache) > negftcachesize:
+            negftcache.popitem(last = False)
+    return data
+
+def parsenegft(text):
+    '''Returns the lines of negft.dat in the string text as a structured
+    array, see readnegft().
+    '''
+    names = sorted(Inegf.idat, key = Inegf.idat.get)
+    ncol = len(names)
+    lines = [l for l in text.splitlines() if '#' not in l and l.strip()]
+    try:
+        if len(lines) == 0:
+            raise IndexError
+        cols = np.loadtxt(lines, dtype = str, usecols = range(ncol), ndmin = 2)
+    except (ValueError, IndexError):
+        # missing # in negft.dat, with intel compiler
+        lines = [l.split()[:ncol] for l in lines if len(l.split()) >= ncol]
+        cols = np.array(lines, dtype = str).reshape((-1, ncol))
+
+    data = np.empty(len(cols), dtype = [(n, float) for n in names] + [("conv", bool)])
+    for i, n in enumerate(names):
+        if n == "ierror":
+            data[n] = [rs.tofloat(e, np.nan) for e in cols[:, i]]
+        else:
+            data[n] = cols[:, i].astype(float)
+    data["conv"] = ~np.char.endswith(cols[:, Inegf.idat["ierror"]], '1') & \
+        ~np.isnan(data["konv"])
+    return data
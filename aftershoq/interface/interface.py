@@ -20,9 +20,13 @@ dictionaries and in __init__() call self.numpar.update( _new_dict_ )
 
 '''
 
-import time
+import asyncio
+import functools
+import os
 from aftershoq.structure import Structure
 from aftershoq.numerics.runplatf import Local
+from aftershoq.utils.resultstore import SQLiteStore
+import aftershoq.utils.debug as dbg
 
 class Interface(object):
     
@@ -40,6 +44,16 @@ class Interface(object):
               "custom figure of merit":11
               }
     
+    # result store class, see resultstore()
+    storetype = SQLiteStore
+
+    # SimCache of the simulation outputs (None for no cache), see
+    # restoreCached()
+    simcache = None
+
+    # attributes created by initsync(), which are not copied by pickle
+    transient = ("stores",)
+    
     def __init__(self,binpath = "" ,pltfm = Local()):
         '''Constructor.
         binpath : path to model binary files
@@ -85,6 +99,26 @@ class Interface(object):
         self.binpath = binpath
         self.pltfm = pltfm
         self.merit = self.merits.get("max gain")
+        # path of the results of each base path, see resultspath()
+        self.resultpaths = {}
+        self.initsync()
+
+    def initsync(self):
+        '''Create the state of the interface which is local to this process
+        (the open result stores), and is not copied by pickle or deepcopy.
+        '''
+        self.stores = {}
+
+    def __getstate__(self):
+        # connections to the result stores cannot be pickled
+        state = dict(self.__dict__)
+        for name in self.transient:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.initsync()
 
     def runStructures(self,structures,path,runprog=True):
         '''Run simulations for all structures in the given structure list with
@@ -105,19 +139,16 @@ class Interface(object):
     
     def waitforproc(self, delay, message = None):
         '''Blocks execution until all processes in self.processes are 
-        finished.
+        finished. Returns as soon as the last process finishes; if message
+        is given, it is printed every delay seconds while waiting.
         '''
         
-        pactive = True
-        while pactive:
+        self.pltfm.flush()
+        if message is not None:
+            print(message)
+        while not self.pltfm.waitall(self.processes, delay):
             if message is not None:
                 print(message)
-            pactive = False
-            for p in self.processes:
-                if self.pltfm.jobstatus(p):
-                    pactive=True
-                    #break
-            time.sleep(delay)
         # close all finished processes:
         for p in self.processes:
             p.wait()
@@ -128,87 +159,209 @@ class Interface(object):
         with base path "path". 
         '''
         pass
+
+    def resultstore(self, path, create = True):
+        '''Returns the store of the results in path (an instance of
+        self.storetype, by default SQLiteStore), which is opened on first
+        use. An existing path/results.log is imported when the store is
+        created. If create is False, returns None if there are no results
+        in path yet.
+        '''
+        path = os.path.abspath(str(path))
+        if path not in self.stores:
+            if not create and not self.storetype.exists(path):
+                return None
+            self.stores[path] = self.storetype(path)
+        return self.stores[path]
+
+    def resultspath(self, pathwd, pathresults = None):
+        '''Returns the path of the results of the structures with base path
+        pathwd: pathresults if it is given, which is remembered for pathwd,
+        otherwise the path remembered for pathwd, or else pathwd. Thus
+        gatherResults(structures, pathwd, pathresults) and
+        storedMerit(structure, pathwd) use the same store.
+        '''
+        key = os.path.abspath(str(pathwd))
+        if pathresults is not None:
+            self.resultpaths[key] = pathresults
+            return pathresults
+        return self.resultpaths.get(key, pathwd)
+
+    def storedMerit(self, structure, path):
+        '''Returns the merit of structure stored in the results of the base
+        path "path" (see resultspath()), or None if it has not been
+        evaluated yet.
+        '''
+        store = self.resultstore(self.resultspath(path), create = False)
+        if store is None:
+            return None
+        return store.getmerit(structure.sid)
+
+    def programs(self):
+        '''Returns the list of programs run for a structure, whose identity
+        is part of the key of its outputs in self.simcache.
+        '''
+        return []
+
+    def cachekey(self, structure):
+        '''Returns the key of the outputs of the simulation of structure in
+        self.simcache, which depends on the structure, self.numpar and
+        self.programs().
+        '''
+        return self.simcache.key(structure, self.numpar, self.programs())
+
+    def restoreCached(self, structure, spath, key = None):
+        '''If the simulation of structure is in self.simcache, restore its
+        outputs into spath, set structure.merit to the cached merit (if it
+        was computed with the same merit function), and return True.
+        Otherwise return False, and runStructures() runs the simulation.
+        The key (by default self.cachekey(structure)) is kept in
+        structure.cachekey for storeCached().
+        '''
+        structure.cached = False
+        if self.simcache is None:
+            return False
+        if key is None:
+            key = self.cachekey(structure)
+        structure.cachekey = key
+        info = self.simcache.restore(structure.cachekey, spath)
+        if info is None:
+            return False
+        structure.cached = True
+        if info.get("meritfunc") == self.merit:
+            structure.merit = info["merit"]
+        dbg.debug("Restored structure " + str(structure.sid) +
+                  " from cache\n", dbg.verb_modes["verbose"], self)
+        return True
+
+    def storeCached(self, structure, spath):
+        '''Store the outputs in spath of the simulation of structure, with its
+        merit, in self.simcache (unless it was restored from there, its
+        simulation was stopped early, or its merit is "ERROR").
+        '''
+        if self.simcache is None or getattr(structure, "cached", False) or \
+            getattr(structure, "censored", False):
+            return
+        key = getattr(structure, "cachekey", None)
+        if key is None:
+            key = self.cachekey(structure)
+        merit = getattr(structure, "merit", None)
+        if merit == "ERROR":
+            return # may be a failure of the platform, run again next time
+        try:
+            merit = float(merit)
+        except (TypeError, ValueError):
+            merit = str(merit)
+        self.simcache.store(key, spath, {"meritfunc": self.merit,
+                                         "merit": merit})
+
+    async def runStructureAsync(self, structure, path):
+        '''Coroutine which runs the simulation for a single structure with
+        base path "path", and returns when it has finished.
+
+        This default implementation calls runStructures() and waits for the
+        processes it added to self.processes. Interfaces with several
+        stages should override it, so that each stage is awaited through
+        the platform's asyncio layer (Platform.submitjob_async()).
+        '''
+        Nstart = len(self.processes)
+        self.runStructures([structure], path)
+        await self.pltfm.waitall_async(self.processes[Nstart:])
+
+    async def evaluate(self, structure, path, pathresults = None):
+        '''Coroutine which runs the simulation for structure, gathers the
+        results and returns the merit function, corresponding to calling
+        runStructures(), waitforproc(), gatherResults() and getMerit()
+        for a single structure. gatherResults() is run in the default
+        executor of the event loop, so that other evaluations can proceed
+        in the meantime.
+
+        Example:
+            merit = await model.evaluate(structure, path)
+        '''
+        await self.runStructureAsync(structure, path)
+
+        kwargs = {}
+        if pathresults is not None:
+            kwargs["pathresults"] = pathresults
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, functools.partial(
+            self.gatherResults, [structure], path, **kwargs))
+
+        return self.getMerit(structure, path)
+
+    async def evaluateStructures(self, structures, path, pathresults = None):
+        '''Coroutine which evaluates all structures concurrently with
+        evaluate(), and returns the list of merits in the same order.
+        To call from synchronous code, use
+
+            merits = asyncio.run(model.evaluateStructures(structures, path))
+        '''
+        return await asyncio.gather(*[self.evaluate(s, path, pathresults)
+                                      for s in structures])
     
     @classmethod
     def loadStructure(cls, resultpath, origs, sid):
         """
         Loads and returns the structure with id "sid" based on the "origs" Structure,
-        from the results file at "resultpath/results.log".
-        Returns None if no structure with the given id was found.
+        from the results stored in "resultpath" (see resultstore()), which are
+        only read. Returns None if no structure with the given id was found.
         """
         
+        if not cls.storetype.exists(resultpath):
+            return None
+        
         s = Structure(origs)
                       
         Nl = len(origs.layers)
         Ndop = len(origs.dopings)
         
-        found = False
+        store = cls.storetype(resultpath, readonly = True)
+        record = store.get(sid, Nl, Ndop)
+        store.close()
+        if record is None:
+            return None
         
-        with open(resultpath + "/results.log") as resfile:
-            try:
-                for line in resfile:
-                    line = line.split()
-                    if line[0] == str(sid):
-                        found=True
-                        break
-            except(IndexError):
-                pass
-            
-            if not found:
-                return None
-            
-            for il in range(Nl):
-                w = float( line[il+2] )
-                x = line[il+2+Ndop*3+Nl]
-                try:
-                      x = float(x)
-                      s.layers[il].material.updateAlloy(x)
-                except(ValueError):
-                    pass # x = 'None'
-                s.layers[il].width = w
-                
-            for idop in range(Ndop):
-                for i in range(3):
-                    s.dopings[idop][i] = float(line[Nl + 2 + idop*3 + i])
-                
+        cls.setrecord(s, record)
         return s
     
     @classmethod
     def loadAllStructures(cls, resultpath, origs):
 
-
-
         Nl = len(origs.layers)
         Ndop = len(origs.dopings)
         Structure.sid = 0
         structures = []
 
-        with open(resultpath + "/results.log") as resfile:
-            for line in resfile:
-                
-                line = line.split()
-
-                try:
-                    sid = int(line[0])
-                except(ValueError, IndexError):
-                    continue # comment or empty line, skip
-                s = Structure(origs)
-                for il in range(Nl):
-                    w = float( line[il+2] )
-                    x = line[il+2+Ndop*3+Nl]
-                    try:
-                          x = float(x)
-                          s.layers[il].material.updateAlloy(x)
-                    except(ValueError):
-                        pass # x = 'None'
-                    s.layers[il].width = w
-
-                for idop in range(Ndop):
-                    for i in range(3):
-                        s.dopings[idop][i] = float(line[Nl + 2 + idop*3 + i])
-
-                structures.append(s)
+        if not cls.storetype.exists(resultpath):
+            return structures
+        store = cls.storetype(resultpath, readonly = True)
+        for record in store.records(Nl, Ndop):
+            try:
+                int(record["sid"])
+            except(ValueError):
+                continue
+            s = Structure(origs)
+            cls.setrecord(s, record)
+            structures.append(s)
+        store.close()
 
         return structures
+
+    @classmethod
+    def setrecord(cls, s, record):
+        """Set the layer widths, alloy compositions and dopings of the
+        Structure s from the result record (see aftershoq.utils.resultstore).
+        """
+        for il in range(len(s.layers)):
+            x = record["x"][il]
+            if x is not None:
+                s.layers[il].material.updateAlloy(x)
+            s.layers[il].width = record["widths"][il]
+
+        # records of models which do not store the dopings have none
+        for idop in range(min(len(s.dopings), len(record["dopings"]))):
+            for i in range(3):
+                s.dopings[idop][i] = record["dopings"][idop][i]
                 
         
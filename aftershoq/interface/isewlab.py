@@ -7,6 +7,7 @@ Created on 12 Mar 2018
 from aftershoq.interface import Interface
 from aftershoq.utils import const
 import aftershoq.utils.systemutil as su
+import aftershoq.utils.resultstore as rs
 import time
 import numpy as np
 import aftershoq.utils.debug as dbg
@@ -275,6 +276,7 @@ class Isewlab(Interface):
             spath = path + "/" + str(ss.dirname)
             self.initdir(ss,spath)
             self.run_sewlab(ss, spath)
+        self.pltfm.flush()
                 
     def run_sewlab(self,structure,spath):
         
@@ -312,18 +314,16 @@ class Isewlab(Interface):
             s.rates = self.readRates(s, path)
             self.saveBands(s, path, wavescale, square)
             
+        pathresults = self.resultspath(path, pathresults)
+        store = self.resultstore(pathresults)
         with open(pathresults+'/results.log','a') as f:
             f.write('# Results for structures:\nID | Merit | N times layer width | N times Mat \n')
             for ss in structures:
-                f.write(str(ss.sid)+" ")
-                f.write(str(self.getMerit(ss, path))+" ")
-                for layer in ss.layers:
-                    f.write(str(layer.width)+" ")
-                for layer in ss.layers:
-                    f.write(str(layer.material.x)+" ")
-                              
-                
-                f.write("\n")
+                ss.merit = self.getMerit(ss, path)
+                # the Sewlab results.log has no dopings
+                record = dict(rs.structrecord(ss), dopings = [])
+                store.add([record])
+                f.write(rs.formatrecord(record))
             
     def saveBands(self, s, path, wavescale, square):
         '''Read wave functions and potential profile from saved files and
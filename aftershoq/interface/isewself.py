@@ -7,7 +7,7 @@ Created on 12 Mar 2018
 from aftershoq.interface import Interface
 from aftershoq.utils import const
 import aftershoq.utils.systemutil as su
-import time
+import aftershoq.utils.resultstore as rs
 import aftershoq.utils.debug as dbg
 import subprocess
 import numpy as np
@@ -157,9 +157,9 @@ class Isewself(Interface):
     def gatherResults(self, structures, path, pathresults = None, runprog=True):
         self.ebound = []
         self.dipoles = []
+        store = self.resultstore(path)
         with open(path+'/results.log','a') as f:
-            f.write('# Results for structures:\nID | merit | \
-            N times layer width | Ndop times (zi, zf, nvol) | N times x \n')
+            f.write(rs.header)
             for ss in structures:
                 
                 levels = self.readEbound(path + "/" + str(ss.dirname))
@@ -174,19 +174,9 @@ class Isewself(Interface):
                 self.dipoles.append( self.readDipoles(ss) )
                 ss.merit = self.getMerit(ss, path)
                 
-                f.write(str(ss.sid)+" ")
-                f.write(str(ss.merit) + " ")
-                
-                for layer in ss.layers:
-                    f.write(str(layer.width)+" ")
-                for doping in ss.dopings:
-                    for val in doping:
-                        f.write( str(val) +" ")
-                for layer in ss.layers:
-                    f.write(str(layer.material.x)+" ")
-                
-                              
-                f.write("\n")
+                record = rs.structrecord(ss)
+                store.add([record])
+                f.write(rs.formatrecord(record))
                 
                 if self.merit == self.merits['Chi2']:
                     with open(path+ ss.dirname+"/chi2.log", 'w') as chif:
@@ -468,18 +458,6 @@ class Isewself(Interface):
             print("Merit function " + str(self.merit) + " not implemented yet!")
             return "ERROR"
                 
-    def waitforproc(self,delay,message=None):
-        pactive = True
-        while pactive:
-            if message is not None:
-                print(message)
-            pactive = False
-            for p in self.processes:
-                if self.pltfm.jobstatus(p):
-                    pactive=True
-                    #break
-            time.sleep(delay)
-            
     def calcChi2(self, structure, E1, E2, gamma):
         
         E3 = E1-E2
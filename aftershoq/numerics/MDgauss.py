@@ -10,6 +10,7 @@ import numpy as np
 from matplotlib import pyplot as pl
 import GPyOpt
 import aftershoq.utils.debug as dbg
+from concurrent import futures
 
 class MDGaussopt(OptimizerND):
     '''
@@ -108,16 +109,24 @@ class MDGaussopt(OptimizerND):
 
             newx = self.nextstep()
             sgenerator.generateStructures(newx)
+            structs = sgenerator.structures[-len(newx):]
             if seq is not None:
-                t = model.runStructSeq(sgenerator.structures[-len(newx):], pathwd,seq)
-                for tt in t: tt.join()
+                seqfutures = model.runStructSeq(structs, pathwd,seq)
+                # gather the results of each structure as soon as it is done
+                for f in futures.as_completed(seqfutures):
+                    ss = structs[seqfutures.index(f)]
+                    if f.exception() is not None:
+                        dbg.debug("Sequence failed for sid=" + str(ss.sid) + ": " +
+                                  str(f.exception()) + "\n",
+                                  dbg.verb_modes["verbose"],self)
+                    model.gatherResults([ss], pathwd, pathresults = pathresults)
             else:
-                model.runStructures(sgenerator.structures[-len(newx):], pathwd)
+                model.runStructures(structs, pathwd)
                 model.waitforproc(60)
+                model.gatherResults(structs, pathwd, pathresults = pathresults)
             newy = []
             newx_success = []
             xi = 0
-            model.gatherResults(sgenerator.structures[-len(newx):], pathwd, pathresults = pathresults)
                 
             self.addEvaldPoints(model, sgenerator, pathwd, sgenerator.structures[-len(newx):])
                 
@@ -3,3 +3,4 @@ from aftershoq.numerics.paraopt import Paraopt
 from aftershoq.numerics.gaussopt import Gaussopt
 from aftershoq.numerics.GAopt import GAopt
 from aftershoq.numerics.MDgauss import MDGaussopt
+from aftershoq.numerics.evaluator import Evaluator
@@ -0,0 +1,75 @@
+'''
+Created on 18 Oct 2026
+
+@author: Martin Franckie
+
+Parallel evaluation of merit functions which run in the Python process
+itself, such as the test functions of NDtestfunc or surrogate models,
+instead of in external programs started through a Platform.
+'''
+
+from concurrent import futures
+import aftershoq.utils.debug as dbg
+import pickle
+import os
+
+
+class Evaluator(object):
+    '''
+    Evaluates a merit function for batches of parameter vectors in
+    parallel, on a pool of processes or threads. The pool is started on the
+    first call of map() and kept until close() (or the end of a with block).
+
+    Parameters:
+    merit: The merit function, merit(x) returns a float. To run in
+        processes it must be picklable, as are module level functions and
+        the methods of picklable objects (such as NDtestfunc.getMerit).
+        Merit functions which cannot be pickled are run in threads.
+    max_workers (optional): Number of processes or threads. Defaults to the
+        number of cores. With max_workers = 1 the merit function is
+        evaluated in the calling thread.
+    threads (optional): If True, use threads instead of processes. This is
+        faster for merit functions which release the GIL (such as numpy
+        or compiled code), as nothing needs to be pickled.
+    '''
+
+    def __init__(self, merit, max_workers = None, threads = False):
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        self.merit = merit
+        self.max_workers = max_workers
+        self.threads = threads
+        self.executor = None
+
+        if not threads and max_workers > 1:
+            try:
+                pickle.dumps(merit)
+            except Exception as e:
+                dbg.debug("WARNING: merit function cannot be pickled (" +
+                          str(e) + "), evaluating in threads.\n",
+                          dbg.verb_modes["verbose"], self)
+                self.threads = True
+
+    def map(self, xs):
+        '''Returns the list of merit(x) for all x in xs, in the same order.'''
+        xs = list(xs)
+        if self.max_workers <= 1 or len(xs) <= 1:
+            return [self.merit(x) for x in xs]
+        if self.executor is None:
+            if self.threads:
+                self.executor = futures.ThreadPoolExecutor(self.max_workers)
+            else:
+                self.executor = futures.ProcessPoolExecutor(self.max_workers)
+        chunksize = max(1, len(xs)//(4*self.max_workers))
+        return list(self.executor.map(self.merit, xs, chunksize=chunksize))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -9,7 +9,89 @@ from aftershoq.numerics import Optimizer1D
 import numpy as np
 from matplotlib import pyplot as pl
 import scipy.optimize as so
+import scipy.linalg as sl
 import aftershoq.utils.debug as dbg
+from aftershoq.numerics.evaluator import Evaluator
+from aftershoq.numerics.kernels import Kernel, points
+import time
+import os
+
+
+class FitTimeout(Exception):
+    '''Raised when the time budget of a hyperparameter fit is exceeded.'''
+    pass
+
+
+def negevidence(theta, x, y, kernel, wrt = None):
+    '''
+    Returns the negative log of the posterior probability of the training
+    data (x, y) of a GP with the Kernel kernel, and its gradient with respect
+    to the hyperparameters theta = [sigma, l_1, ..., l_n, sigma_noise]
+    (zero except for the indices in wrt, defaults to all).
+
+    Both are computed from one Cholesky factorization. The gradient uses the
+    identity
+
+    dlogp/dtheta_i = 1/2 sum( (alpha alpha^T - K^-1) * dK/dtheta_i ),
+
+    with alpha = K^-1 y, where * is the element-wise product. If K is not
+    positive definite, a small jitter is added to its diagonal, and if that
+    fails a large value is returned, so that minimizers step back.
+    '''
+    theta = np.asarray(theta, dtype=np.double)
+    if wrt is None:
+        wrt = range(len(theta))
+    K, dK = kernel.evaluate(x, x, theta[0], theta[1:-1], theta[-1], wrt)
+    N = np.shape(x)[0]
+
+    jitter = 0.
+    for i in range(7):
+        try:
+            L = np.linalg.cholesky(K + jitter*np.eye(N))
+            break
+        except np.linalg.LinAlgError:
+            jitter = 1e-10*np.max(np.abs(np.diag(K)))*10**i
+    else:
+        return 1e10, np.zeros(len(theta))
+
+    alpha = sl.cho_solve((L, True), y)
+    logp = -0.5*np.sum(y*alpha) - np.sum( np.log( np.diag(L) ) ) - \
+        N / 2. * np.log( 2*np.pi )
+
+    W = np.dot(alpha, alpha.T)
+    W -= sl.cho_solve((L, True), np.eye(N))
+    dlogpdtheta = np.zeros(len(theta))
+    for dd, dKdd in dK:
+        dlogpdtheta[dd] = 0.5*np.sum(W*dKdd)
+
+    return -logp, -dlogpdtheta
+
+
+def fitstart(job):
+    '''
+    Minimizes negevidence() with L-BFGS-B from one start, for job =
+    (theta0, x, y, kernel, wrt, bounds, maxiter, deadline). Returns (value,
+    theta) of the best theta found, stopping at the time deadline (as given
+    by time.time(), None for no limit).
+    '''
+    theta0, x, y, kernel, wrt, bounds, maxiter, deadline = job
+    best = [np.inf, np.array(theta0, dtype=np.double)]
+
+    def f(theta):
+        if deadline is not None and time.time() > deadline:
+            raise FitTimeout()
+        value, grad = negevidence(theta, x, y, kernel, wrt)
+        if value < best[0]:
+            best[0] = value; best[1] = np.array(theta)
+        return value, grad
+
+    try:
+        so.minimize(f, best[1], jac=True, method="L-BFGS-B", bounds=bounds,
+                    options={"maxiter": maxiter})
+    except FitTimeout:
+        pass
+    return best[0], best[1]
+
 
 class Gaussopt(Optimizer1D):
     '''
@@ -19,10 +101,15 @@ class Gaussopt(Optimizer1D):
     minimize_parameters().
     '''
 
+    # attributes which are not copied by pickle, see __getstate__()
+    transient = ("fitevaluator",)
+
     def __init__(self, tolerance, maxiter, procmax, x0 = [], y0 = [],
                  sigma = 4, l = 2, sigma_noise = 0., padding = 10.,
                  sigma_max = None, l_max = None , sigma_noise_max = None,
-                 utility = None):
+                 utility = None, family = "rbf", thetatol = 1e-3,
+                 nstarts = 4, fitbudget = None, fitprocs = None,
+                 fullcov = None, refitevery = 5, refitmargin = 1.):
         '''Constructor.
 
         Parameters
@@ -42,21 +129,69 @@ class Gaussopt(Optimizer1D):
         l_max: maximum value for l in optimization
         sigma_noise_max: maximum value for sigma_noise in optimization
         utility (optional): utility function f(mean, cov) with two arguments
-        (mean and covarianvce. If None, standard is used.
+        (mean and covarianvce, or variance if fullcov is False). If None,
+        standard is used.
+        family (optional): covariance function of the GP, "rbf" (squared
+        exponential, default), "matern12", "matern32" or "matern52" (see
+        aftershoq.numerics.kernels).
+        thetatol (optional): relative change of the hyperparameters, below
+        which the Cholesky factor of the covariance matrix is extended with
+        the new points instead of being recomputed (see cholesky()).
+        nstarts (optional): number of starts of the hyperparameter fit (see
+        fit()), default 4.
+        fitbudget (optional): time budget (s) of the hyperparameter fit.
+        Defaults to no limit.
+        fitprocs (optional): number of threads running the starts of the
+        fit. Defaults to the smaller of nstarts and the number of cores (1
+        runs them in the calling thread).
+        fullcov (optional): If True, the full covariance matrix of the GP at
+        the trial points is computed and passed to utility. Otherwise, only
+        the mean and the variances are computed, in chunks of trial points
+        with memory linear in their number, and utility gets the variances
+        instead of the covariance. Defaults to True if utility is given.
+        refitevery (optional): number of steps between the hyperparameter
+        fits of nextstep(), default 5. Between fits, theta is kept, so that
+        the Cholesky factor is extended with the new points.
+        refitmargin (optional): decrease of -log p (see negevidence()) by
+        which a fit must improve on the current theta to replace it,
+        default 1.
         '''
 
         self.K = [] # covariance matrix
         self.Kt = [] #
         self.Kpp = []
         self.KtT = []
-        self.L = []
+        self.L = [] # Cholesky factor of K for the points Lx and theta Ltheta
+        self.Lx = []
+        self.Ltheta = None
+        self.thetatol = thetatol
+        self.nstarts = nstarts
+        self.fitbudget = fitbudget
+        if fitprocs is None:
+            fitprocs = min(max(1, nstarts), os.cpu_count() or 1)
+        self.fitprocs = fitprocs
+        # Evaluator of the starts of fit(), kept between fits
+        self.fitevaluator = None
+        self.refitevery = refitevery
+        self.refitmargin = refitmargin
+        # number of calls of nextstep(), and the one of the last fit
+        self.nsteps = 0
+        self.lastfit = None
+        self.rng = np.random.default_rng()
         self.theta = [sigma, l, sigma_noise]
         self.thetamax = [sigma_max, l_max, sigma_noise_max]
-        self.theta0 = self.theta
+        # a copy, as nextstep() updates the guess of l
+        self.theta0 = list(self.theta)
         self.xmin = 0
         self.iter = 0
         self.padding = padding
         self.utility = utility
+        if fullcov is None:
+            fullcov = utility is not None
+        self.fullcov = fullcov
+        self.cov = None
+        self.var = []
+        self.covariance = Kernel(family)
 
         if len( x0 ) > 0:
             self.xmax = np.max(x0)
@@ -88,107 +223,263 @@ class Gaussopt(Optimizer1D):
         self.Nx = len( np.squeeze(self.xt) )
         self.xt = np.reshape( self.xt, (self.Nx, 1) )
 
-        self.Kpp = self.kernel(self.xt, self.xt, self.theta,measnoise = 0.)
+        if not self.fullcov:
+            self.Kpp = []
+            return
+        out = self.Kpp if np.shape(self.Kpp) == (self.Nx, self.Nx) else None
+        self.Kpp = self.kernel(self.xt, self.xt, self.theta,measnoise = 0.,
+                               out = out)
 
     def logPosterior(self, theta, *args):
         '''
         log of the posterior probability as a function of the hyper
-        parameters theta = [sigma, l, sigma_noise].
+        parameters theta = [sigma, l, sigma_noise]. Returns the negative
+        value, see evidence().
         '''
-        x, y = args
-        try:
-            k = self.kernel( x, x, theta)
-            L = np.linalg.cholesky(k)
-        except( np.linalg.LinAlgError ):
-            #print "WARNING: Linalg error, trying different theta..."
-            for d in range(len(theta)):
-                theta[d] = self.theta0[d]
-                #print theta
-        error = ""
-        trymax = 100
-        for i in range( trymax ):
-            try:
-                k = self.kernel( x, x, theta)
-                L = np.linalg.cholesky(k)
-                break
-            except np.linalg.LinAlgError as e:
-                error = str( e )
-                #print "WARNING: Linalg error, trying different theta..."
-                for d in range(len(theta)):
-                    theta[d] += 0.5
-                    #print theta
-                    #print self.maxloc
-        if i == trymax-1:
-            print("FATAL, could not resolve linalg error: " + error)
-            print("x = " + str( np.sort(x.transpose()) ))
-            return 0
-
-        beta = np.linalg.solve(np.transpose(L), np.linalg.solve(L,y))
-        logp = -0.5*np.dot( y.transpose(), beta ) - np.sum( np.log( np.diag(L) ) ) - np.shape(x)[0] / 2. * np.log( 2*np.pi )
-
-        return -logp[0]
+        return self.evidence(theta, *args)[0]
 
     def gradLogPosterior(self, theta, *args):
         '''
         gradient of the log of the posterior probability, with respect to the
-        paratmeres theta = [sigma, l, sigma_noise].
+        paratmeres theta = [sigma, l, sigma_noise]. Returns the negative
+        value, see evidence().
         '''
-        x, y = args
-        d = len(theta)
+        return self.evidence(theta, *args)[1]
 
+    def evidence(self, theta, *args):
+        '''
+        Returns the negative log of the posterior probability and its
+        gradient with respect to the hyperparameters theta = [sigma, l,
+        sigma_noise], for the training data args = (x, y), to be minimized
+        by the scipy minimizers with jac=True (see negevidence()).
+
+        The result is cached for the last theta, so that separate calls of
+        logPosterior() and gradLogPosterior() (as by fmin_cg) factorize
+        only once.
+        '''
+        x, y = args
+        theta = np.array(np.squeeze(theta), dtype=np.double)
+        cache = getattr(self, "evidencecache", None)
+        if cache is not None and cache[0] is x and cache[1] is y and \
+            np.array_equal(cache[2], theta):
+            return cache[3]
+
+        fulltheta = self.cliptheta(theta.copy())
+        value, grad = negevidence(fulltheta, x, y, self.covariance,
+                                  self.hyperparams(fulltheta))
+        result = (value, grad[:len(theta)])
+        self.evidencecache = (x, y, theta, result)
+        return result
+
+    def bounds(self, theta):
+        '''
+        Returns the list of (min, max) of the hyperparameters theta =
+        [sigma, l_1, ..., l_n, sigma_noise] in the fit. The maxima are given
+        by thetamax (None for no limit). The minima are 1e-3 times the
+        standard deviation of the training data for sigma, half of the
+        smallest distance between training points for l, and 1e-6 times
+        the standard deviation for sigma_noise. A sigma_noise of 0 is kept.
+        '''
+        theta = self.cliptheta(np.array(theta, dtype=np.double))
+        ystd = np.std(self.y)
+        if not ystd > 0:
+            ystd = 1.
+        xs = np.unique(self.x)
+        lmin = 0.5*np.min(np.diff(xs)) if len(xs) > 1 else 1e-3
+
+        minima = [1e-3*ystd] + [lmin]*(len(theta)-2) + [1e-6*ystd]
+        bounds = []
+        for tmin, tmax in zip(minima, self.thetamaxima(len(theta))):
+            if tmax is not None:
+                tmin = min(tmin, tmax)
+            bounds.append((tmin, tmax))
+        if theta[-1] == 0:
+            bounds[-1] = (0., 0.)
+        return bounds
+
+    def fit(self, x, y):
+        '''
+        Fits the hyperparameters to the training data (x, y), and returns
+        the theta with the highest posterior probability. Runs nstarts
+        bounded L-BFGS-B minimizations of negevidence() in parallel (see
+        fitprocs), within the time budget fitbudget. The starts run in
+        threads, as numpy and scipy release the GIL, on a pool which is
+        started by the first fit and kept until close(). The starts are the
+        theta of the previous fit (warm start), the initial guess theta0,
+        and random log-normal variations of the former within the bounds.
+        '''
+        warm = self.cliptheta(np.array(self.theta, dtype=np.double))
+        guess = self.cliptheta(np.array(self.theta0, dtype=np.double))
+        bounds = self.bounds(warm)
+        wrt = self.hyperparams(warm)
+        lower = [b[0] for b in bounds]
+        upper = [np.inf if b[1] is None else b[1] for b in bounds]
+
+        starts = [warm]
+        if len(guess) == len(warm) and not np.allclose(guess, warm):
+            starts.append(guess)
+        while len(starts) < self.nstarts:
+            starts.append(warm*np.exp(self.rng.normal(0., 1., len(warm))))
+        starts = [np.clip(t, lower, upper) for t in starts[:max(1,self.nstarts)]]
+
+        deadline = None
+        if self.fitbudget is not None:
+            deadline = time.time() + self.fitbudget
+        jobs = [(t, x, y, self.covariance, wrt, bounds, 100, deadline)
+                for t in starts]
+        if self.fitevaluator is None:
+            self.fitevaluator = Evaluator(fitstart, self.fitprocs,
+                                          threads = True)
+        results = self.fitevaluator.map(jobs)
+
+        values = [r[0] for r in results]
+        best = int(np.argmin(values))
+        dbg.debug("Hyperparameter fit: " + str(len(starts)) + " starts, " +
+                  "best " + str(results[best][1]) + " (start " + str(best) +
+                  "), -log p = " + str(values[best]) + "\n",
+                  dbg.verb_modes["verbose"], self)
+        return results[best][1]
+
+    def refit(self, x, y):
+        '''Fits the hyperparameters at the first call, and then every
+        refitevery calls (see fit()). The fitted theta replaces self.theta
+        only if it decreases -log p by more than refitmargin. Otherwise,
+        and between fits, theta is kept, so that the Cholesky factor of the
+        covariance matrix is extended instead of recomputed (see
+        cholesky()). Returns True if theta was changed.
+        '''
+        self.nsteps += 1
+        if self.lastfit is not None and \
+            self.nsteps - self.lastfit < self.refitevery:
+            return False
+        self.lastfit = self.nsteps
+
+        old = self.logPosterior(self.theta, x, y)
+        newtheta = self.fit(x, y)
+        new = self.logPosterior(newtheta, x, y)
+        print("old theta = ", self.theta, old)
+        print("new theta = ", newtheta, new)
+        if new < old - self.refitmargin:
+            self.theta = newtheta
+            return True
+        dbg.debug("Keeping theta " + str(self.theta) + ", the fit improves " +
+                  "-log p by " + str(old - new) + " only\n",
+                  dbg.verb_modes["verbose"], self)
+        return False
+
+    def close(self):
+        '''Stops the threads of the hyperparameter fit, see fit().'''
+        if self.fitevaluator is not None:
+            self.fitevaluator.close()
+            self.fitevaluator = None
+
+    def __getstate__(self):
+        # the threads of the fit are of no use to a copy
+        state = dict(self.__dict__)
+        for name in self.transient:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.fitevaluator = None
+
+    def cholesky(self):
+        '''Returns the lower Cholesky factor L of the covariance matrix of the
+        training points for the hyperparameters self.theta.
+
+        The factor is kept between calls. If theta changed by less than the
+        relative tolerance thetatol since L was computed, theta is reset to
+        the one of L (which is logged), and L is only extended with the
+        rows of the points added since, by a block update of cost O(n^2 k)
+        for k new points. Otherwise, L is recomputed, at a cost of O(n^3).
+        Since nextstep() only changes theta at a refit, L is mostly
+        extended.
+        '''
+        N = len(self.x)
+        NL = len(self.Lx)
+        theta = np.array(np.squeeze(self.theta), dtype=np.double)
+        if self.Ltheta is None or np.shape(theta) != np.shape(self.Ltheta) \
+            or np.any(np.abs(theta - self.Ltheta) >
+                      self.thetatol*np.abs(self.Ltheta)) \
+            or N < NL or not np.array_equal(self.x[:NL], self.Lx):
+            return self.refactorize()
+
+        if not np.array_equal(theta, self.Ltheta):
+            dbg.debug("Resetting theta " + str(theta) + " to " +
+                      str(self.Ltheta) + " of the Cholesky factor\n",
+                      dbg.verb_modes["chatty"], self)
+        self.theta = self.Ltheta.copy()
+        if N == NL:
+            return self.L
+
+        # [[L11, 0], [L21, L22]], with L21 = (L11^-1 K12)^T and
+        # L22 L22^T = K22 - L21 L21^T
+        xnew = self.x[NL:]
+        K12 = self.kernel(self.Lx, xnew, self.theta, measnoise = 0.)
+        K22 = self.kernel(xnew, xnew, self.theta)
         try:
-            K = self.kernel(x,x,theta,wantderiv=True)
-            L = np.linalg.cholesky(np.squeeze(K[:,:,0]))
-        except( np.linalg.LinAlgError ):
-            #print "WARNING: Linalg error, trying different theta..."
-            for dd in range(len(theta)):
-                theta[dd] = self.theta0[dd]*0.1
-                #print theta
-        error = ""
-        trymax = 100
-        for i in range(trymax):
-            try:
-                K = self.kernel(x,x,theta,wantderiv=True)
-                L = np.linalg.cholesky(np.squeeze(K[:,:,0]))
-                break
-            except np.linalg.LinAlgError as e :
-                error = str( e )
-                #print "WARNING: Linalg error, trying different theta..." + str( e )
-                for dd in range(len(theta)):
-                    theta[dd] += 0.1*self.theta0[dd]
-                    #print theta
-                    #print self.maxloc
-        if i == trymax-1:
-            print("FATAL, could not resolve linalg error: " + error)
-            print("x = " + str( np.sort(x.transpose()) ))
-            return np.zeros(d)
-
-
-        invk = np.linalg.solve(L.transpose(),np.linalg.solve(L,np.eye(np.shape(x)[0])))
-
-        dlogpdtheta = np.zeros(d)
-        for dd in range(1,len(theta)+1):
-
-            dlogpdtheta[dd-1] = 0.5*np.dot(y.transpose(), np.dot(invk, np.dot(np.squeeze(K[:,:,dd]), np.dot(invk,y)))) - 0.5*np.trace(np.dot(invk,np.squeeze(K[:,:,dd])))
-
+            L21 = sl.solve_triangular(self.L, K12, lower=True).T
+            L22 = np.linalg.cholesky(K22 - np.dot(L21, L21.T))
+        except (np.linalg.LinAlgError, ValueError) as e:
+            dbg.debug("Cholesky update failed (" + str(e) + "), recomputing\n",
+                      dbg.verb_modes["verbose"], self)
+            return self.refactorize()
+
+        L = np.zeros((N, N), dtype=np.double)
+        L[:NL,:NL] = self.L
+        L[NL:,:NL] = L21
+        L[NL:,NL:] = L22
+        self.L = L
+        self.Lx = np.array(self.x, dtype=np.double)
+        return self.L
+
+    def refactorize(self):
+        '''Computes the Cholesky factor of the covariance matrix of the
+        training points from scratch, see cholesky().
+        '''
+        self.L = np.linalg.cholesky(self.kernel(self.x, self.x, self.theta))
+        self.Lx = np.array(self.x, dtype=np.double)
+        self.Ltheta = np.array(np.squeeze(self.theta), dtype=np.double)
+        return self.L
 
-        #print dlogpdtheta
-        return -dlogpdtheta
+    # maximum size of the blocks of the covariance between training and
+    # trial points in evalmeancov()
+    chunkelements = 2**22
 
     def evalmeancov(self):
-        '''Evaluates the mean and covariance of the GP.'''
-
-        self.updateTrials()
-        K = self.kernel(self.x, self.x, self.theta)
+        '''Evaluates the mean and variance (self.var) of the GP at the trial
+        points, and the covariance (self.cov) if fullcov. Without fullcov,
+        the trial points are evaluated in chunks, so that no matrix larger
+        than chunkelements or the number of trial points is formed.
+        '''
 
         try:
-            L = np.linalg.cholesky(K)
-            beta = np.linalg.solve(np.transpose(L), np.linalg.solve(L,self.y))
-            #invk = np.linalg.solve(L.transpose(),np.linalg.solve(L,np.eye(np.shape(self.x)[0], dtype=np.double)))
-
-        except np.linalg.linalg.LinAlgError as e:
+            L = self.cholesky()
+        except np.linalg.LinAlgError as e:
             print("linalg error: " + str( e ))
             return -1
+        beta = sl.cho_solve((L, True), self.y)
+
+        self.updateTrials()
+
+        if not self.fullcov:
+            self.cov = None
+            self.mean = np.zeros((self.Nx, 1))
+            self.var = np.zeros(self.Nx)
+            # prior variance of a stationary kernel
+            prior = self.cliptheta(np.array(self.theta, dtype=np.double))[0]**2
+            chunk = max(1, self.chunkelements//len(self.x))
+            for i in range(0, self.Nx, chunk):
+                Kt = self.kernel(self.x, self.xt[i:i+chunk], self.theta,
+                                 measnoise = 0.)
+                self.mean[i:i+chunk] = np.dot(Kt.T, beta)
+                v = sl.solve_triangular(L, Kt, lower=True, overwrite_b=True)
+                self.var[i:i+chunk] = prior - np.einsum('ij,ij->j', v, v)
+            self.u = self.util( np.squeeze( self.mean ), self.var )
+            self.umax = np.max(self.u)
+            self.maxloc = self.xt[np.argmax(self.u)]
+            return
 
         Kt = self.kernel(self.x, self.xt, self.theta, measnoise = 0.)
 
@@ -199,11 +490,12 @@ class Gaussopt(Optimizer1D):
         self.mean = np.dot(KtT,beta)
         #self.mean = np.dot(KtT,np.dot(invk,self.y))
 
-        v = np.linalg.solve(L, Kt)
+        v = sl.solve_triangular(L, Kt, lower=True)
         self.cov = Kpp - np.dot(np.transpose(v),v)
         #self.cov = Kpp - np.diag( np.dot( KtT, np.dot( invk, Kt ) ) )
+        self.var = np.diag(self.cov)
 
-        self.u = self.util( np.squeeze( self.mean ), self.cov )
+        self.u = self.util( np.squeeze( self.mean ), self.var, self.cov )
 
         self.umax = np.max(self.u)
         maxloc = np.argmax(self.u)
@@ -234,19 +526,13 @@ class Gaussopt(Optimizer1D):
 
         #print "xmin, xmax, xav = ",xmin,xmax,xav
 
-        print("old theta = ", self.theta0, self.logPosterior(self.theta0,*args))
-        newtheta = so.fmin_cg(self.logPosterior, self.theta0,
-                            fprime=self.gradLogPosterior, args=args,
-                            gtol=1e-4, maxiter=100, disp=1)
-        print("new theta = ", newtheta, self.logPosterior(newtheta,*args))
-
-        self.theta = newtheta
+        self.refit(*args)
 
         # build the covariance matrix:
 
         self.evalmeancov()
 
-        self.u = self.util(np.squeeze( self.mean ), self.cov)
+        self.u = self.util(np.squeeze( self.mean ), self.var, self.cov)
 
         self.umax = []
         maxloc = []
@@ -338,7 +624,17 @@ class Gaussopt(Optimizer1D):
         dbg.flush()
         return self.converged
 
-    def minimize_parameters(self, model, hutil, plot = False):
+    def minimize_parameters(self, model, hutil, plot = False, evaluator = None):
+        '''Minimize the merit function model.getMerit(params) of a model
+        which is evaluated in Python (such as NDtestfunc), for parameters
+        along the Hilbert curve hutil. The procmax points of each iteration
+        are evaluated in parallel by evaluator (see Evaluator), which
+        defaults to procmax processes.
+        '''
+
+        if evaluator is None:
+            with Evaluator(model.getMerit, self.pmax) as evaluator:
+                return self.minimize_parameters(model, hutil, plot, evaluator)
 
         self.iter = 0
         while self.converged == 0:
@@ -358,14 +654,11 @@ class Gaussopt(Optimizer1D):
                     print("Update failed! Stopping.")
                     self.converged = -1
                     break
-            for xx in newx:
-                if xx > hutil.imax-2:
-                    xx = hutil.imax - 2
-                elif xx < 2:
-                    xx = 2
-            newy = []
-            for xx in newx:
-                newy.append( -float(model.getMerit(hutil.interp_coords_from_dist(xx)/float(2**hutil.p))) )
+            # distances along the curve, kept inside its ends
+            newx = [min(max(float(np.squeeze(xx)), 2.), hutil.imax - 2.)
+                    for xx in newx]
+            params = [hutil.interp_coords_from_dist(xx)/float(2**hutil.p) for xx in newx]
+            newy = [-float(y) for y in evaluator.map(params)]
 
             xstr = ''
             for xx in self.x:
@@ -379,7 +672,7 @@ class Gaussopt(Optimizer1D):
 
             self.addpoints(newx,newy)
             if(plot):
-                self.plotGP(model, hutil)
+                self.plotGP_testfunc(model, hutil)
 
 
 
@@ -395,10 +688,10 @@ class Gaussopt(Optimizer1D):
         '''
         maxloc = self.maxloc; umax = self.umax
         xt = self.xt; mean = np.squeeze( self.mean )
-        cov = self.cov; u = self.u;
+        u = self.u;
         x = self.x; y = self.y;
 
-        var = np.reshape( np.abs( np.diag( self.cov ) ), (self.Nx,1) )
+        var = np.reshape( np.abs( self.var ), (self.Nx,1) )
 
         pl.figure(5)
         pl.clf()
@@ -428,11 +721,11 @@ class Gaussopt(Optimizer1D):
 
         model: A tets function giving a fast merit function evaluation'''
 
-        xt = self.xt; mean = np.squeeze( self.mean ); cov = self.cov; u = self.u;
+        xt = self.xt; mean = np.squeeze( self.mean ); u = self.u;
         maxloc = self.maxloc; umax = self.umax
         x = self.x; y = self.y;
 
-        var = np.reshape( np.abs( np.diag( self.cov ) ), (self.Nx,1) )
+        var = np.reshape( np.abs( self.var ), (self.Nx,1) )
 
         yt = []
         [yt.append(-model.getMerit((hutil.interp_coords_from_dist(xx)/float(2**hutil.p)))) for xx in xt]
@@ -460,105 +753,121 @@ class Gaussopt(Optimizer1D):
         index = np.argmin(self.y)
         return [self.x[index], self.y[index] ]
 
-    def util(self, mean, cov):
+    def util(self, mean, var, cov = None):
         '''
         Utility function, estimating the most likely points along
-        the x-axis to contain the new minimum.
+        the x-axis to contain the new minimum, from the mean and variance
+        var of the GP (and the covariance cov if fullcov).
         '''
 
         if self.utility is None:
-            return (-mean + np.sqrt( np.abs( np.diag(cov) ) ) )
-        else:
+            return (-mean + np.sqrt( np.abs( var ) ) )
+        elif self.fullcov:
             return self.utility(mean, cov)
+        else:
+            return self.utility(mean, var)
 
-    def constraint(self, theta0):
-        '''Contains the inequality constraints for the hyperparameter
-        minimization. If None is specified, no constraint is applied.
+    def thetamaxima(self, ntheta):
+        '''Returns the maxima of the ntheta hyperparameters [sigma, l_1, ...,
+        l_n, sigma_noise], from thetamax = [sigma_max, l_max (for all length
+        scales), sigma_noise_max].
         '''
-        return self.thetamax - theta
-
-    def kernel(self,data1,data2,theta,wantderiv=False,measnoise=1.):
-        '''Author: Stephen Marsland, 2014. Modified by Martin Franckie 2018'''
-
-
+        if ntheta > 2:
+            return self.thetamax[:1] + self.thetamax[1:2]*(ntheta-2) + \
+                self.thetamax[2:]
+        return self.thetamax[:2]
+
+    def hyperparams(self, theta):
+        '''Returns the indices of the hyperparameters in theta which are
+        optimized: all except sigma_noise if it is 0 (or not given).
+        '''
+        theta = np.atleast_1d(np.squeeze(theta))
+        if len(theta) == 2 or theta[-1] == 0:
+            return list(range(max(len(theta) - 1, 2)))
+        return list(range(len(theta)))
+
+    def cliptheta(self, theta):
+        '''Returns theta as [sigma, l_1, ..., l_n, sigma_noise], limited
+        to the maxima in thetamax.'''
         theta = np.squeeze(theta)
+        thetamax = self.thetamaxima(len(theta))
         for i in range(len(theta)):
-            if self.thetamax[i] is not None and \
-                theta[i] > self.thetamax[i]:
-                theta[i] = self.thetamax[i]
+            if thetamax[i] is not None and theta[i] > thetamax[i]:
+                theta[i] = thetamax[i]
 
         if (len(theta) == 2):
             theta = np.append(theta, 0.)
-
-
-        # Gaussian
-        if np.shape(data1)[0] == len(data1):
-            d1 = np.shape(data1)[0]
-            n = 1
-        else:
-            (d1,n) = np.shape(data1)
-        d2 = np.shape(data2)[0]
-        sumxy = np.zeros((d1,d2), dtype=np.double)
-        for d in range(n):
-            D1 = np.transpose( [data1[:,d]]) * np.ones((d1,d2), dtype=np.double )
-            D2 = [data2[:,d]] * np.ones((d1,d2), dtype = np.double)
-            try:
-                sumxy += (D1-D2)
-            except(TypeError):
-                print("TypeError")
-                print("D1 =",D1)
-                print("D2 =",D2)
-                exit
-
-        k = theta[0]**2. * np.exp(-sumxy**2./(2.0*theta[1]**2.))
-
-        if wantderiv:
-            K = np.zeros((d1,d2,len(theta)+1), dtype=np.double)
-            K[:,:,0] = k + measnoise*theta[2]**2.*np.eye(d1,d2, dtype=np.double)
-            K[:,:,1] = 2.0 *k /theta[0]
-            K[:,:,2] = k*sumxy**2./theta[1]**3.
-            K[:,:,3] = 2.0*measnoise*theta[2]*np.eye(d1,d2, dtype=np.double)
-            return K
-        else:
-            return k + measnoise*theta[2]**2.*np.eye(d1,d2, dtype = np.double)
+        return theta
+
+    def kernel(self,data1,data2,theta,wantderiv=False,measnoise=1.,out=None):
+        '''Returns the covariance matrix of the points data1 and data2, for
+        the hyperparameters theta = [sigma, l, sigma_noise] (or [sigma, l_1,
+        ..., l_n, sigma_noise], with a length scale per dimension), with the
+        noise variance scaled by measnoise.
+
+        If wantderiv, returns K of shape (N1, N2, len(theta)+1) with the
+        covariance matrix in K[:,:,0] and its derivative with respect to
+        theta[i] in K[:,:,i+1], for the optimized hyperparameters (see
+        hyperparams(), the others are 0). Otherwise, the covariance matrix is
+        written to out if given.
+
+        Author: Stephen Marsland, 2014. Modified by Martin Franckie 2018'''
+
+        theta = self.cliptheta(theta)
+        if not wantderiv:
+            noise = np.sqrt(measnoise)*theta[-1]
+            return self.covariance(data1, data2, theta[0], theta[1:-1], noise,
+                                   out = out)
+
+        k, dk = self.kernelderivs(data1, data2, theta, measnoise)
+        K = np.zeros(np.shape(k) + (len(theta)+1,), dtype=np.double)
+        K[:,:,0] = k
+        for i, dki in dk:
+            K[:,:,i+1] = dki
+        return K
+
+    def kernelderivs(self, data1, data2, theta, measnoise=1.):
+        '''Returns (K, dK): the covariance matrix (see kernel()) and a
+        generator of (i, dK/dtheta_i) for the optimized hyperparameters
+        theta_i (see hyperparams()), computed one at a time.'''
+        theta = self.cliptheta(theta)
+        noise = np.sqrt(measnoise)*theta[-1]
+        k, dk = self.covariance.evaluate(data1, data2, theta[0], theta[1:-1],
+                                         noise, self.hyperparams(theta))
+        return k, self.chainnoise(dk, len(theta)-1, np.sqrt(measnoise))
+
+    def chainnoise(self, dk, inoise, scale):
+        '''Chain rule for noise = sqrt(measnoise)*sigma_noise.'''
+        for i, dki in dk:
+            yield i, (dki*scale if i == inoise else dki)
 
     def kernel2(self,data1,data2,theta,wantderiv=False,measnoise=0):
         '''
+        Squared exponential kernel with the hyperparameters theta =
+        [log(sigma**2), log(l_1**-2), ..., log(l_n**-2)], which ensures
+        positive hyperparameters. If wantderiv, K[:,:,0] is the covariance
+        matrix and K[:,:,i+1] its derivative with respect to theta[i].
+
         Author: Stephen Marsland, 2014
         '''
-        # Uses exp(theta) to ensure positive hyperparams
-        theta = np.squeeze(theta)
-        theta = np.exp(theta)
-        # Squared exponential
-        if np.ndim(data1) == 1:
-            d1 = np.shape(data1)[0]
-            n = 1
-            data1 = data1*np.ones((d1,1))
-            data2 = data2*np.ones((np.shape(data2)[0],1))
-        else:
-            (d1,n) = np.shape(data1)
-
-        d2 = np.shape(data2)[0]
-        sumxy = np.zeros((d1,d2))
-        for d in range(n):
-            D1 = np.transpose([data1[:,d]]) * np.ones((d1,d2))
-            D2 = [data2[:,d]] * np.ones((d1,d2))
-            sumxy += (D1-D2)**2*theta[d+1]
-
-        k = theta[0] * np.exp(-0.5*sumxy)
-        #k = theta[0]**2 * np.exp(-sumxy/(2.0*theta[1]**2))
-
-        #print k
-        #print measnoise*theta[2]**2*np.eye(d1,d2)
-        if wantderiv:
-            K = np.zeros((d1,d2,len(theta)+1))
-            K[:,:,0] = k
-            K[:,:,1] = k
-            K[:,:,2] = -0.5*k*sumxy
-            #K[:,:,3] = theta[2]*np.eye(d1,d2)
-            return K
-        else:
-            return k
+        theta = np.exp(np.atleast_1d(np.squeeze(theta)))
+        data1 = points(data1); data2 = points(data2)
+        n = np.shape(data1)[1]
+        sigma = np.sqrt(theta[0])
+        ls = theta[1:n+1]**-0.5
+
+        rbf = Kernel("rbf")
+        if not wantderiv:
+            return rbf(data1, data2, sigma, ls)
+
+        K = np.zeros((np.shape(data1)[0],np.shape(data2)[0],len(theta)+1))
+        k, dk = rbf.evaluate(data1, data2, sigma, ls, wrt = range(1, n+1))
+        K[:,:,0] = k
+        K[:,:,1] = k
+        for i, dki in dk:
+            # dl/dtheta = -l/2
+            K[:,:,i+1] = -0.5*ls[i-1]*dki
+        return K
 
     def testopt(self):
         #theta = np.array([0.05,2]) # GP4
@@ -652,7 +961,7 @@ class Gaussopt(Optimizer1D):
                 np.squeeze( self.y[i] )) +"\n") for i in range(0,len(self.x))]
 
     def writeGP(self, pathresults, filename):
-        std = np.sqrt( np.abs( np.diag( self.cov ) ) )
+        std = np.sqrt( np.abs( self.var ) )
         with open(pathresults + "/" + filename, 'w') as f:
             f.write('# Iteration = ' + str( self.iter ) +"\n")
             f.write('# theta = (' + str( self.theta) + "\n" )
@@ -0,0 +1,193 @@
+'''
+Created on 18 Oct 2026
+
+@author: Martin Franckie
+
+Stationary covariance functions (kernels) for Gaussian processes, on points
+in N dimensions with a length scale per dimension (automatic relevance
+determination, ARD):
+
+k(x1, x2) = sigma**2 * c(r2) + noise**2 * delta(x1, x2),
+r2 = sum_d ( (x1_d - x2_d)/l_d )**2
+
+The squared distances of all pairs of points are computed in a single
+broadcast (one dimension) or matrix product (several dimensions), and the
+derivatives with respect to the hyperparameters [sigma, l_1, ..., l_n, noise]
+are only computed when requested.
+'''
+
+import numpy as np
+
+
+def points(x):
+    '''Returns x as an array of shape (number of points, dimensions).'''
+    x = np.asarray(x, dtype = np.double)
+    if x.ndim < 2:
+        return np.reshape(x, (-1, 1))
+    return x
+
+
+def sqdist(x1, x2, lengthscales = 1., out = None):
+    '''Returns the matrix of squared distances between the points x1 and x2,
+    each dimension d scaled by lengthscales[d] (or a common scalar length
+    scale).
+
+    Parameters:
+    x1, x2: arrays of points, of shape (N1, n) and (N2, n), or (N1,) and (N2,)
+        in one dimension.
+    lengthscales (optional): scalar or list of n length scales.
+    out (optional): preallocated (N1, N2) array for the result.
+    '''
+    same = x1 is x2
+    x1 = points(x1); x2 = points(x2)
+    ls = np.broadcast_to(np.asarray(lengthscales, dtype = np.double),
+                         (x1.shape[1],))
+
+    if x1.shape[1] == 1:
+        out = np.subtract.outer(x1[:,0]/ls[0], x2[:,0]/ls[0], out = out)
+        return np.square(out, out = out)
+
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, centered to reduce cancellation
+    center = np.mean(x1, axis = 0)
+    a = (x1 - center)/ls
+    b = (x2 - center)/ls
+    out = np.dot(a, b.T, out = out)
+    out *= -2.
+    out += np.einsum('ij,ij->i', a, a)[:,np.newaxis]
+    out += np.einsum('ij,ij->i', b, b)[np.newaxis,:]
+    np.maximum(out, 0., out = out)
+    if same:
+        np.fill_diagonal(out, 0.)
+    return out
+
+
+def rbf(r2, out = None):
+    '''Squared exponential correlation exp(-r2/2).'''
+    out = np.multiply(r2, -0.5, out = out)
+    return np.exp(out, out = out)
+
+def drbf(r2, c):
+    '''Derivative of rbf() with respect to r2, given c = rbf(r2).'''
+    return -0.5*c
+
+def matern12(r2, out = None):
+    '''Matern correlation with nu = 1/2, exp(-r).'''
+    out = np.sqrt(r2, out = out)
+    out *= -1.
+    return np.exp(out, out = out)
+
+def dmatern12(r2, c):
+    '''Derivative of matern12() with respect to r2.'''
+    r = np.sqrt(r2)
+    return -0.5*np.divide(c, r, out = np.zeros_like(c), where = r > 0)
+
+def matern32(r2, out = None):
+    '''Matern correlation with nu = 3/2, (1 + sqrt(3) r) exp(-sqrt(3) r).'''
+    r = np.sqrt(3.*r2)
+    out = np.exp(-r, out = out)
+    out *= 1. + r
+    return out
+
+def dmatern32(r2, c):
+    '''Derivative of matern32() with respect to r2.'''
+    return -1.5*np.exp(-np.sqrt(3.*r2))
+
+def matern52(r2, out = None):
+    '''Matern correlation with nu = 5/2,
+    (1 + sqrt(5) r + 5 r2/3) exp(-sqrt(5) r).'''
+    r = np.sqrt(5.*r2)
+    out = np.exp(-r, out = out) # out may be r2
+    out *= 1. + r + r**2/3.
+    return out
+
+def dmatern52(r2, c):
+    '''Derivative of matern52() with respect to r2.'''
+    r = np.sqrt(5.*r2)
+    return -5./6.*(1. + r)*np.exp(-r)
+
+
+class Kernel(object):
+    '''
+    Stationary kernel of a family of correlation functions, with the
+    hyperparameters theta = [sigma, l_1, ..., l_n, noise] (a single l is a
+    common length scale for all dimensions).
+
+    Parameters:
+    family (optional): "rbf" (squared exponential, default), "matern12",
+        "matern32" or "matern52".
+    '''
+
+    families = {"rbf": (rbf, drbf),
+                "matern12": (matern12, dmatern12),
+                "matern32": (matern32, dmatern32),
+                "matern52": (matern52, dmatern52)}
+
+    def __init__(self, family = "rbf"):
+        if family not in self.families:
+            raise ValueError("Unknown kernel family: " + str(family))
+        self.family = family
+        self.corr, self.dcorr = self.families[family]
+
+    def __call__(self, x1, x2, sigma, lengthscales, noise = 0., out = None):
+        '''Returns the covariance matrix of the points x1 and x2, see
+        evaluate().'''
+        return self.evaluate(x1, x2, sigma, lengthscales, noise, out = out)[0]
+
+    def evaluate(self, x1, x2, sigma, lengthscales, noise = 0., wrt = (),
+                 out = None):
+        '''Returns (K, dK), where K is the covariance matrix of the points
+        x1 and x2 (see sqdist()), and dK a generator of (i, dK/dtheta_i)
+        for the indices i of the hyperparameters theta = [sigma, l_1, ...,
+        l_n, noise] in wrt. The derivatives are computed one at a time while
+        iterating over dK.
+
+        Parameters:
+        sigma: standard deviation.
+        lengthscales: scalar or list of length scales.
+        noise (optional): standard deviation of the noise, added to the
+            diagonal.
+        wrt (optional): indices of the hyperparameters of the derivatives.
+            Defaults to none.
+        out (optional): preallocated (N1, N2) array for K.
+        '''
+        N1 = np.shape(x1)[0]; N2 = np.shape(x2)[0]
+        if len(wrt) == 0:
+            # correlation computed in place of the distances
+            K = self.corr(sqdist(x1, x2, lengthscales, out = out), out = out)
+            r2 = c = None
+        else:
+            r2 = sqdist(x1, x2, lengthscales)
+            c = self.corr(r2)
+            if out is None:
+                K = c.copy()
+            else:
+                np.copyto(out, c)
+                K = out
+        K *= sigma**2
+        if noise != 0.:
+            diag = np.arange(min(N1, N2))
+            K[diag,diag] += noise**2
+
+        return K, self.derivatives(x1, x2, sigma, lengthscales, noise, wrt,
+                                   r2, c)
+
+    def derivatives(self, x1, x2, sigma, lengthscales, noise, wrt, r2, c):
+        '''Generator of (i, dK/dtheta_i) for i in wrt, see evaluate().'''
+        ls = np.atleast_1d(np.asarray(lengthscales, dtype = np.double))
+        x1 = points(x1); x2 = points(x2)
+        dcdr2 = None
+        for i in wrt:
+            if i == 0:
+                yield i, 2.*sigma*c
+            elif i <= len(ls):
+                if dcdr2 is None:
+                    dcdr2 = sigma**2*self.dcorr(r2, c)
+                l = ls[i-1]
+                if len(ls) == 1:
+                    r2d = r2
+                else:
+                    r2d = sqdist(x1[:,i-1], x2[:,i-1], l)
+                # dr2/dl = -2 r2_l/l
+                yield i, -2.*dcdr2*r2d/l
+            else:
+                yield i, 2.*noise*np.eye(len(x1), len(x2))
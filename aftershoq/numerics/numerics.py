@@ -3,7 +3,6 @@ Created on 30 Jan 2018
 
 @author: martin
 '''
-import time
 
 class Numerics():
     '''
@@ -27,13 +26,6 @@ class Numerics():
         [self.processes.append(i) for i in proc]
         
     def waitforproc(self,delay):
-        pactive = True
-        while pactive:
+        while not self.model.pltfm.waitall(self.processes, delay):
             print("Processes running...")
-            pactive = False
-            for p in self.processes:
-                if self.model.pltfm.jobstatus(p):
-                    pactive=True
-                    #break
-            time.sleep(delay)
         print("All processes terminated!")
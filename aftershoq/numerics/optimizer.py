@@ -119,7 +119,13 @@ class Optimizer1D(object):
         '''
         pass
 
-    def minimize_parameters(self, model, hutil):
+    def minimize_parameters(self, model, hutil, evaluator = None):
+        '''
+        Minimizes the merit function model.getMerit(params) of a model which
+        is evaluated in Python, for parameters along the Hilbert curve of
+        the HilbertUtil hutil. evaluator (optional) is an Evaluator for
+        evaluating the points of each iteration in parallel.
+        '''
         pass
 
     def getbest(self):
@@ -7,6 +7,8 @@ Created on 13 Mar 2018
 import numpy as np
 from aftershoq.numerics.optimizer import Optimizer1D
 import aftershoq.utils.debug as dbg
+from concurrent import futures
+from aftershoq.numerics.evaluator import Evaluator
 
 class Paraopt(Optimizer1D):
     '''
@@ -124,15 +126,23 @@ class Paraopt(Optimizer1D):
             
             newx = self.nextstep()
             sgenerator.gen_struct_from_hilbert_curve(newx)
+            structs = sgenerator.structures[-len(newx):]
             if seq is not None:
-                t = model.runStructSeq(sgenerator.structures[-len(newx):], pathwd,seq)
-                for tt in t: tt.join()
+                seqfutures = model.runStructSeq(structs, pathwd,seq)
+                # gather the results of each structure as soon as it is done
+                for f in futures.as_completed(seqfutures):
+                    ss = structs[seqfutures.index(f)]
+                    if f.exception() is not None:
+                        dbg.debug("Sequence failed for sid=" + str(ss.sid) + ": " +
+                                  str(f.exception()) + "\n",
+                                  dbg.verb_modes["verbose"],self)
+                    model.gatherResults([ss], pathwd, pathresults = pathresults)
             else:
-                model.runStructures(sgenerator.structures[-len(newx):], pathwd)
+                model.runStructures(structs, pathwd)
                 model.waitforproc(0.1)
+                model.gatherResults(structs, pathwd, pathresults = pathresults)
             newy = []
             xi = 0
-            model.gatherResults(sgenerator.structures[-len(newx):], pathwd, pathresults = pathresults)
             for ss in sgenerator.structures[-len(newx):]:
                 try:
                     val = -float(model.getMerit(ss,pathwd))
@@ -150,16 +160,24 @@ class Paraopt(Optimizer1D):
         dbg.flush()
         return self.converged
     
-    def minimize_parameters(self, model, hutil):
+    def minimize_parameters(self, model, hutil, evaluator = None):
+        '''Minimize model.getMerit(params) for parameters along the Hilbert
+        curve hutil, evaluating the procmax points of each iteration in
+        parallel with evaluator (see Evaluator). Defaults to procmax
+        processes.
+        '''
+        
+        if evaluator is None:
+            with Evaluator(model.getMerit, self.pmax) as evaluator:
+                return self.minimize_parameters(model, hutil, evaluator)
         
         niter = 0
         while self.converged == 0:
             niter += 1
             
             newx = self.nextstep()
-            newy = []
-            for xx in newx:
-                newy.append( -float(model.getMerit(hutil.interp_coords_from_dist(xx)/float(2**hutil.p))) )
+            params = [hutil.interp_coords_from_dist(xx)/float(2**hutil.p) for xx in newx]
+            newy = [-float(y) for y in evaluator.map(params)]
         
             self.addpoints(newx,newy)
         
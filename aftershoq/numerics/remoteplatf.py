@@ -0,0 +1,479 @@
+'''
+Created on 18 Oct 2026
+
+@author: Martin Franckie
+
+Run platform for spreading jobs over several computers. A worker daemon runs
+on each computer, and a RemotePool submits jobs to the workers over TCP or
+Unix sockets. All computers must share the file system in which the
+simulations are run, since only the paths are sent to the workers.
+
+Start a worker with:
+
+AFTERSHOQ_TOKEN=secret python -m aftershoq.numerics.remoteplatf host:port [--ncores N]
+
+A worker runs any program a client asks for, as the user running the
+worker. Anyone who can connect to it can therefore execute arbitrary code on
+the computer. A worker listening on TCP must be given a shared secret token
+(--token, or the environment variable AFTERSHOQ_TOKEN), which the clients
+send when they connect. Without a token, a worker only listens on the
+loopback interface or on a Unix socket, which only its user can access.
+The token is sent in clear text, so only use workers on trusted networks.
+
+The protocol consists of JSON objects, one per line. The client opens the
+connection with {"op": "hello", "token": token}, and the worker answers
+{"op": "hello", "ncores": N}, or closes the connection if the token is
+wrong. The client submits jobs with
+{"op": "submit", "id": i, "prog": prog, "args": args, "dirpath": dirpath,
+"Nproc": Nproc}, and the worker answers {"op": "exit", "id": i,
+"returncode": r} when the job has finished. {"op": "kill", "id": i}
+terminates a job.
+'''
+
+from aftershoq.numerics.runplatf import Platform, Pool
+import aftershoq.utils.debug as dbg
+import socketserver
+import ipaddress
+import socket
+import threading
+import itertools
+import argparse
+import hmac
+import json
+import os
+
+
+def parseaddress(address):
+    '''Returns (family, address) for the socket address "host:port", a
+    (host, port) tuple, or the path of a Unix socket.
+    '''
+    if isinstance(address, tuple):
+        return socket.AF_INET, address
+    address = str(address)
+    if ":" in address and not os.path.sep in address:
+        host, port = address.rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def isloopback(host):
+    '''Returns True if host is an address of the loopback interface.'''
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class WorkerTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class WorkerUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    '''Serves one client connection of a Worker.'''
+
+    def handle(self):
+        platform = self.server.worker.platform
+        lock = threading.Lock()
+        jobs = {}
+
+        def send(msg):
+            with lock:
+                try:
+                    self.wfile.write((json.dumps(msg) + "\n").encode())
+                    self.wfile.flush()
+                except (OSError, ValueError):
+                    # the client has disconnected
+                    pass
+
+        try:
+            hello = json.loads(self.rfile.readline())
+            token = str(hello.get("token") or "")
+        except (ValueError, AttributeError):
+            return
+        if not self.server.worker.authenticate(token):
+            dbg.debug("Rejected client " + str(self.client_address) + "\n",
+                      dbg.verb_modes["verbose"], self.server.worker)
+            send({"op": "error", "error": "authentication failed"})
+            return
+
+        ncores = platform.Ncores
+        if ncores is None:
+            ncores = os.cpu_count()
+        send({"op": "hello", "ncores": ncores})
+
+        for line in self.rfile:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if msg.get("op") == "kill":
+                with lock:
+                    job = jobs.get(msg.get("id"))
+                if job is not None:
+                    platform.killjob(job)
+                continue
+            if msg.get("op") != "submit":
+                continue
+            jid = msg["id"]
+            try:
+                job = platform.submitjob(msg["prog"], msg["args"],
+                                         msg["dirpath"], msg.get("Nproc"))
+            except Exception as e:
+                dbg.debug("Could not start job: " + str(e) + "\n",
+                          dbg.verb_modes["verbose"], self.server.worker)
+                send({"op": "exit", "id": jid, "returncode": -1,
+                      "error": str(e)})
+                continue
+            with lock:
+                jobs[jid] = job
+
+            def finished(j, jid=jid):
+                with lock:
+                    jobs.pop(jid, None)
+                send({"op": "exit", "id": jid, "returncode": j.returncode})
+            platform.on_complete(job, finished)
+
+        # the client has disconnected, nobody waits for its jobs any more
+        with lock:
+            orphans = list(jobs.values())
+        for job in orphans:
+            platform.killjob(job)
+        if len(orphans) > 0:
+            dbg.debug("Killed " + str(len(orphans)) + " jobs of client " +
+                      str(self.client_address) + "\n",
+                      dbg.verb_modes["verbose"], self.server.worker)
+
+
+class Worker(object):
+    '''
+    Worker daemon, which runs jobs submitted by RemotePool clients on a
+    local platform.
+
+    Parameters:
+    address: "host:port" (port 0 picks a free port), or the path of a Unix
+        socket, to listen on. Without a token, host must be a loopback
+        address.
+    platform (optional): Platform running the jobs. Defaults to a Pool
+        using all cores of the computer.
+    token (optional): Shared secret the clients have to send, see the module
+        documentation.
+    '''
+
+    def __init__(self, address, platform = None, token = None):
+        family, addr = parseaddress(address)
+        if family == socket.AF_INET and not token and not isloopback(addr[0]):
+            raise ValueError("Worker: a token is required to listen on " +
+                             str(addr[0]))
+        if platform is None:
+            platform = Pool()
+        self.platform = platform
+        self.token = token
+
+        if family == socket.AF_UNIX:
+            # only the user may connect, from the moment the socket exists
+            umask = os.umask(0o177)
+            try:
+                self.server = WorkerUnixServer(addr, WorkerHandler)
+            finally:
+                os.umask(umask)
+        else:
+            self.server = WorkerTCPServer(addr, WorkerHandler)
+        self.server.worker = self
+
+    def authenticate(self, token):
+        '''Returns True if a client sending token may submit jobs.'''
+        if not self.token:
+            return True
+        return hmac.compare_digest(token.encode(), str(self.token).encode())
+
+    @property
+    def address(self):
+        '''The address the worker listens on, in the format of the
+        constructor (with the actual port).'''
+        addr = self.server.server_address
+        if isinstance(addr, tuple):
+            return addr[0] + ":" + str(addr[1])
+        return addr
+
+    def serve_forever(self):
+        dbg.debug("Worker listening on " + str(self.address) + "\n",
+                  dbg.verb_modes["verbose"], self)
+        self.server.serve_forever()
+
+    def start(self):
+        '''Serve in a background thread, and return self.'''
+        t = threading.Thread(target=self.serve_forever, daemon=True)
+        t.start()
+        return self
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.server.server_address, str):
+            os.remove(self.server.server_address)
+
+
+class RemoteJob(object):
+    '''
+    Handle for a job submitted to a RemotePool. Behaves like the Popen
+    object returned by Local.submitjob().
+    '''
+
+    def __init__(self, jid, prog, args, dirpath, Nproc):
+        self.jid = jid
+        self.prog = prog
+        self.args = args
+        self.dirpath = dirpath
+        self.Nproc = Nproc
+        self.worker = None
+        self.returncode = None
+        self.done = threading.Event()
+
+    @property
+    def pid(self):
+        return self.jid
+
+    def finish(self, returncode):
+        self.returncode = returncode
+        self.done.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.done.wait()
+        return self.returncode
+
+
+class WorkerConnection(object):
+    '''Connection of a RemotePool to one worker.'''
+
+    def __init__(self, address, token = None):
+        self.address = address
+        family, addr = parseaddress(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        self.rfile = self.sock.makefile("rb")
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.used = 0
+        self.alive = True
+
+        self.sock.sendall((json.dumps({"op": "hello", "token": token}) +
+                           "\n").encode())
+        try:
+            hello = json.loads(self.rfile.readline())
+            self.ncores = hello["ncores"]
+        except (ValueError, KeyError, TypeError):
+            self.sock.close()
+            raise ConnectionError("Worker " + str(address) +
+                                  " refused the connection")
+
+        t = threading.Thread(target=self.reader, daemon=True)
+        t.start()
+
+    def load(self):
+        '''Returns the fraction of the cores of the worker in use.'''
+        return self.used/self.ncores
+
+    def submit(self, job):
+        msg = {"op": "submit", "id": job.jid, "prog": job.prog,
+               "args": list(job.args), "dirpath": job.dirpath,
+               "Nproc": job.Nproc}
+        with self.lock:
+            if not self.alive:
+                raise ConnectionError("Lost connection to worker " +
+                                      str(self.address))
+            try:
+                self.sock.sendall((json.dumps(msg) + "\n").encode())
+            except OSError:
+                self.lost()
+                raise
+            job.worker = self
+            self.jobs[job.jid] = job
+            self.used += job.Nproc
+
+    def kill(self, job):
+        msg = {"op": "kill", "id": job.jid}
+        with self.lock:
+            if job.jid not in self.jobs:
+                return
+            try:
+                self.sock.sendall((json.dumps(msg) + "\n").encode())
+            except OSError as e:
+                # the jobs of the worker fail, see reader()
+                dbg.debug("Lost connection to worker " + str(self.address) +
+                          ": " + str(e) + "\n", dbg.verb_modes["verbose"], self)
+                self.lost()
+
+    def lost(self):
+        '''Mark the connection as lost, and stop reader().'''
+        self.alive = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def reader(self):
+        try:
+            for line in self.rfile:
+                msg = json.loads(line)
+                if msg.get("op") != "exit":
+                    continue
+                with self.lock:
+                    job = self.jobs.pop(msg["id"], None)
+                    if job is not None:
+                        self.used -= job.Nproc
+                if job is not None:
+                    job.finish(msg["returncode"])
+        except (OSError, ValueError) as e:
+            dbg.debug("Lost connection to worker " + str(self.address) +
+                      ": " + str(e) + "\n", dbg.verb_modes["verbose"], self)
+        # the jobs of a lost worker fail
+        with self.lock:
+            self.alive = False
+            jobs = list(self.jobs.values())
+            self.jobs = {}
+        for job in jobs:
+            job.finish(-1)
+
+    def close(self):
+        self.sock.close()
+
+
+class RemotePool(Platform):
+    '''
+    Run platform which distributes jobs over several Worker daemons. Each
+    job is sent to the worker with the smallest fraction of its cores in
+    use. Directories are passed to the workers as absolute paths, which
+    must be valid on all computers.
+
+    Parameters:
+    workers (optional): List of worker addresses, see Worker. More workers
+        can be registered with addworker().
+    Nproc (optional): Number of cores used by each job. Defaults to 1.
+    token (optional): Shared secret of the workers, see Worker.
+
+    A copy made by pickle has no connections, and connects to the workers
+    when it submits its first job.
+    '''
+
+    transient = Platform.transient + ("lock", "workers", "counter")
+
+    def __init__(self, workers = None, Nproc = 1, token = None):
+        super(RemotePool,self).__init__("RemotePool")
+
+        if workers is None:
+            workers = []
+        self.Nproc = Nproc
+        self.token = token
+        self.addresses = []
+        [self.addworker(w) for w in workers]
+
+    def initsync(self):
+        super(RemotePool,self).initsync()
+        self.lock = threading.RLock()
+        self.workers = []
+        self.counter = itertools.count()
+
+    def addworker(self, address):
+        '''Connect to the worker at address, and use it for new jobs.'''
+        with self.lock:
+            self.connect()
+            worker = WorkerConnection(address, self.token)
+            self.workers.append(worker)
+            self.addresses.append(address)
+            self.countcores()
+        return worker
+
+    def connect(self):
+        '''Connect to the workers which are not connected yet (all of them
+        in a copy made by pickle).
+        '''
+        with self.lock:
+            for address in self.addresses[len(self.workers):]:
+                self.workers.append(WorkerConnection(address, self.token))
+            self.countcores()
+
+    def countcores(self):
+        with self.lock:
+            self.Ncores = sum([w.ncores for w in self.workers if w.alive])
+
+    def submitjob(self, prog, args, dirpath, Nproc = None, wtime = None):
+        if Nproc is None:
+            Nproc = self.Nproc
+        job = RemoteJob(next(self.counter), prog, args,
+                        os.path.abspath(str(dirpath)), Nproc)
+        with self.lock:
+            self.connect()
+            while True:
+                alive = [w for w in self.workers if w.alive]
+                if len(alive) == 0:
+                    raise RuntimeError("RemotePool: no worker available")
+                worker = min(alive, key=lambda w: (w.load(), len(w.jobs)))
+                try:
+                    worker.submit(job)
+                    break
+                except OSError as e:
+                    # try the next worker
+                    dbg.debug("Lost connection to worker " +
+                              str(worker.address) + ": " + str(e) + "\n",
+                              dbg.verb_modes["verbose"], self)
+                    self.countcores()
+        dbg.debug("Submitted " + str(prog) + " in " + job.dirpath + " to " +
+                  str(worker.address) + "\n", dbg.verb_modes["chatty"], self)
+        return job
+
+    def submitandwait(self, prog, args, dirpath, Nproc = None):
+        job = self.submitjob(prog, args, dirpath, Nproc)
+        job.wait()
+        return job
+
+    def jobstatus(self, proc):
+        return not proc.done.is_set()
+
+    def waitjob(self, proc):
+        proc.wait()
+
+    def killjob(self, proc):
+        if proc.worker is not None:
+            proc.worker.kill(proc)
+
+    def close(self):
+        with self.lock:
+            [w.close() for w in self.workers]
+            self.workers = []
+            self.addresses = []
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="aftershoq worker daemon for RemotePool")
+    parser.add_argument("address",
+                        help="host:port or path of a Unix socket to listen on")
+    parser.add_argument("--ncores", type=int, default=None,
+                        help="number of cores to use (default: all)")
+    parser.add_argument("--nproc", type=int, default=1,
+                        help="default number of cores per job")
+    parser.add_argument("--token", default=os.environ.get("AFTERSHOQ_TOKEN"),
+                        help="shared secret of the clients (default: "
+                        "$AFTERSHOQ_TOKEN), required unless listening on "
+                        "the loopback interface or a Unix socket")
+    args = parser.parse_args()
+
+    worker = Worker(args.address, Pool(args.ncores, args.nproc), args.token)
+    try:
+        worker.serve_forever()
+    except KeyboardInterrupt:
+        worker.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,14 @@ import time
 import aftershoq.utils.debug as dbg
 import subprocess
 import os
+import heapq
+import itertools
+import threading
+import weakref
+import asyncio
+import shlex
+import re
+import contextlib
 #import psutil
 
 class Platform(object):
@@ -24,6 +32,9 @@ class Platform(object):
              "OMP": 1,
              "SERIAL": 2}
 
+    # synchronisation state, which is not pickled (see __getstate__())
+    transient = ("cond", "callbacks", "watched", "finished")
+
 
     def __init__(self, name=None):
         '''
@@ -36,17 +47,210 @@ class Platform(object):
             "SERIAL"
         commlist: A list of commands to be executed next. Commands are added
             through the method addcomm(command), and executed by execcomm().
+        pollinterval: Time in seconds between status checks, for platforms
+            which cannot be notified when a job finishes (see waitjob()).
+        Nproc: Number of cores used by each job.
+        Ncores: Number of cores the platform may use at the same time, or
+            None if not limited locally (as for batch schedulers).
         '''
         
         self.paral = self.paral_modes["SERIAL"]
         self.commlist = []
+        self.pollinterval = 1.
+        self.Nproc = 1
+        self.Ncores = None
+        self.initsync()
+
+    def initsync(self):
+        '''Create the synchronisation state of the platform (locks and the
+        jobs being watched), which is not copied by pickle or deepcopy.
+        '''
+        # completion notification, see on_complete() and waitall()
+        self.cond = threading.Condition(threading.RLock())
+        self.callbacks = {}
+        self.watched = set()
+        self.finished = weakref.WeakSet()
+
+    def __getstate__(self):
+        # locks cannot be pickled, and the jobs watched by the threads of
+        # this process are of no use to a copy
+        state = dict(self.__dict__)
+        for name in self.transient:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.initsync()
         
     def submitjob(self,prog,args,dirpath,Nproc=None,wtime=None):
         pass
     
     def jobstatus(self,proc):
         pass
+
+    def killjob(self, proc):
+        '''Terminate the job proc. Callbacks and waiting threads are notified
+        as for a job which has finished by itself, with a nonzero return
+        code. The default implementation terminates the process returned by
+        submitjob().
+        '''
+        proc.terminate()
+
+    @contextlib.contextmanager
+    def reserve(self, ncores = 1):
+        '''Context manager for running ncores cores worth of work in the
+        calling process (or programs it waits for, such as hdiag), so that
+        platforms with a core budget (see Pool) account for them. Blocks
+        until the cores are free, and yields the list of cpu ids reserved
+        if jobs are pinned, else None. Does nothing on other platforms.
+        '''
+        yield None
+
+    def flush(self):
+        '''Submit jobs which submitjob() has kept back, for platforms which
+        collect jobs and submit them together (see BatchPlatform). Does
+        nothing on other platforms.
+        '''
+        pass
+
+    def maxjobs(self, Nproc = None):
+        '''Returns the number of jobs using Nproc cores each (defaults to
+        self.Nproc) which the platform runs at the same time without
+        oversubscribing its cores, or None if there is no local limit (as for
+        batch schedulers).
+        '''
+        if Nproc is None:
+            Nproc = self.Nproc
+        if self.Ncores is None:
+            return None
+        return max(1, self.Ncores // max(1, Nproc))
+
+    def waitjob(self, proc):
+        '''Blocks until the job proc has finished. The default implementation
+        polls jobstatus() every self.pollinterval seconds. Platforms which
+        can wait for the process to exit directly override this method.
+        '''
+        while self.jobstatus(proc):
+            time.sleep(self.pollinterval)
+
+    def watch(self, proc):
+        '''Start a watcher thread which waits for proc to finish, calls the
+        callbacks registered with on_complete(), and then wakes up all
+        threads waiting in waitall() or waitany().
+        '''
+        with self.cond:
+            if proc in self.watched or proc in self.finished:
+                return
+            self.watched.add(proc)
+        t = threading.Thread(target=self._watcher, args=(proc,), daemon=True)
+        t.start()
+
+    def _watcher(self, proc):
+        try:
+            self.waitjob(proc)
+        except Exception as e:
+            dbg.debug("Error while waiting for job: " + str(e) + "\n",
+                      dbg.verb_modes["verbose"], self)
+        while True:
+            # callbacks may be registered while others are running
+            with self.cond:
+                callbacks = self.callbacks.pop(proc, [])
+                if len(callbacks) == 0:
+                    self.finished.add(proc)
+                    self.watched.discard(proc)
+                    self.cond.notify_all()
+                    return
+            for callback in callbacks:
+                try:
+                    callback(proc)
+                except Exception as e:
+                    dbg.debug("Error in on_complete callback: " + str(e) + "\n",
+                              dbg.verb_modes["verbose"], self)
+
+    def on_complete(self, proc, callback):
+        '''Register callback(proc) to be called as soon as proc has finished.
+        The callback runs on a watcher thread, and before any thread waiting
+        for proc in waitall() or waitany() is woken up. If proc has already
+        finished, callback is called immediately.
+        '''
+        with self.cond:
+            done = proc in self.finished
+            if not done:
+                self.callbacks.setdefault(proc, []).append(callback)
+        if done:
+            callback(proc)
+        else:
+            self.watch(proc)
+
+    def isfinished(self, proc):
+        '''Returns True if proc has finished and all its callbacks are done.'''
+        with self.cond:
+            return proc in self.finished
+
+    def waitall(self, procs, timeout = None):
+        '''Blocks until all jobs in the list procs have finished, and returns
+        True, or until timeout seconds have passed, and returns False.
+        The list procs may grow while waiting (for instance from within an
+        on_complete() callback); new jobs are waited for as well.
+        '''
+        return self._wait(procs, timeout, all)
+
+    def waitany(self, procs, timeout = None):
+        '''Blocks until at least one of the jobs in procs has finished, or
+        until timeout seconds have passed. Returns the list of finished jobs.
+        '''
+        self._wait(procs, timeout, any)
+        return [p for p in list(procs) if self.isfinished(p)]
+
+    def _wait(self, procs, timeout, condition):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                current = list(procs)
+                if len(current) == 0 or \
+                    condition([p in self.finished for p in current]):
+                    return True
+                [self.watch(p) for p in current]
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
     
+    async def waitjob_async(self, proc):
+        '''Coroutine which returns proc once it has finished. Uses the
+        completion notification of on_complete(), so that the event loop is
+        not blocked while waiting.
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def setdone(fut):
+            if not fut.done():
+                fut.set_result(proc)
+
+        self.on_complete(proc,
+                         lambda p: loop.call_soon_threadsafe(setdone, future))
+        return await future
+
+    async def waitall_async(self, procs):
+        '''Coroutine which returns once all jobs in procs have finished.'''
+        await asyncio.gather(*[self.waitjob_async(p) for p in list(procs)])
+
+    async def submitjob_async(self, prog, args, dirpath, Nproc = None,
+                              wtime = None):
+        '''Coroutine which submits a job with submitjob(), and returns the
+        job once it has finished. Platforms which can run the program as an
+        asyncio subprocess override this method, so that many jobs can be
+        waited for on one event loop without a thread for each job.
+        '''
+        proc = self.submitjob(prog, args, dirpath, Nproc, wtime)
+        return await self.waitjob_async(proc)
+
     def addcomm(self, command):
         """
         Add command "command" to list of commands to be executed.
@@ -62,71 +266,387 @@ class Platform(object):
         pass
     
     
-class Euler(Platform):
+class BatchJob(object):
+    '''
+    Handle of a job submitted to a BatchPlatform. The job is kept in a buffer
+    until the platform is flushed; afterwards jobid (and index, for an
+    element of an array job) identify it to the scheduler.
+    '''
+
+    def __init__(self, platform, prog, args, dirpath, Nproc, wtime):
+        self.platform = platform
+        self.prog = prog
+        self.args = [str(a) for a in args]
+        self.dirpath = os.path.abspath(str(dirpath))
+        self.Nproc = Nproc
+        self.wtime = wtime
+        self.jobname = None
+        self.jobid = None
+        self.index = None
+        self.submitted = None
+        self.returncode = None
+        self.killed = False
+
+    @property
+    def pid(self):
+        return self.jobid
+
+    def poll(self):
+        if self.platform.jobstatus(self):
+            return None
+        return self.returncode
+
+    def wait(self):
+        self.platform.waitjob(self)
+        return self.returncode
+
+
+class BatchPlatform(Platform):
+    '''
+    Base class for platforms which submit jobs to a batch scheduler.
+    submitjob() only buffers the job and returns a BatchJob. The buffer is
+    submitted by flush(), with one array job for each group of jobs running
+    the same program with the same arguments and resources. The status of
+    all jobs is obtained from a single scheduler query, which is repeated at
+    most once every self.pollinterval seconds and shared by all calls to
+    jobstatus().
     
+    Derived classes implement:
+    submitarray(jobs, jobname, script): submit the job script for the list
+        of jobs and return the job id.
+    querystatus(jobids): return a dictionary {(jobid, index): returncode}
+        for the given job ids, with returncode None while a job is pending
+        or running. index is None for jobs which are not array elements.
+    canceljob(job): cancel the submitted job (or array element).
+    finalstatus(jobids) (optional): as querystatus(), for jobs which are no
+        longer listed by querystatus(), from the accounting of the
+        scheduler. Jobs which have left the queue without a known final
+        state get the return code self.unknowncode.
     
+    Parameters:
+    name: Name of the platform.
+    Nproc: Number of cores per job.
+    wtime: Wall time per job, in the format of the scheduler.
+    paral_in (optional): Parallelization mode, defaults to "MPI".
+    array (optional): If False, every job is submitted on its own.
+    '''
+
+    indexvar = None
+    transient = Platform.transient + ("lock",)
     
-    def __init__(self, Nproc, wtime, paral_in = None):
-        '''
-        Constructor
-        '''
-        super(Euler,self).__init__("Euler")
+    # return code of jobs which have ended in an unknown state
+    unknowncode = -2
+
+    def __init__(self, name, Nproc, wtime, paral_in = None, array = True):
+        super(BatchPlatform,self).__init__(name)
         
         if paral_in is None:
             paral_in = self.paral_modes.get("MPI")
         
         self.paral = paral_in
-        
         self.Nproc = Nproc
         self.wtime = wtime
-        self.subcommand = "bsub"
-        self.procinfo = []
-    
-    def submitjob(self, prog, args,dirpath,Nproc=None,wtime=None):
+        self.array = array
+        self.pollinterval = 10.
+        self.jobprefix = "aftershoq" + str(os.getpid()) + "_"
+        
+        # jobs not yet submitted, submitted jobs by job id, and the result
+        # of the last status query
+        self.pending = []
+        self.procinfo = {}
+        self.status = {}
+        self.lastquery = 0.
+        self.counter = itertools.count()
+
+    def initsync(self):
+        super(BatchPlatform,self).initsync()
+        self.lock = threading.RLock()
+
+    def submitjob(self, prog, args, dirpath, Nproc = None, wtime = None):
         if Nproc is None:
             Nproc = self.Nproc
         if wtime is None:
             wtime = self.wtime
-            
+        job = BatchJob(self, prog, args, dirpath, Nproc, wtime)
+        with self.lock:
+            self.pending.append(job)
+        return job
+
+    def submitandwait(self, prog, args, dirpath, Nproc = None, wtime = None):
+        job = self.submitjob(prog, args, dirpath, Nproc, wtime)
+        self.flush()
+        self.waitjob(job)
+        return job
+
+    async def submitjob_async(self, prog, args, dirpath, Nproc = None,
+                              wtime = None):
+        job = self.submitjob(prog, args, dirpath, Nproc, wtime)
+        # let other coroutines add their jobs to the same array
+        await asyncio.sleep(0)
+        self.flush()
+        return await self.waitjob_async(job)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            groups = {}
+            for job in pending:
+                key = (job.prog, tuple(job.args), job.Nproc, job.wtime)
+                groups.setdefault(key, []).append(job)
+            for jobs in groups.values():
+                if self.array:
+                    self.submitbatch(jobs)
+                else:
+                    [self.submitbatch([job]) for job in jobs]
+
+    def submitbatch(self, jobs):
+        jobname = self.jobprefix + str(next(self.counter))
+        script = self.writescript(jobs, jobname)
+        try:
+            jobid = self.submitarray(jobs, jobname, script)
+        except Exception as e:
+            dbg.debug("Job submission failed: " + str(e) + "\n",
+                      dbg.verb_modes["verbose"], self)
+            jobid = None
+        
+        dbg.debug("Submitted " + str(len(jobs)) + " job(s) as " + jobname +
+                  " with id " + str(jobid) + "\n",dbg.verb_modes["chatty"],self)
+        
+        for i, job in enumerate(jobs):
+            job.jobname = jobname
+            job.jobid = jobid
+            job.index = i + 1 if len(jobs) > 1 else None
+            job.submitted = time.time()
+            if jobid is None:
+                job.returncode = -1
+        if jobid is not None:
+            self.procinfo[jobid] = jobs
+
+    def writescript(self, jobs, jobname):
+        '''Write the shell script run by all elements of the array job for
+        jobs, to the common parent directory of the jobs, and return its
+        path. Each element enters the directory of its job, selected by the
+        array index in the variable self.indexvar.
+        '''
+        if len(jobs) == 1:
+            scriptdir = jobs[0].dirpath
+        else:
+            scriptdir = os.path.commonpath([j.dirpath for j in jobs])
+        script = os.path.join(scriptdir, "." + jobname + ".sh")
+        
+        with open(script, 'w') as f:
+            f.write("#!/bin/sh\n")
+            if len(jobs) == 1:
+                f.write("cd " + shlex.quote(jobs[0].dirpath) + " || exit 1\n")
+            else:
+                f.write('case "$' + self.indexvar + '" in\n')
+                for i, job in enumerate(jobs):
+                    f.write(str(i+1) + ") cd " + shlex.quote(job.dirpath) +
+                            " || exit 1 ;;\n")
+                f.write("*) exit 1 ;;\nesac\n")
+            command = [shlex.quote(c) for c in self.command(jobs[0])]
+            f.write("exec " + " ".join(command) + " > out.log 2> err.log\n")
+        return script
+
+    def command(self, job):
+        '''Returns the command line running job on its allocated cores.'''
+        return [job.prog] + job.args
+
+    def jobstatus(self, job):
+        with self.lock:
+            if job.submitted is None:
+                self.flush()
+            if job.returncode is not None:
+                return False
+            if job.submitted > self.lastquery or \
+                time.time() - self.lastquery >= self.pollinterval:
+                self.refresh()
+            if self.status is None:
+                # the last query failed, assume the job is still running
+                return True
+            key = (job.jobid, job.index)
+            if key in self.status and self.status[key] is None:
+                return True
+            # jobs which are no longer known to the scheduler have ended
+            job.returncode = self.status.get(key, 1 if job.killed
+                                             else self.unknowncode)
+            dbg.debug( "process ended!" )
+            return False
+
+    def killjob(self, job):
+        with self.lock:
+            if job.submitted is None and job in self.pending:
+                # never submitted
+                self.pending.remove(job)
+                job.submitted = time.time()
+                job.returncode = -1
+                return
+        if job.jobid is None or job.returncode is not None:
+            return
+        job.killed = True
+        try:
+            self.canceljob(job)
+        except Exception as e:
+            dbg.debug("Could not cancel job " + str(job.jobid) + ": " + str(e) +
+                      "\n", dbg.verb_modes["verbose"], self)
+
+    def refresh(self):
+        '''Query the status of all unfinished jobs from the scheduler.'''
+        self.lastquery = time.time()
+        for jobid in list(self.procinfo):
+            if all([j.returncode is not None for j in self.procinfo[jobid]]):
+                del self.procinfo[jobid]
+        if len(self.procinfo) == 0:
+            self.status = {}
+            return
+        try:
+            status = self.querystatus(list(self.procinfo))
+        except Exception as e:
+            dbg.debug("Job status query failed: " + str(e) + "\n",
+                      dbg.verb_modes["verbose"], self)
+            self.status = None
+            return
+        lost = set([j.jobid for jobs in self.procinfo.values() for j in jobs
+                    if j.returncode is None and
+                    (j.jobid, j.index) not in status])
+        if len(lost) > 0:
+            try:
+                final = self.finalstatus(sorted(lost))
+                final.update(status)
+                status = final
+            except Exception as e:
+                dbg.debug("Final job status query failed: " + str(e) + "\n",
+                          dbg.verb_modes["verbose"], self)
+        self.status = status
+
+    def submitarray(self, jobs, jobname, script):
+        pass
+
+    def querystatus(self, jobids):
+        pass
+
+    def finalstatus(self, jobids):
+        return {}
+
+    def canceljob(self, job):
+        pass
+
+
+class Euler(BatchPlatform):
+    '''
+    Run platform for the LSF batch system of the Euler cluster. Jobs are
+    submitted with bsub as job arrays, see BatchPlatform. The status is
+    obtained with bjobs -a, and the final state of jobs which are no longer
+    listed by bjobs (after the CLEAN_PERIOD of LSF) with bhist.
+    
+    Parameters:
+    Nproc: Number of cores per job.
+    wtime: Wall time per job, as "hh:mm".
+    paral_in (optional): Parallelization mode, defaults to "MPI".
+    array (optional): If False, every job is submitted with its own bsub.
+    '''
+    
+    indexvar = "LSB_JOBINDEX"
+    
+    # LSF job states, and the corresponding return codes once finished
+    states = {"DONE": 0, "EXIT": 1, "ZOMBI": 1}
+    
+    def __init__(self, Nproc, wtime, paral_in = None, array = True):
+        '''
+        Constructor
+        '''
+        super(Euler,self).__init__("Euler", Nproc, wtime, paral_in, array)
+        
+        self.subcommand = "bsub"
+        self.statcommand = "bjobs"
+        self.killcommand = "bkill"
+        self.histcommand = "bhist"
+    
+    def command(self, job):
+        if job.Nproc>1 and self.paral == self.paral_modes.get("MPI"):
+            return ["mpirun", job.prog] + job.args
+        return [job.prog] + job.args
+    
+    def submitarray(self, jobs, jobname, script):
+        Nproc = jobs[0].Nproc
+        
         if self.paral == self.paral_modes.get("OMP"):
             os.environ["OMP_NUM_THREADS"] = str(Nproc)
         else:
             os.environ["OMP_NUM_THREADS"] = str(1)
         
-        progargs = []
-        jobname = str(dirpath)
+        if len(jobs) > 1:
+            jobname = jobname + "[1-" + str(len(jobs)) + "]"
         
+        progargs = []
         progargs.append("-n")
         progargs.append(str(Nproc))
         progargs.append("-W")
-        progargs.append(str(wtime))
+        progargs.append(str(jobs[0].wtime))
         progargs.append("-J")
         progargs.append(jobname)
         if Nproc>1 and self.paral == self.paral_modes.get("OMP"):
             progargs.append("-R")
             progargs.append("span[ptile="+str(Nproc)+"]")
-        if Nproc>1 and self.paral == self.paral_modes.get("MPI"):
-            progargs.append("mpirun")
-        progargs.append(prog)
-        [progargs.append(a) for a in args]
-        with open(dirpath+"/err.log", 'w') as errfile:
-            with open(dirpath+"/out.log", 'w') as outfile:
-                proc = su.dispatch(self.subcommand, progargs, dirpath, errfile=errfile, outfile=outfile)
-        self.procinfo.append([proc.pid,jobname])
-        return proc
+        progargs.append("sh")
+        progargs.append(script)
+        
+        proc = su.dispatch(self.subcommand, progargs, os.path.dirname(script),
+                           outfile=subprocess.PIPE, errfile=subprocess.PIPE)
+        out = proc.communicate()
+        jobid = re.search(r"Job <(\d+)>", out[0])
+        if jobid is None:
+            raise RuntimeError(self.subcommand + " failed: " + out[1])
+        return jobid.group(1)
     
-    def jobstatus(self, proc):
-        for info in self.procinfo:
-            if info[0]==proc.pid:
-                jobname = info[1]
-        p = su.dispatch("bjobs",["-J",jobname],errfile=subprocess.PIPE)
+    def querystatus(self, jobids):
+        args = ["-a", "-noheader", "-o", "jobid jobindex stat"] + jobids
+        p = su.dispatch(self.statcommand, args,
+                        outfile=subprocess.PIPE, errfile=subprocess.PIPE)
         out = p.communicate()
         
-        if ("not found" in out[1]) and (proc.poll()!=None):
-            dbg.debug( "process ended!" )
-            return False
-        else:
-            return True
+        status = {}
+        for line in out[0].splitlines():
+            s = line.split()
+            if len(s) < 3 or not s[0].isdigit():
+                continue
+            index = None if s[1] in ("0", "-") else int(s[1])
+            status[(s[0], index)] = self.states.get(s[2])
+        return status
+
+    def finalstatus(self, jobids):
+        args = ["-l", "-n", "0"] + jobids
+        p = su.dispatch(self.histcommand, args,
+                        outfile=subprocess.PIPE, errfile=subprocess.PIPE)
+        out = p.communicate()
+        
+        # long lines are continued on the next lines, indented by spaces
+        text = re.sub(r"\n +", "", out[0])
+        status = {}
+        for record in re.split(r"\n(?=Job <)", "\n" + text):
+            m = re.match(r"Job <(\d+)(?:\[(\d+)\])?>", record)
+            if m is None:
+                continue
+            index = None if m.group(2) is None else int(m.group(2))
+            code = re.search(r"Exited with exit code (\d+)", record)
+            if "Done successfully" in record:
+                returncode = 0
+            elif code is not None:
+                returncode = int(code.group(1)) or 1
+            elif "Exited" in record:
+                returncode = 1
+            else:
+                returncode = None
+            status[(m.group(1), index)] = returncode
+        return status
+
+    def canceljob(self, job):
+        jobid = job.jobid
+        if job.index is not None:
+            jobid += "[" + str(job.index) + "]"
+        p = su.dispatch(self.killcommand, [jobid],
+                        outfile=subprocess.PIPE, errfile=subprocess.PIPE)
+        p.communicate()
         
     def execcomm(self):
         
@@ -143,6 +663,154 @@ class Euler(Platform):
         
         self.commlist = []
         
+class Slurm(BatchPlatform):
+    '''
+    Run platform for clusters with the SLURM batch system. Jobs are
+    submitted with sbatch as job arrays, and their status is obtained with
+    one squeue call per polling interval, see BatchPlatform.
+    
+    The parallelization mode selects the resources of each job:
+    "MPI": Nproc tasks with one cpu each, the program is started with srun.
+    "OMP": one task with Nproc cpus, and OMP_NUM_THREADS = Nproc.
+    "SERIAL": one task with one cpu.
+    
+    Parameters:
+    Nproc: Number of cores per job.
+    wtime: Wall time per job, as "hh:mm" (as for Euler) or in any of the
+        formats accepted by sbatch --time.
+    paral_in (optional): Parallelization mode, defaults to "MPI".
+    array (optional): If False, every job is submitted with its own sbatch.
+    '''
+    
+    indexvar = "SLURM_ARRAY_TASK_ID"
+    
+    # squeue states of finished jobs, and the corresponding return codes
+    states = {"CD": 0, "F": 1, "TO": 1, "CA": 1, "NF": 1, "OOM": 1,
+              "BF": 1, "DL": 1, "PR": 1}
+    
+    # sacct states of jobs which have not finished yet
+    active = ("PENDING", "RUNNING", "REQUEUED", "RESIZING", "SUSPENDED",
+              "CONFIGURING", "COMPLETING", "STAGE_OUT", "SIGNALING")
+    
+    def __init__(self, Nproc, wtime, paral_in = None, array = True):
+        super(Slurm,self).__init__("Slurm", Nproc, wtime, paral_in, array)
+        
+        self.subcommand = "sbatch"
+        self.statcommand = "squeue"
+        self.killcommand = "scancel"
+        self.acctcommand = "sacct"
+    
+    def command(self, job):
+        if self.paral == self.paral_modes.get("MPI"):
+            return ["srun", job.prog] + job.args
+        if self.paral == self.paral_modes.get("OMP"):
+            return ["env", "OMP_NUM_THREADS="+str(job.Nproc),
+                    job.prog] + job.args
+        return [job.prog] + job.args
+    
+    def resources(self, Nproc):
+        '''Returns (ntasks, cpus per task) for jobs with Nproc cores.'''
+        if self.paral == self.paral_modes.get("MPI"):
+            return Nproc, 1
+        if self.paral == self.paral_modes.get("OMP"):
+            return 1, Nproc
+        return 1, 1
+    
+    def submitarray(self, jobs, jobname, script):
+        ntasks, cpus = self.resources(jobs[0].Nproc)
+        wtime = str(jobs[0].wtime)
+        if wtime.count(":") == 1:
+            # hh:mm, which sbatch would read as mm:ss
+            wtime = wtime + ":00"
+        
+        progargs = []
+        progargs.append("--parsable")
+        progargs.append("--job-name=" + jobname)
+        progargs.append("--ntasks=" + str(ntasks))
+        progargs.append("--cpus-per-task=" + str(cpus))
+        progargs.append("--time=" + wtime)
+        progargs.append("--output=/dev/null")
+        if len(jobs) > 1:
+            progargs.append("--array=1-" + str(len(jobs)))
+        progargs.append(script)
+        
+        proc = su.dispatch(self.subcommand, progargs, os.path.dirname(script),
+                           outfile=subprocess.PIPE, errfile=subprocess.PIPE)
+        out = proc.communicate()
+        jobid = out[0].strip().split(";")[0]
+        if not jobid.isdigit():
+            raise RuntimeError(self.subcommand + " failed: " + out[1])
+        return jobid
+    
+    def querystatus(self, jobids):
+        args = ["-h", "-o", "%i %t", "-j", ",".join(jobids)]
+        p = su.dispatch(self.statcommand, args,
+                        outfile=subprocess.PIPE, errfile=subprocess.PIPE)
+        out = p.communicate()
+        
+        status = {}
+        for line in out[0].splitlines():
+            s = line.split()
+            if len(s) < 2:
+                continue
+            for key in parsejobid(s[0]):
+                status[key] = self.states.get(s[1])
+        return status
+
+    def finalstatus(self, jobids):
+        args = ["-n", "-X", "-P", "-o", "JobID,State,ExitCode",
+                "-j", ",".join(jobids)]
+        p = su.dispatch(self.acctcommand, args,
+                        outfile=subprocess.PIPE, errfile=subprocess.PIPE)
+        out = p.communicate()
+        
+        status = {}
+        for line in out[0].splitlines():
+            s = line.split("|")
+            if len(s) < 3 or len(s[1].split()) == 0:
+                continue
+            # e.g. "CANCELLED by 1000", and the exit code as "code:signal"
+            state = s[1].split()[0]
+            if state in self.active:
+                returncode = None
+            elif state == "COMPLETED":
+                returncode = 0
+            else:
+                code = s[2].split(":")[0]
+                returncode = int(code) if code.isdigit() and int(code) else 1
+            for key in parsejobid(s[0]):
+                status[key] = returncode
+        return status
+
+    def canceljob(self, job):
+        jobid = job.jobid
+        if job.index is not None:
+            jobid += "_" + str(job.index)
+        p = su.dispatch(self.killcommand, [jobid],
+                        outfile=subprocess.PIPE, errfile=subprocess.PIPE)
+        p.communicate()
+
+
+def parsejobid(jobid):
+    '''Returns the list of (jobid, index) of the jobs in the squeue job id
+    jobid, which is one of "123" (index None), "123_4" or "123_[5-7,9%2]"
+    (the pending elements of an array job).
+    '''
+    if "_" not in jobid:
+        return [(jobid, None)]
+    jobid, index = jobid.split("_", 1)
+    if not index.startswith("["):
+        return [(jobid, int(index))]
+    keys = []
+    for r in index.strip("[]").split("%")[0].split(","):
+        if "-" in r:
+            first, last = r.split("-")
+            keys.extend([(jobid, i) for i in range(int(first), int(last)+1)])
+        elif r:
+            keys.append((jobid, int(r)))
+    return keys
+    
+    
 class Local(Platform):
     """
     Run platform for running local simulations, on a single node or computer.
@@ -156,6 +824,7 @@ class Local(Platform):
         super(Local,self).__init__("Local")
         
         self.Nproc = Nproc
+        self.Ncores = os.cpu_count()
         if Nproc > 1:
             self.paral = self.paral_modes["OMP"]
             os.environ["OMP_NUM_THREADS"] = str(Nproc)
@@ -167,8 +836,7 @@ class Local(Platform):
     
     def submitandwait(self, prog,  args, dirpath):
         proc = su.dispatch(prog, args, dirpath)
-        while proc.poll() == None:
-            time.sleep(0.1)
+        proc.wait()
         return proc
     
     def jobstatus(self, proc):
@@ -176,7 +844,401 @@ class Local(Platform):
             return True
         else:
             return False
+
+    def waitjob(self, proc):
+        proc.wait()
+
+    async def submitjob_async(self, prog, args, dirpath, Nproc = None,
+                              wtime = None):
+        proc = await su.dispatch_async(prog, args, dirpath)
+        await proc.wait()
+        return proc
+
+
+class PoolJob(object):
+    """
+    Handle for a job submitted to a Pool. Behaves like the Popen object
+    returned by Local.submitjob(), but the process is only started once the
+    pool has free cores for it. Until then, pid is None and poll() returns
+    None, so that the job counts as active.
+    
+    The job uses ranks MPI processes with threads OpenMP threads each, that
+    is cores = ranks*threads cores. cpus is the list of cpu ids the job is
+    pinned to, or None.
+    """
+
+    def __init__(self, pool, prog, args, dirpath, ranks = 1, threads = 1):
+        self.pool = pool
+        self.prog = prog
+        self.args = args
+        self.dirpath = dirpath
+        self.ranks = ranks
+        self.threads = threads
+        self.cpus = None
+        self.skipped = 0
+        self.proc = None
+        self.cancelled = False
+        self.started = threading.Event()
+
+    @property
+    def cores(self):
+        return self.ranks*self.threads
+
+    def start(self):
+        prog, args = self.pool.command(self)
+        self.proc = su.dispatch(prog, args, self.dirpath,
+                                env=self.pool.environment(self),
+                                cpus=self.cpus)
+        self.started.set()
+        # start the next queued job as soon as this one finishes
+        self.pool.on_complete(self, lambda j: self.pool.schedule())
+
+    def isrunning(self):
+        return self.proc.poll() is None
+
+    @property
+    def pid(self):
+        if self.proc is None:
+            return None
+        return self.proc.pid
+
+    @property
+    def returncode(self):
+        if self.proc is None:
+            return -1 if self.cancelled else None
+        return self.proc.returncode
+
+    def poll(self):
+        self.pool.schedule()
+        if self.proc is None:
+            return self.returncode
+        return self.proc.poll()
+
+    def wait(self):
+        self.started.wait()
+        if self.proc is None:
+            return self.returncode
+        return self.proc.wait()
+
+    def cancel(self):
+        '''Called by the pool when the job is removed from the queue.'''
+        self.cancelled = True
+        self.started.set()
+
+
+class AsyncPoolJob(PoolJob):
+    """
+    Place in the queue of a Pool for a job run by Pool.submitjob_async().
+    When the pool starts the job, the waiting coroutine is woken up on its
+    event loop and starts the program as an asyncio subprocess.
+    """
+
+    def __init__(self, pool, prog, args, dirpath, ranks, threads, loop):
+        super(AsyncPoolJob,self).__init__(pool, prog, args, dirpath,
+                                          ranks, threads)
+        self.loop = loop
+        self.go = asyncio.Event()
+        self.done = False
+
+    def start(self):
+        if self.loop.is_closed():
+            # the coroutine was abandoned with its event loop
+            self.done = True
+            return
+        self.loop.call_soon_threadsafe(self.go.set)
+
+    def isrunning(self):
+        return not self.done
+
+    def cancel(self):
+        self.cancelled = True
+        self.start()
+
+
+class Reservation(PoolJob):
+    """
+    Place in the queue of a Pool for cores used by the calling process
+    itself, see Pool.reserve().
+    """
+
+    def __init__(self, pool, ncores):
+        super(Reservation,self).__init__(pool, None, [], None, 1, ncores)
+        self.done = False
+
+    def start(self):
+        self.started.set()
+
+    def isrunning(self):
+        return not self.done
+
+
+class Pool(Platform):
+    """
+    Run platform for local simulations with a limited budget of cores.
+    At most Ncores cores are used at the same time; jobs submitted while
+    the pool is full are queued and started as running jobs finish.
+    Queued jobs are started in order of priority (lowest value first), and
+    in order of submission for equal priorities.
+    
+    Each job requests ranks*threads cores: in the "MPI" mode a job with Nproc
+    processes is started with mpirun and uses Nthreads OpenMP threads per
+    process, otherwise a job uses Nproc OpenMP threads. Queued jobs are
+    packed first-fit into the free cores, so that small jobs may start
+    before a larger job with higher priority which does not fit yet. To
+    avoid starving the larger job, it may be overtaken at most backfill
+    times, after which no more jobs are started until it fits.
+
+    submitjob() returns a PoolJob, which can be passed to jobstatus() and
+    Interface.waitforproc() just like the processes returned by Local.
+
+    Parameters:
+    Ncores (optional) : Total number of cores available to the pool.
+                        Defaults to the number of cores of the machine.
+    Nproc (optional) : Number of cores (MPI processes in the "MPI" mode)
+                        used by each job. If Nproc > 1, OpenMP will be
+                        used unless paral_in is given. Defaults to 1.
+    paral_in (optional) : Parallelization mode.
+    Nthreads (optional) : OpenMP threads per MPI process in the "MPI" mode.
+                        Defaults to 1.
+    pin (optional) : If True, every job is pinned to its own cores with
+                        os.sched_setaffinity (Linux only). Ncores is then
+                        limited to the cores this process may run on.
+    backfill (optional) : Number of times a queued job may be overtaken by
+                        jobs with lower priority. Defaults to Ncores; 0
+                        starts the jobs strictly in order.
+    """
+
+    # the queued and running jobs belong to the pool they were submitted to
+    transient = Platform.transient + ("lock", "queue", "running")
+
+    def __init__(self, Ncores = None, Nproc = 1, paral_in = None,
+                 Nthreads = 1, pin = False, backfill = None):
+        super(Pool,self).__init__("Pool")
+
+        if Ncores is None:
+            Ncores = os.cpu_count()
+        self.Ncores = Ncores
+        self.Nproc = Nproc
+        self.Nthreads = Nthreads
+        if paral_in is not None:
+            self.paral = paral_in
+        elif Nproc > 1:
+            self.paral = self.paral_modes["OMP"]
+            os.environ["OMP_NUM_THREADS"] = str(Nproc)
+        if backfill is None:
+            backfill = Ncores
+        self.backfill = backfill
+
+        self.pin = pin and hasattr(os, "sched_setaffinity")
+        if pin and not self.pin:
+            dbg.debug("WARNING: cpu affinity not supported, jobs are not pinned\n",
+                      dbg.verb_modes["verbose"], self)
+        if self.pin:
+            cpus = sorted(os.sched_getaffinity(0))
+            if len(cpus) < Ncores:
+                dbg.debug("WARNING: only " + str(len(cpus)) + " cores available "
+                          "for pinning, using " + str(len(cpus)) + " instead of " +
+                          str(Ncores) + "\n", dbg.verb_modes["verbose"], self)
+                self.Ncores = len(cpus)
+            self.freecpus = cpus[:self.Ncores]
+
+        self.counter = itertools.count()
         
+        # core usage integrated over time, for utilisation()
+        self.tstart = time.time()
+        self.tlast = self.tstart
+        self.coretime = 0.
+
+    def initsync(self):
+        super(Pool,self).initsync()
+        self.queue = []
+        self.running = []
+        self.lock = threading.RLock()
+
+    def request(self, Nproc = None, Nthreads = None):
+        '''Returns (ranks, threads) for a job with Nproc cores, or Nproc MPI
+        processes with Nthreads threads each in the "MPI" mode.
+        '''
+        if Nproc is None:
+            Nproc = self.Nproc
+        if Nthreads is None:
+            Nthreads = self.Nthreads
+        if self.paral == self.paral_modes["MPI"]:
+            return Nproc, Nthreads
+        return 1, Nproc
+
+    def command(self, job):
+        '''Returns (prog, args) which run job.'''
+        if self.paral == self.paral_modes["MPI"]:
+            return "mpirun", ["-np", str(job.ranks), job.prog] + list(job.args)
+        return job.prog, job.args
+
+    def environment(self, job):
+        env = dict(os.environ)
+        env["OMP_NUM_THREADS"] = str(job.threads)
+        return env
+
+    def submitjob(self, prog, args, dirpath, Nproc = None, wtime = None,
+                  priority = 0, Nthreads = None):
+        '''Queue the program prog for execution in dirpath, and start it
+        immediately if there are free cores. Returns a PoolJob.
+
+        priority (optional): jobs with lower values are started first.
+        Nthreads (optional): OpenMP threads per process in the "MPI" mode.
+        '''
+        ranks, threads = self.request(Nproc, Nthreads)
+        job = PoolJob(self, prog, args, dirpath, ranks, threads)
+        self.enqueue(job, priority)
+        dbg.debug("Queued " + str(prog) + " in " + str(dirpath) + " (" +
+                  str(self.queued()) + " waiting)\n",
+                  dbg.verb_modes["chatty"], self)
+        return job
+
+    def submitandwait(self, prog, args, dirpath, Nproc = None):
+        job = self.submitjob(prog, args, dirpath, Nproc)
+        job.wait()
+        return job
+
+    def enqueue(self, job, priority):
+        with self.lock:
+            heapq.heappush(self.queue, (priority, next(self.counter), job))
+        self.schedule()
+
+    @contextlib.contextmanager
+    def reserve(self, ncores = 1, priority = 0):
+        '''Reserve ncores cores of the pool for work done by the calling
+        process, see Platform.reserve(). The reservation is queued like a
+        job with the given priority.
+        '''
+        job = Reservation(self, ncores)
+        self.enqueue(job, priority)
+        job.started.wait()
+        try:
+            yield job.cpus
+        finally:
+            job.done = True
+            self.schedule()
+
+    def schedule(self):
+        '''Remove finished jobs from the pool and start queued jobs in the
+        free cores. A job requesting more cores than the pool has is
+        started when the pool is empty.
+        '''
+        with self.lock:
+            self.account()
+            running = []
+            for job in self.running:
+                if job.isrunning():
+                    running.append(job)
+                elif self.pin and job.cpus is not None:
+                    self.freecpus = sorted(self.freecpus + job.cpus)
+                    job.cpus = None
+            self.running = running
+            free = self.Ncores - self.usedcores()
+            
+            waiting = []
+            for entry in sorted(self.queue):
+                job = entry[2]
+                if len(self.running) > 0 and job.cores > free:
+                    waiting.append(entry)
+                    continue
+                if any([w[2].skipped >= self.backfill for w in waiting]):
+                    break
+                for w in waiting:
+                    w[2].skipped += 1
+                self.queue.remove(entry)
+                if self.pin:
+                    job.cpus = self.freecpus[:job.cores]
+                    self.freecpus = self.freecpus[job.cores:]
+                job.start()
+                self.running.append(job)
+                free -= job.cores
+            heapq.heapify(self.queue)
+
+    def account(self):
+        now = time.time()
+        self.coretime += self.usedcores()*(now - self.tlast)
+        self.tlast = now
+
+    def usedcores(self):
+        '''Returns the number of cores requested by the running jobs.'''
+        with self.lock:
+            return sum([j.cores for j in self.running])
+
+    def utilisation(self, average = False):
+        '''Returns the fraction of the Ncores cores used by running jobs (and
+        reservations). If average is True, returns the average fraction
+        since the pool was created.
+        '''
+        with self.lock:
+            self.account()
+            if not average:
+                return self.usedcores()/self.Ncores
+            elapsed = self.tlast - self.tstart
+            if elapsed <= 0:
+                return 0.
+            return self.coretime/(self.Ncores*elapsed)
+
+    def queued(self):
+        '''Returns the number of jobs waiting for free cores.'''
+        with self.lock:
+            return len(self.queue)
+
+    def jobstatus(self, proc):
+        if proc.poll()==None:
+            return True
+        else:
+            return False
+
+    def waitjob(self, proc):
+        proc.wait()
+
+    def dequeue(self, job):
+        '''Remove job from the queue. Returns False if it was not queued.'''
+        with self.lock:
+            for entry in self.queue:
+                if entry[2] is job:
+                    self.queue.remove(entry)
+                    heapq.heapify(self.queue)
+                    job.cancel()
+                    return True
+        return False
+
+    def killjob(self, job):
+        '''Remove job from the queue, or terminate it if it is running.'''
+        if self.dequeue(job):
+            return
+        if job.proc is not None:
+            job.proc.terminate()
+
+    async def submitjob_async(self, prog, args, dirpath, Nproc = None,
+                              wtime = None, priority = 0, Nthreads = None):
+        '''Coroutine which queues the program like submitjob(), runs it as
+        an asyncio subprocess once the pool has free cores, and returns the
+        finished process.
+        '''
+        ranks, threads = self.request(Nproc, Nthreads)
+        job = AsyncPoolJob(self, prog, args, dirpath, ranks, threads,
+                           asyncio.get_running_loop())
+        self.enqueue(job, priority)
+        try:
+            await job.go.wait()
+            if job.cancelled:
+                return None
+            prog, args = self.command(job)
+            job.proc = await su.dispatch_async(prog, args, dirpath,
+                                               env=self.environment(job),
+                                               cpus=job.cpus)
+            await job.proc.wait()
+        except asyncio.CancelledError:
+            # a task cancelled while waiting for cores leaves the queue
+            self.dequeue(job)
+            raise
+        finally:
+            job.done = True
+            self.schedule()
+        return job.proc
+
 class MPI(Platform):
     
     def __init__(self, logical = False):
@@ -184,6 +1246,7 @@ class MPI(Platform):
         self.paral = self.paral_modes["MPI"]
         #self.Nproc = psutil.cpu_count(logical=logical)
         self.Nproc = 1
+        self.Ncores = os.cpu_count()
         
     def submitjob(self, prog, args, dirpath, Nproc = None, wtime = None):
         if Nproc is None:
@@ -201,8 +1264,7 @@ class MPI(Platform):
         
     def submitandwait(self, prog,  args, dirpath, Nproc = None):
         proc = self.submitjob(prog, args, dirpath, Nproc)
-        while proc.poll() == None:
-            time.sleep(0.1)
+        proc.wait()
         return proc
     
     
@@ -211,3 +1273,18 @@ class MPI(Platform):
             return True
         else:
             return False
+
+    def waitjob(self, proc):
+        proc.wait()
+
+    async def submitjob_async(self, prog, args, dirpath, Nproc = None,
+                              wtime = None):
+        if Nproc is None:
+            Nproc = self.Nproc
+
+        progargs = ["-np", str(Nproc), prog]
+        [progargs.append(a) for a in args]
+
+        proc = await su.dispatch_async("mpirun", progargs, dirpath)
+        await proc.wait()
+        return proc
@@ -0,0 +1,83 @@
+'''
+Created on 18 Oct 2026
+
+@author: Martin Franckie
+
+Merit functions of sweeps over bias and frequency, computed with numpy on
+whole columns of results (such as the fields of the array returned by
+aftershoq.interface.inegf.readnegft()), for use by all interfaces.
+
+The points of a sweep are grouped into segments of equal bias (eFd), which
+are the runs of consecutive points with the same eFd, in the order of the
+output of the simulation programs. Within a segment, omega is assumed to
+increase.
+'''
+
+import numpy as np
+
+
+def segments(efd):
+    '''Returns (starts, ids): the index of the first point of each segment
+    of equal bias in the array efd, and the segment index of each point.
+    '''
+    efd = np.asarray(efd)
+    new = np.ones(len(efd), dtype = bool)
+    new[1:] = efd[1:] != efd[:-1]
+    return np.flatnonzero(new), np.cumsum(new) - 1
+
+
+def maxgainj(gain, j):
+    '''Returns the maximum of gain/j over all points.'''
+    return np.max(np.asarray(gain)/np.asarray(j))
+
+
+def gainintegrals(efd, omega, gain):
+    '''Returns the integral of the gain over omega for each segment of equal
+    bias, as the sum of the gain times the spacing of the first two omegas.
+    '''
+    gain = np.asarray(gain)
+    starts, _ = segments(efd)
+    domega = omega[1] - omega[0]
+    return np.add.reduceat(gain, starts)*domega
+
+
+def gainintegral(efd, omega, gain):
+    '''Returns the largest integral of the gain over omega of all biases,
+    scaled by the maximum of the absolute gain, to avoid favouring sharp
+    narrow peaks.
+    '''
+    return np.max(gainintegrals(efd, omega, gain))/np.max(np.abs(gain))
+
+
+def gainwidths(efd, omega, gain, losses = 0.):
+    '''Returns the width of the gain spectrum for each segment of equal bias:
+    the distance in omega between the first and the last crossing of the
+    gain with the level losses, interpolated linearly between the points.
+    The width is 0 for segments with less than two crossings, or with
+    negative gain at all omegas.
+    '''
+    omega = np.asarray(omega, dtype = float)
+    gain = np.asarray(gain, dtype = float)
+    starts, ids = segments(efd)
+    widths = np.zeros(len(starts))
+
+    # crossings between points k and k+1 of the same segment
+    g = gain - losses
+    k = np.flatnonzero((ids[1:] == ids[:-1]) & (g[:-1]*g[1:] < 0))
+    if len(k) > 0:
+        om = omega[k] - g[k]*(omega[k+1] - omega[k])/(g[k+1] - g[k])
+        seg = ids[k]
+        first, _ = segments(seg)
+        count = np.diff(np.append(first, len(seg)))
+        widths[seg[first]] = np.where(count > 1,
+                                      np.maximum.reduceat(om, first) -
+                                      np.minimum.reduceat(om, first), 0.)
+    widths[np.maximum.reduceat(gain, starts) < 0] = 0.
+    return widths
+
+
+def gainfwhm(efd, omega, gain, losses = 0.):
+    '''Returns the largest width of the gain spectrum of all biases, see
+    gainwidths().
+    '''
+    return np.max(gainwidths(efd, omega, gain, losses))
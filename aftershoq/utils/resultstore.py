@@ -0,0 +1,311 @@
+'''
+Created on 18 Oct 2026
+
+@author: Martin Franckie
+
+Stores of the results of evaluated structures, keyed by the structure id.
+A result record is a dictionary with the keys:
+
+sid:     structure id (string), as in the first column of results.log
+merit:   merit function value (string, may be "NO CONV" or "ERROR")
+widths:  list of the layer widths
+dopings: list of [zi, zf, nvol] for each doping region
+x:       list of the alloy compositions of the layers (None if not an alloy)
+censored: True if the merit is a lower bound, from a simulation which was
+         stopped early (see aftershoq.interface.inegf.NegftMonitor)
+
+The legacy results.log format has one line per record:
+sid merit widths dopings x [# censored]
+where the censored flag is a comment, so that the columns are unchanged.
+'''
+
+import aftershoq.utils.debug as dbg
+import threading
+import sqlite3
+import pathlib
+import os
+
+header = '# Results for structures:\nID | merit | \
+            N times layer width | Ndop times (zi, zf, nvol) | N times x \n'
+
+
+def structrecord(structure, sid = None):
+    '''Returns the result record of the Structure structure, with its merit
+    in structure.merit. sid defaults to structure.sid.
+    '''
+    if sid is None:
+        sid = structure.sid
+    return {"sid": str(sid),
+            "merit": str(getattr(structure, "merit", None)),
+            "widths": [layer.width for layer in structure.layers],
+            "dopings": [list(doping) for doping in structure.dopings],
+            "x": [layer.material.x for layer in structure.layers],
+            "censored": bool(getattr(structure, "censored", False))}
+
+
+def formatrecord(record):
+    '''Returns the line of results.log for record.'''
+    line = record["sid"] + " " + record["merit"] + " " + formatfields(record)
+    if record.get("censored"):
+        line += "# censored"
+    return line + "\n"
+
+
+def formatfields(record):
+    '''Returns the columns of results.log after the merit for record.'''
+    if record.get("fields") is not None:
+        return record["fields"]
+    line = ""
+    for w in record["widths"]:
+        line += str(w) + " "
+    for doping in record["dopings"]:
+        for val in doping:
+            line += str(val) + " "
+    for x in record["x"]:
+        line += str(x) + " "
+    return line
+
+
+def parsefields(fields, Nl, Ndop):
+    '''Returns (widths, dopings, x) from the columns of a line of results.log
+    after the merit, for Nl layers and Ndop doping regions.
+    '''
+    fields = fields.split()
+    widths = [float(fields[il]) for il in range(Nl)]
+    dopings = [[float(fields[Nl + idop*3 + i]) for i in range(3)]
+               for idop in range(Ndop)]
+    x = []
+    for il in range(Nl):
+        try:
+            x.append(float(fields[il + Ndop*3 + Nl]))
+        except(ValueError):
+            x.append(None) # x = 'None'
+    return widths, dopings, x
+
+
+class ResultStore(object):
+    '''
+    Base class for result stores. Derived classes implement add(), get() and
+    records(); export() writes the legacy results.log from records().
+
+    Parameters:
+    path: Directory of the results.
+    readonly (optional): If True, nothing is written to path.
+    '''
+
+    logname = "results.log"
+
+    def __init__(self, path, readonly = False):
+        self.path = str(path)
+        self.readonly = readonly
+
+    @classmethod
+    def exists(cls, path):
+        '''Returns True if there are stored (or legacy) results in path.'''
+        return os.path.exists(os.path.join(str(path), cls.logname))
+
+    def add(self, records):
+        '''Add the list of result records. Records of a sid which is already
+        stored are ignored, as the first result of a structure is kept.
+        '''
+        pass
+
+    def get(self, sid, Nl = None, Ndop = None):
+        '''Returns the record of structure id sid, or None if not found.
+        Nl and Ndop (the number of layers and doping regions) are needed to
+        split the fields of records imported from a results.log.
+        '''
+        pass
+
+    def getmerit(self, sid):
+        '''Returns the stored merit of structure id sid, or None.'''
+        record = self.get(sid)
+        if record is None:
+            return None
+        return record["merit"]
+
+    def records(self, Nl = None, Ndop = None):
+        '''Returns the list of all records, in the order they were added.'''
+        pass
+
+    def export(self, filename = None):
+        '''Write all records to filename (defaults to path/results.log) in
+        the legacy results.log format.
+        '''
+        if filename is None:
+            filename = os.path.join(self.path, self.logname)
+        with open(filename, 'w') as f:
+            f.write(header)
+            [f.write(formatrecord(r)) for r in self.records()]
+
+    def importlog(self, filename = None):
+        '''Add the records of the results file filename (defaults to
+        path/results.log) in the legacy format.
+        '''
+        if filename is None:
+            filename = os.path.join(self.path, self.logname)
+        records = []
+        with open(filename) as f:
+            for line in f:
+                line = line.split(None, 2)
+                if len(line) < 2 or line[0].startswith("#") or line[1] == "|":
+                    continue # comment, empty line or header
+                if line[1] == "NO" and len(line) > 2 and \
+                    line[2].startswith("CONV"):
+                    # the merit "NO CONV" contains a space
+                    line = [line[0], "NO CONV", line[2][4:]]
+                (fields, _, comment) = line[2].partition("#") \
+                    if len(line) > 2 else ("", "", "")
+                records.append({"sid": line[0], "merit": line[1],
+                                "fields": " ".join(fields.split()),
+                                "widths": None,
+                                "censored": "censored" in comment.split()})
+        self.add(records)
+        dbg.debug("Imported " + str(len(records)) + " results from " +
+                  filename + "\n", dbg.verb_modes["verbose"], self)
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(ResultStore):
+    '''
+    Result store in the SQLite database path/results.db. The merits are
+    stored in the table results (indexed by sid), the layers and dopings of
+    each structure in the tables layers and dopings. When the database is
+    created, the records of an existing path/results.log are imported.
+    A read-only store opens an existing database read-only, or else imports
+    path/results.log into a database in memory.
+    '''
+
+    dbname = "results.db"
+
+    schema = ["CREATE TABLE IF NOT EXISTS results (sid TEXT PRIMARY KEY, "
+              "merit TEXT, fields TEXT, censored INTEGER DEFAULT 0)",
+              "CREATE TABLE IF NOT EXISTS layers (sid TEXT, il INTEGER, "
+              "width REAL, x REAL, PRIMARY KEY (sid, il))",
+              "CREATE TABLE IF NOT EXISTS dopings (sid TEXT, idop INTEGER, "
+              "zi REAL, zf REAL, nvol REAL, PRIMARY KEY (sid, idop))"]
+
+    def __init__(self, path, readonly = False):
+        super(SQLiteStore,self).__init__(path, readonly)
+
+        dbfile = os.path.join(self.path, self.dbname)
+        new = not os.path.exists(dbfile)
+        self.lock = threading.Lock()
+        if readonly and not new:
+            uri = pathlib.Path(dbfile).absolute().as_uri() + "?mode=ro"
+            self.db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self.columns = self.resultcolumns()
+            return
+        if readonly:
+            dbfile = ":memory:"
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        with self.lock, self.db:
+            [self.db.execute(s) for s in self.schema]
+            if "censored" not in self.resultcolumns():
+                # database of an earlier version
+                self.db.execute("ALTER TABLE results ADD COLUMN "
+                                "censored INTEGER DEFAULT 0")
+        self.columns = self.resultcolumns()
+        if new and os.path.exists(os.path.join(self.path, self.logname)):
+            self.importlog()
+
+    def resultcolumns(self):
+        '''Returns the columns of the table results to read, with 0 for the
+        censored flag of read-only databases of an earlier version.
+        '''
+        names = [c[1] for c in self.db.execute("PRAGMA table_info(results)")]
+        if "censored" not in names:
+            return "sid, merit, fields, 0"
+        return "sid, merit, fields, censored"
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(str(path), cls.dbname)) or \
+            super(SQLiteStore,cls).exists(path)
+
+    def add(self, records):
+        results = []; layers = []; dopings = []
+        for r in records:
+            sid = str(r["sid"])
+            censored = int(bool(r.get("censored")))
+            if r.get("widths") is None:
+                results.append((sid, r["merit"], r.get("fields", ""),
+                                censored))
+                continue
+            # keep the legacy columns, to export imported and new records alike
+            results.append((sid, r["merit"], formatfields(r), censored))
+            for il in range(len(r["widths"])):
+                layers.append((sid, il, r["widths"][il], tofloat(r["x"][il])))
+            for idop in range(len(r["dopings"])):
+                dopings.append((sid, idop) + tuple(r["dopings"][idop]))
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO results (sid, merit, "
+                                "fields, censored) VALUES (?, ?, ?, ?)",
+                                results)
+            self.db.executemany("INSERT OR IGNORE INTO layers "
+                                "VALUES (?, ?, ?, ?)", layers)
+            self.db.executemany("INSERT OR IGNORE INTO dopings "
+                                "VALUES (?, ?, ?, ?, ?)", dopings)
+
+    def getmerit(self, sid):
+        with self.lock:
+            row = self.db.execute("SELECT merit FROM results WHERE sid = ?",
+                                  (str(sid),)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get(self, sid, Nl = None, Ndop = None):
+        with self.lock:
+            row = self.db.execute("SELECT " + self.columns + " FROM results "
+                                  "WHERE sid = ?", (str(sid),)).fetchone()
+            if row is None:
+                return None
+            layers = self.db.execute("SELECT width, x FROM layers WHERE "
+                                     "sid = ? ORDER BY il", (row[0],)).fetchall()
+            dopings = self.db.execute("SELECT zi, zf, nvol FROM dopings WHERE "
+                                      "sid = ? ORDER BY idop", (row[0],)).fetchall()
+        return self.makerecord(row, layers, dopings, Nl, Ndop)
+
+    def records(self, Nl = None, Ndop = None):
+        with self.lock:
+            rows = self.db.execute("SELECT " + self.columns + " FROM results "
+                                   "ORDER BY rowid").fetchall()
+            layers = {}; dopings = {}
+            for l in self.db.execute("SELECT sid, width, x FROM layers "
+                                     "ORDER BY sid, il"):
+                layers.setdefault(l[0], []).append(l[1:])
+            for d in self.db.execute("SELECT sid, zi, zf, nvol FROM dopings "
+                                     "ORDER BY sid, idop"):
+                dopings.setdefault(d[0], []).append(d[1:])
+        return [self.makerecord(row, layers.get(row[0], []),
+                                dopings.get(row[0], []), Nl, Ndop)
+                for row in rows]
+
+    def makerecord(self, row, layers, dopings, Nl, Ndop):
+        record = {"sid": row[0], "merit": row[1], "fields": row[2],
+                  "censored": bool(row[3])}
+        if len(layers) > 0:
+            record["widths"] = [l[0] for l in layers]
+            record["x"] = [l[1] for l in layers]
+            record["dopings"] = [list(d) for d in dopings]
+        elif Nl is not None and Ndop is not None:
+            (record["widths"], record["dopings"],
+             record["x"]) = parsefields(row[2], Nl, Ndop)
+        else:
+            record["widths"] = None
+        return record
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def tofloat(x, default = None):
+    '''Returns x as a float, or default if it is not a number.'''
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return default
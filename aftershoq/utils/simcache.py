@@ -0,0 +1,222 @@
+'''
+Created on 18 Oct 2026
+
+@author: Martin Franckie
+
+Content-addressed cache of simulation outputs. The output directory of a
+structure is stored under a key, which is the SHA-256 hash of everything the
+simulation depends on: the layers (widths, materials, interface roughness)
+and dopings of the structure, the numerical parameters, and the identity
+(path, size and modification time) of the model programs. A structure which
+has been simulated before, in any directory or campaign, is restored from
+the cache instead of being run again.
+
+The cache directory contains one directory per key, with the stored output
+in key/data and the metadata (size, last use and information such as the
+merit) in key/meta.json. When the total size of the cache exceeds the
+limit, the least recently used entries are removed.
+'''
+
+import aftershoq.utils.systemutil as su
+import aftershoq.utils.debug as dbg
+import numbers
+import threading
+import hashlib
+import shutil
+import json
+import time
+import os
+
+
+def canonical(obj):
+    '''Returns obj as a JSON serializable object, in which dictionaries are
+    sorted and floats are rounded to 12 significant digits, so that equal
+    inputs always give the same key.
+    '''
+    if isinstance(obj, dict):
+        return [[str(k), canonical(obj[k])] for k in sorted(obj, key=str)]
+    if isinstance(obj, (list, tuple)):
+        return [canonical(o) for o in obj]
+    if isinstance(obj, bool) or obj is None or isinstance(obj, str):
+        return obj
+    if isinstance(obj, numbers.Integral):
+        return int(obj)
+    if isinstance(obj, numbers.Real):
+        return format(float(obj), ".12g")
+    return str(obj)
+
+
+def structureinputs(structure):
+    '''Returns the inputs of a simulation of structure: its layers, as
+    [width, eta, lam, material name, x, material parameters], its dopings
+    and its lattice temperature.
+    '''
+    layers = [[l.width, l.eta, l.lam, l.material.name, l.material.x,
+               l.material.params] for l in structure.layers]
+    return {"layers": layers,
+            "dopings": [list(d) for d in structure.dopings],
+            "TL": getattr(structure, "TL", None)}
+
+
+def programidentity(prog):
+    '''Returns [path, size, modification time] of the program prog, or
+    [prog] if it cannot be found.
+    '''
+    path = shutil.which(prog) or prog
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [prog]
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+def dirsize(path):
+    '''Returns the total size of the files in the tree path.'''
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class SimCache(object):
+    '''
+    Content-addressed, size bounded cache of simulation output directories.
+
+    Parameters:
+    path: Directory of the cache. It can be shared by several campaigns
+        (but not by several processes writing at the same time).
+    maxsize (optional): Maximum total size of the cached outputs in bytes.
+        Defaults to 10 GB.
+    link (optional): If True, restored outputs are hard links to the cached
+        files (falling back to copies across file systems). This is faster
+        and saves space, but a program modifying the restored files in
+        place also modifies the cache. Defaults to False (copies).
+    '''
+
+    metaname = "meta.json"
+    dataname = "data"
+
+    def __init__(self, path, maxsize = 10*2**30, link = False):
+        self.path = os.path.abspath(str(path))
+        self.maxsize = maxsize
+        self.link = link
+        self.lock = threading.Lock()
+        su.mkdir(self.path)
+
+        # key: [size, last use]
+        self.entries = {}
+        for key in os.listdir(self.path):
+            if key.startswith("."):
+                continue # left over by an interrupted store()
+            meta = self.readmeta(key)
+            if meta is not None:
+                self.entries[key] = [meta["size"], meta["used"]]
+
+    def key(self, structure, numpar, programs = [], extra = None):
+        '''Returns the key of the simulation of the Structure structure, with
+        the numerical parameters numpar, run by the list of programs.
+        extra may hold further (JSON serializable) inputs of the model.
+        '''
+        inputs = {"structure": structureinputs(structure),
+                  "numpar": numpar,
+                  "programs": [programidentity(p) for p in programs],
+                  "extra": extra}
+        data = json.dumps(canonical(inputs), separators=(",", ":"))
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def readmeta(self, key):
+        try:
+            with open(os.path.join(self.path, key, self.metaname)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def writemeta(self, path, meta):
+        with open(os.path.join(path, self.metaname), 'w') as f:
+            json.dump(meta, f)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def size(self):
+        '''Returns the total size of the cached outputs in bytes.'''
+        with self.lock:
+            return sum([e[0] for e in self.entries.values()])
+
+    def restore(self, key, dest):
+        '''Restore the output stored under key into the directory dest, and
+        return the information stored with it (a dictionary), or None if key
+        is not in the cache.
+        '''
+        with self.lock:
+            if key not in self.entries:
+                return None
+            meta = self.readmeta(key)
+            if meta is None:
+                del self.entries[key]
+                return None
+            copy = su.linkorcopy if self.link else shutil.copy2
+            shutil.copytree(os.path.join(self.path, key, self.dataname),
+                            str(dest), copy_function = copy,
+                            dirs_exist_ok = True)
+            meta["used"] = time.time()
+            self.writemeta(os.path.join(self.path, key), meta)
+            self.entries[key][1] = meta["used"]
+        dbg.debug("Restored " + key[:12] + " from cache into " + str(dest) +
+                  "\n", dbg.verb_modes["chatty"], self)
+        return meta["info"]
+
+    def store(self, key, src, info = None):
+        '''Store a copy of the output directory src under key, together with
+        the dictionary info (such as the merit). An existing entry is kept.
+        Least recently used entries are removed to keep the cache within
+        maxsize.
+        '''
+        with self.lock:
+            if key in self.entries:
+                return
+            tmp = os.path.join(self.path, ".tmp-" + key + "-" + str(os.getpid()))
+            shutil.rmtree(tmp, ignore_errors = True)
+            shutil.copytree(str(src), os.path.join(tmp, self.dataname))
+            meta = {"size": dirsize(tmp), "used": time.time(),
+                    "info": info or {}}
+            self.writemeta(tmp, meta)
+            try:
+                os.rename(tmp, os.path.join(self.path, key))
+            except OSError:
+                # stored by another process in the meantime
+                shutil.rmtree(tmp, ignore_errors = True)
+                return
+            self.entries[key] = [meta["size"], meta["used"]]
+            self.evict()
+        dbg.debug("Stored " + str(src) + " in cache as " + key[:12] + "\n",
+                  dbg.verb_modes["chatty"], self)
+
+    def evict(self):
+        '''Remove the least recently used entries while the cache is larger
+        than maxsize. Called with self.lock held.
+        '''
+        total = sum([e[0] for e in self.entries.values()])
+        for key in sorted(self.entries, key=lambda k: self.entries[k][1]):
+            if total <= self.maxsize:
+                break
+            total -= self.entries.pop(key)[0]
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors = True)
+            dbg.debug("Evicted " + key[:12] + " from cache\n",
+                      dbg.verb_modes["chatty"], self)
+
+    def __getstate__(self):
+        # the lock cannot be pickled, and the entries are read again from
+        # the cache directory by the copy
+        return {"path": self.path, "maxsize": self.maxsize, "link": self.link}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["maxsize"], state["link"])
@@ -9,7 +9,9 @@ programs.
 
 from subprocess import call, Popen, PIPE
 import os
+import shutil
 import time
+import asyncio
 import aftershoq.utils.debug as dbg
 from tempfile import TemporaryFile as tmp
 
@@ -48,12 +50,24 @@ def abspath(path):
     return abspath
 
 
+def linkorcopy(src, dst):
+    '''Make dst a hard link to the file src, or a copy of it if src cannot
+    be linked (for instance on another file system). An existing dst is
+    replaced.'''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
 def waitforproc(proc,delay = 0.1):
     '''Wait for the process proc to finish. Sleep with delay seconds.'''
     while proc.poll() == None:
         time.sleep()
 
-def dispatch(prog,args,dirpath=None, infile = None, outfile = None, errfile = None):
+def dispatch(prog,args,dirpath=None, infile = None, outfile = None, errfile = None,
+             env = None, cpus = None):
     '''Dispatch program prog with arguments args.
 
     Optional parameters:
@@ -61,6 +75,10 @@ def dispatch(prog,args,dirpath=None, infile = None, outfile = None, errfile = No
     infile:  File with inputs to the program. Use subprocess.PIPE for input stream.
     outfile: File for program output. Use subprocess.PIPE for output stream.
     errfile: File for program output. Use subprocess.PIPE for output stream.
+    env:     Environment of the program, defaults to the current environment.
+    cpus:    List of cpu ids the program (and its threads and children) is
+             restricted to, see affinity(). Requires os.sched_setaffinity
+             (Linux).
 
     Returns the Popen() process.
 
@@ -83,6 +101,10 @@ def dispatch(prog,args,dirpath=None, infile = None, outfile = None, errfile = No
         for a in args:
             progargs.append(a)
 
+    pin = affinity(cpus)
+    if len(pin) > 0:
+        progargs = pin + ([progargs] if isinstance(progargs, str) else progargs)
+
     if dirpath is None:
         dirpath = "./"
 
@@ -90,9 +112,70 @@ def dispatch(prog,args,dirpath=None, infile = None, outfile = None, errfile = No
                dbg.verb_modes["chatty"])
 
     process=Popen(progargs,cwd=dirpath,close_fds=True,stdout=outfile,stderr=errfile,stdin=infile,
-                  universal_newlines=True)
+                  universal_newlines=True,env=env)
+    if cpus is not None and len(pin) == 0:
+        setaffinity(process.pid, cpus)
 
     dbg.debug(  " with pid="+str(process.pid)+" >>>>\n" ,
                 dbg.verb_modes["chatty"])
     dbg.flush()
     return process
+
+def affinity(cpus):
+    '''Returns the command line prefix which restricts a program (and its
+    threads and children) to the cpu ids in cpus, using taskset. Returns []
+    if cpus is None or taskset is not available, in which case the affinity
+    is set by setaffinity() once the program has started (children it has
+    started before are not restricted).
+
+    A preexec_fn is not used, as it is unsafe in processes with threads,
+    such as the watcher threads of the platforms.
+    '''
+    if cpus is None or shutil.which("taskset") is None:
+        return []
+    return ["taskset", "-c", ",".join([str(c) for c in sorted(cpus)])]
+
+def setaffinity(pid, cpus):
+    '''Restrict the running process pid to the cpu ids in cpus.'''
+    try:
+        os.sched_setaffinity(pid, set(cpus))
+    except OSError as e:
+        # the program may already have finished
+        dbg.debug("Could not set the affinity of " + str(pid) + ": " +
+                  str(e) + "\n", dbg.verb_modes["verbose"])
+
+async def dispatch_async(prog,args,dirpath=None, infile = None, outfile = None, errfile = None,
+                         env = None, cpus = None):
+    '''Coroutine version of dispatch(), which starts the program prog with
+    arguments args as an asyncio subprocess. The optional parameters are the
+    same as for dispatch().
+
+    Returns the asyncio.subprocess.Process, whose wait() coroutine returns
+    when the program has finished without blocking the event loop.
+    '''
+
+    if infile is None:
+        infile = tmp()
+    if outfile is None:
+        outfile = tmp()
+    if errfile is None:
+        errfile = tmp()
+
+    if dirpath is None:
+        dirpath = "./"
+
+    dbg.debug( "<<<< Dispatching program (async): " + str([prog] + list(args)) +
+               " from " + dirpath, dbg.verb_modes["chatty"])
+
+    pin = affinity(cpus)
+    progargs = pin + [prog] + list(args)
+    process = await asyncio.create_subprocess_exec(*progargs, cwd=dirpath,
+                                                   close_fds=True, stdout=outfile,
+                                                   stderr=errfile, stdin=infile,
+                                                   env=env)
+    if cpus is not None and len(pin) == 0:
+        setaffinity(process.pid, cpus)
+
+    dbg.debug(  " with pid="+str(process.pid)+" >>>>\n" ,
+                dbg.verb_modes["chatty"])
+    return process
@@ -0,0 +1,110 @@
+'''
+Created on 18 Oct 2026
+
+@author: Martin Franckie
+
+Warm starts of self-consistent simulations from the nearest previously
+converged structure. Neighbouring structures of an optimization converge to
+similar solutions, so that a simulation started from the converged state of
+a neighbour (for NEGF, its eins files) needs fewer iterations than one
+started from scratch.
+'''
+
+import aftershoq.utils.debug as dbg
+import numpy as np
+import threading
+
+
+class WarmStart(object):
+    '''
+    Index of converged structures, for finding the nearest neighbour of a
+    new structure, and statistics of the warm and cold started runs.
+
+    Parameters:
+    sgenerator (optional): Sgenerator whose parameter space is used for the
+        distance between structures, each parameter scaled by its range
+        (Sgenerator.dparams). Without it, the distance is computed from the
+        layer widths and alloy compositions.
+    maxdist (optional): Neighbours further away than maxdist are not used.
+        Defaults to no limit.
+    '''
+
+    def __init__(self, sgenerator = None, maxdist = None):
+        self.sgenerator = sgenerator
+        self.maxdist = maxdist
+        self.lock = threading.Lock()
+        self.coordlist = []
+        self.sources = []
+        self.sids = []
+        # wall times of the runs: "warm", "cold", and "failed" warm starts
+        self.times = {"warm": [], "cold": [], "failed": []}
+
+    def coords(self, structure):
+        '''Returns the coordinates of structure in parameter space.'''
+        if self.sgenerator is not None:
+            coords = np.array(self.sgenerator.coords_from_struct(structure)[0],
+                              dtype = float)
+            scale = np.array(self.sgenerator.dparams, dtype = float)
+            return coords/np.where(scale > 0, scale, 1)
+        coords = [l.width for l in structure.layers]
+        coords += [l.material.x for l in structure.layers
+                   if l.material.x is not None]
+        return np.array(coords, dtype = float)
+
+    def add(self, structure, source):
+        '''Add the converged structure, which can seed new runs from source
+        (for instance the directory of its converged state).
+        '''
+        with self.lock:
+            self.coordlist.append(self.coords(structure))
+            self.sources.append(source)
+            self.sids.append(structure.sid)
+
+    def nearest(self, structure):
+        '''Returns (source, distance) of the converged structure nearest to
+        structure (other than structure itself), or None if there is none
+        within maxdist.
+        '''
+        x = self.coords(structure)
+        with self.lock:
+            candidates = [i for i in range(len(self.sids))
+                          if self.sids[i] != structure.sid]
+            if len(candidates) == 0:
+                return None
+            dist = np.linalg.norm(np.array([self.coordlist[i]
+                                            for i in candidates]) - x, axis=1)
+        i = np.argmin(dist)
+        if self.maxdist is not None and dist[i] > self.maxdist:
+            return None
+        return self.sources[candidates[i]], dist[i]
+
+    def record(self, kind, walltime):
+        '''Record the wall time (s) of a finished run. kind is "warm" or
+        "cold" for converged runs, and "failed" for warm starts which did
+        not converge (and were run again from a cold start).
+        '''
+        with self.lock:
+            self.times[kind].append(walltime)
+
+    def report(self):
+        '''Returns a dictionary with the number of runs and mean wall time
+        of each kind, and the wall time saved by the warm starts, estimated
+        as the mean time of the cold starts for each warm start, minus the
+        time of the warm starts and the failed ones. Note that this includes
+        the time spent waiting in the queue of batch systems.
+        '''
+        with self.lock:
+            times = {k: list(v) for k, v in self.times.items()}
+        report = {}
+        for kind in times:
+            report["N" + kind] = len(times[kind])
+            report[kind] = np.mean(times[kind]) if len(times[kind]) > 0 \
+                else None
+        if report["cold"] is None:
+            report["saved"] = None
+        else:
+            report["saved"] = report["cold"]*len(times["warm"]) - \
+                sum(times["warm"]) - sum(times["failed"])
+        dbg.debug("Warm starts: " + str(report) + "\n",
+                  dbg.verb_modes["verbose"], self)
+        return report
@@ -0,0 +1,63 @@
+# test parallel evaluation of merit functions in Python
+
+from aftershoq.numerics.evaluator import Evaluator
+from aftershoq.numerics import Paraopt, Gaussopt
+from aftershoq.interface import NDtestfunc
+from aftershoq.utils import HilbertUtil
+from hilbert_curve.hilbert import HilbertCurve
+import numpy as np
+
+
+def test_evaluator_processes_and_threads():
+
+    model = NDtestfunc(2, function='rastrigin')
+    xs = [np.random.random(2) for _ in range(20)]
+    serial = [model.getMerit(x) for x in xs]
+
+    with Evaluator(model.getMerit, 4) as ev:
+        assert not ev.threads
+        assert ev.map(xs) == serial
+
+    # lambdas cannot be pickled, and are evaluated in threads
+    with Evaluator(lambda x: model.getMerit(x), 4) as ev:
+        assert ev.threads
+        assert ev.map(xs) == serial
+
+
+def test_paraopt_minimize_parameters():
+
+    ND = 2
+    model = NDtestfunc(ND)
+    hutil = HilbertUtil(HilbertCurve(5, ND))
+    x0 = [0., hutil.imax/2., float(hutil.imax)]
+    y0 = [-float(model.getMerit(hutil.interp_coords_from_dist(d)/float(2**hutil.p)))
+          for d in x0]
+    opt = Paraopt(tolerance=0.01*hutil.imax, r=1.5, maxiter=20, procmax=4,
+                  x0=x0, y0=y0)
+
+    opt.minimize_parameters(model, hutil)
+    assert opt.converged != 0
+    assert len(opt.x) > len(x0)
+
+
+def test_gaussopt_minimize_parameters():
+
+    import random
+
+    ND = 2
+    random.seed(1)
+    model = NDtestfunc(ND)
+    hutil = HilbertUtil(HilbertCurve(5, ND))
+    x0 = list(np.linspace(0., hutil.imax, 5))
+    y0 = [-float(model.getMerit(hutil.interp_coords_from_dist(d)/float(2**hutil.p)))
+          for d in x0]
+    opt = Gaussopt(tolerance=0.01*hutil.imax, maxiter=10, procmax=2,
+                   x0=x0, y0=y0, l=hutil.imax/8., l_max=hutil.imax/4.,
+                   fitprocs=1)
+    opt.rng = np.random.default_rng(1)
+
+    opt.minimize_parameters(model, hutil)
+    assert opt.converged != 0
+    assert len(opt.x) > len(x0)
+    # new points are evaluated inside the ends of the curve
+    assert all([2 <= x <= hutil.imax - 2 for x in np.squeeze(opt.x)[5:]])
@@ -0,0 +1,136 @@
+# test the Gaussian process optimizer Gaussopt
+
+from aftershoq.numerics.gaussopt import Gaussopt
+import numpy as np
+
+
+def fulcholesky(gopt):
+    return np.linalg.cholesky(gopt.kernel(gopt.x, gopt.x, gopt.theta))
+
+
+def test_cholesky_update():
+
+    x = np.linspace(0, 4095, 9)
+    gopt = Gaussopt(1, 10, 3, list(x), list(np.sin(x/500.)), sigma = 1.,
+                    l = 400., sigma_noise = 0.1)
+    L = gopt.cholesky()
+    assert np.allclose(L, fulcholesky(gopt))
+
+    # a batch of new points extends the factor
+    newx = [100., 1500., 3000.]
+    gopt.addpoints(newx, list(np.sin(np.array(newx)/500.)))
+    L = gopt.cholesky()
+    assert np.shape(L) == (12, 12)
+    assert np.allclose(L, fulcholesky(gopt))
+
+    # small changes of theta keep the factor, large ones recompute it
+    gopt.theta = [1.0000001, 400., 0.1]
+    assert gopt.cholesky() is L and gopt.theta[0] == 1.
+    gopt.theta = [2., 400., 0.1]
+    assert np.allclose(gopt.cholesky(), fulcholesky(gopt))
+    assert gopt.Ltheta[0] == 2.
+
+
+def test_evidence():
+
+    x = np.linspace(0, 4095, 17)
+    gopt = Gaussopt(1, 10, 2, list(x), list(np.sin(x/500.)),
+                    sigma_noise = 0.3)
+    args = (gopt.x, gopt.y)
+    theta = np.array([4., 300., 0.3])
+    value, grad = gopt.evidence(theta, *args)
+
+    # shared factorization of separate calls
+    assert gopt.logPosterior(theta, *args) == value
+    assert gopt.gradLogPosterior(theta, *args) is grad
+
+    h = 1e-6*theta
+    num = [(gopt.logPosterior(theta + h*np.eye(3)[i], *args) - value)/h[i]
+           for i in range(3)]
+    assert np.allclose(grad, num, rtol = 1e-4)
+
+
+def test_fit():
+
+    x = np.linspace(0, 4095, 9)
+    gopt = Gaussopt(1, 10, 2, list(x), list(np.sin(x/500.)), sigma = 1.,
+                    l = 400., sigma_noise = 0.1, l_max = 1000., fitprocs = 1)
+    bounds = gopt.bounds(gopt.theta)
+    assert bounds[1] == (0.5*4095/8, 1000.)
+
+    theta = gopt.fit(gopt.x, gopt.y)
+    assert all(b[0] <= t <= (b[1] or np.inf) for t, b in zip(theta, bounds))
+    assert gopt.logPosterior(theta, gopt.x, gopt.y) < \
+        gopt.logPosterior(gopt.theta, gopt.x, gopt.y)
+
+    # without time left, the previous theta is kept
+    gopt.fitbudget = -1.
+    assert np.allclose(gopt.fit(gopt.x, gopt.y), gopt.theta)
+
+
+def test_variance_chunks():
+
+    x = np.linspace(0, 4095, 9)
+    y = list(np.sin(x/500.))
+    full = Gaussopt(1, 10, 2, list(x), y, sigma = 1., l = 400.,
+                    sigma_noise = 0.1, fullcov = True)
+    full.evalmeancov()
+
+    gopt = Gaussopt(1, 10, 2, list(x), y, sigma = 1., l = 400.,
+                    sigma_noise = 0.1, utility = lambda mean, var: var)
+    assert gopt.fullcov
+    gopt.fullcov = False
+    gopt.chunkelements = 30 # chunks of 3 trial points
+    gopt.evalmeancov()
+    assert gopt.cov is None and len(gopt.Kpp) == 0
+    assert np.allclose(gopt.mean, full.mean)
+    assert np.allclose(gopt.var, np.diag(full.cov))
+    assert np.allclose(gopt.u, gopt.var)
+
+
+def test_fit_threads():
+
+    import pickle
+    x = np.linspace(0, 4095, 9)
+    gopt = Gaussopt(1, 10, 2, list(x), list(np.sin(x/500.)), sigma = 1.,
+                    l = 400., sigma_noise = 0.1, nstarts = 2)
+    assert gopt.fitprocs <= 2
+
+    # the threads of the fit are kept between fits, but not pickled
+    gopt.fitprocs = 2
+    gopt.fit(gopt.x, gopt.y)
+    evaluator = gopt.fitevaluator
+    gopt.fit(gopt.x, gopt.y)
+    assert gopt.fitevaluator is evaluator and evaluator.threads
+    copy = pickle.loads(pickle.dumps(gopt))
+    assert copy.fitevaluator is None
+    assert np.allclose(copy.fit(copy.x, copy.y), gopt.fit(gopt.x, gopt.y))
+    copy.close()
+    gopt.close()
+    assert gopt.fitevaluator is None
+
+
+def test_nextstep_extends_cholesky():
+
+    x = np.linspace(0, 4095, 9)
+    f = lambda x: list(np.sin(np.array(x, dtype=float).ravel()/500.))
+    gopt = Gaussopt(1, 10, 2, list(x), f(x), sigma = 1., l = 400.,
+                    sigma_noise = 0.1, l_max = 1000., fitprocs = 1,
+                    refitevery = 3)
+    calls = []
+    refactorize = gopt.refactorize
+    def counted():
+        calls.append(len(gopt.x))
+        return refactorize()
+    gopt.refactorize = counted
+
+    # the first step fits theta, the next ones extend the factor with the
+    # batches of new points, until the next fit
+    for step in range(3):
+        newx = [p for p in gopt.nextstep() if p not in gopt.x]
+        if len(newx) > 0:
+            gopt.addpoints(newx, f(newx))
+    assert len(gopt.x) > 9 and np.shape(gopt.L) == (len(gopt.x),)*2
+    assert calls == [9]
+    assert np.allclose(gopt.L, fulcholesky(gopt))
+    assert gopt.lastfit == 1 and gopt.nsteps == 3
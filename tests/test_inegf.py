@@ -0,0 +1,471 @@
+# test the parts of the NEGF interface which do not need the NEGF programs
+
+from aftershoq.interface import Inegf
+from aftershoq.interface.inegf import readnegft
+from aftershoq.qcls import EV2416
+from aftershoq.structure import Structure
+import numpy as np
+import os
+
+
+negft = """# eFd omega eFacd j gain dk konv errdyn ierror
+0.050 0.010 0.0 10.0 5.0 0.0 1e-5 0.0 0
+0.050 0.012 0.0 10.0 7.0 0.0 1e-5 0.0 0
+ forrtl: missing comment sign
+0.048 0.010 0.0 12.0 6.0 0.0 NaN 0.0 0
+0.048 0.012 0.0 12.0 9.0 0.0 1e-5 0.0 1
+"""
+
+
+def writenegft(model, structure, path, text = negft):
+    datpath = os.path.join(str(path), structure.dirname, model.datpath)
+    os.makedirs(datpath, exist_ok = True)
+    with open(os.path.join(datpath, "negft.dat"), 'w') as f:
+        f.write(text)
+    return os.path.join(datpath, "negft.dat")
+
+
+def test_readnegft(tmp_path):
+
+    model = Inegf()
+    s = Structure(EV2416())
+    filename = writenegft(model, s, tmp_path)
+
+    data = readnegft(filename)
+    assert len(data) == 4
+    assert list(data["gain"]) == [5., 7., 6., 9.]
+    assert list(data["conv"]) == [True, True, False, False]
+    # cached until the file changes
+    assert readnegft(filename) is data
+    writenegft(model, s, tmp_path, negft + "0.052 0.010 0.0 1.0 1.0 0.0 1e-5 0.0 0\n")
+    assert len(readnegft(filename)) == 5
+
+    res = model.getresults(s, str(tmp_path))
+    assert res.shape == (5, 5)
+    assert list(res[:,0]) == sorted(res[:,0])
+
+
+
+def test_readnegft_cache(tmp_path, monkeypatch):
+
+    import aftershoq.interface.inegf as inegf
+
+    monkeypatch.setattr(inegf, "negftcachesize", 2)
+    model = Inegf()
+    files = [writenegft(model, Structure(EV2416()), tmp_path) for _ in range(3)]
+    first = readnegft(files[0])
+    readnegft(files[1])
+    assert readnegft(files[0]) is first
+    # the least recently read file is dropped
+    readnegft(files[2])
+    assert len(inegf.negftcache) == 2
+    assert os.path.abspath(files[1]) not in inegf.negftcache
+    assert readnegft(files[0]) is first
+
+
+def test_getmerit_negft(tmp_path):
+
+    model = Inegf()
+    model.merit = model.merits["(max gain)/(current density)"]
+    s = Structure(EV2416())
+    writenegft(model, s, tmp_path)
+
+    assert np.isclose(model.getMerit(s, str(tmp_path)), 0.7)
+    assert np.isclose(model.getMerit(s, str(tmp_path), only_conv = False), 0.75)
+
+    s2 = Structure(EV2416())
+    writenegft(model, s2, tmp_path, "# nothing converged\n")
+    assert model.getMerit(s2, str(tmp_path)) == "NO CONV"
+    assert model.getMerit(Structure(EV2416()), str(tmp_path)) == "ERROR"
+
+    # the partial merits of the monitor are evaluated as by getMerit()
+    from aftershoq.interface.inegf import NegftMonitor
+    monitor = NegftMonitor(model)
+    sweep = "".join(["0.050 " + str(w) + " 0.0 1.0 " + str(1 - (w - 0.012)**2) +
+                     " 0.0 1e-5 0.0 0\n" for w in [0.010, 0.011, 0.013, 0.014]])
+    for name, target in [("max gain", None), ("photocurrent", [0.012])]:
+        model.merit = model.merits[name]
+        model.target = target
+        s3 = Structure(EV2416())
+        filename = writenegft(model, s3, tmp_path, sweep)
+        merit = model.getMerit(s3, str(tmp_path))
+        assert monitor.partialmerit(readnegft(filename)) == merit
+        if name == "max gain":
+            # interpolated between the points, by both
+            assert merit > 1 - 0.001**2
+            assert os.path.exists(os.path.join(os.path.dirname(filename),
+                                               "gain_interp.dat"))
+
+
+def test_gatherresults_parallel(tmp_path, monkeypatch):
+
+    import time
+    model = Inegf()
+    model.merit = model.merits["(max gain)/(current density)"]
+    structs = [Structure(EV2416()) for _ in range(2)]
+    for s in structs:
+        writenegft(model, s, tmp_path)
+        for folder in ["0.050", "0.048", "0.052"]:
+            os.makedirs(os.path.join(str(tmp_path), s.dirname, model.datpath,
+                                     "eins", folder))
+
+    def postprocess(ss, einspath, runhdiag = True, runbandplot = True):
+        time.sleep(0.2)
+        return os.path.basename(einspath), [ss.sid]
+    monkeypatch.setattr(model, "postprocess", postprocess)
+
+    t0 = time.time()
+    model.gatherResults(structs, str(tmp_path), max_workers = 6)
+    assert time.time() - t0 < 0.5
+
+    for s in structs:
+        folders = os.listdir(os.path.join(str(tmp_path), s.dirname,
+                                          model.datpath, "eins"))
+        assert s.wslevels == folders
+        assert s.dipoles == [[s.sid]]*3
+        assert np.isclose(float(s.merit), 0.7)
+    assert model.storedMerit(structs[1], tmp_path) == str(structs[1].merit)
+
+    # the merits are looked up where gatherResults() writes them
+    model.stores = {}
+    (tmp_path / "results").mkdir()
+    model.gatherResults(structs, str(tmp_path),
+                        pathresults = str(tmp_path / "results"))
+    assert model.resultstore(tmp_path / "results").getmerit(structs[0].sid) \
+        is not None
+    assert model.storedMerit(structs[0], tmp_path) == \
+        model.resultstore(tmp_path / "results").getmerit(structs[0].sid)
+
+
+def test_stagenegf(tmp_path):
+
+    model = Inegf()
+    spath = str(tmp_path)
+    os.makedirs(os.path.join(spath, model.datpath), exist_ok = True)
+    with open(os.path.join(spath, "scatt3.inp"), 'w') as f:
+        f.write("# scatt3\n 1   10  1\n 1\n")
+    with open(os.path.join(spath, "gw.inp"), 'w') as f:
+        f.write("gw\n")
+    with open(os.path.join(spath, "wannier.out"), 'w') as f:
+        f.write("wannier\n")
+
+    numpar = model.numpar.copy()
+    for Nper in [3, 2]:
+        numpar["Nper"] = Nper
+        model.stageNEGF(spath, numpar = numpar)
+        with open(os.path.join(spath, model.datpath, "scatt3.inp")) as f:
+            assert f.read() == "# scatt3\n " + str(Nper) + "   10  1\n 1\n"
+    # the Wannier output is left as it was
+    with open(os.path.join(spath, "scatt3.inp")) as f:
+        assert f.read() == "# scatt3\n 1   10  1\n 1\n"
+    with open(os.path.join(spath, model.datpath, "gw.inp")) as f:
+        assert f.read() == "gw\n"
+    assert os.path.exists(os.path.join(spath, model.datpath, "wannier.out"))
+
+    # the NEGF program reads the staged Wannier output, with Nper patched
+    model.writeNegftRun(Structure(EV2416()), spath)
+    with open(os.path.join(spath, model.datpath, "negft7.inp")) as f:
+        pathwann = f.read().splitlines()[9]
+    assert pathwann == os.path.join(spath, model.datpath) + "/"
+    with open(os.path.join(pathwann, "scatt3.inp")) as f:
+        assert f.read() == "# scatt3\n 2   10  1\n 1\n"
+
+
+def test_warmstart(tmp_path):
+
+    from aftershoq.utils.warmstart import WarmStart
+    model = Inegf()
+    model.warmstart = WarmStart()
+    model.numpar["efield0"] = 0.0485
+    s1, s2 = Structure(EV2416()), Structure(EV2416())
+    s2.layers[0].width += 0.1
+    path = str(tmp_path)
+
+    # s1 is started from scratch and converges
+    for folder in ["50.0_10.0_0.0", "48.0_10.0_0.0"]:
+        os.makedirs(os.path.join(path, s1.dirname, model.datpath, "eins", folder))
+    writenegft(model, s1, tmp_path)
+    model.writeNegftRun(s1, os.path.join(path, s1.dirname))
+    assert s1.warmfrom is None
+    assert not model.finishNEGF(s1, os.path.join(path, s1.dirname), 10.)
+
+    # s2 is started from the eins files of s1
+    spath = os.path.join(path, s2.dirname)
+    os.makedirs(os.path.join(spath, model.datpath))
+    model.writeNegftRun(s2, spath)
+    assert s2.warmfrom.endswith(os.path.join(s1.dirname, model.datpath,
+                                             "eins", "48.0_10.0_0.0/"))
+    with open(os.path.join(spath, model.datpath, "negft7.inp")) as f:
+        assert s2.warmfrom + "\n" in f.readlines()
+
+    # and from scratch again if it does not converge
+    writenegft(model, s2, tmp_path, "# nothing converged\n")
+    assert model.finishNEGF(s2, spath, 4.)
+    assert s2.warmfrom is None
+    with open(os.path.join(spath, model.datpath, "negft7.inp")) as f:
+        assert model.einspath + "\n" in f.readlines()
+    writenegft(model, s2, tmp_path)
+    assert not model.finishNEGF(s2, spath, 8.)
+
+    report = model.warmstart.report()
+    assert report["Ncold"] == 2 and report["Nfailed"] == 1
+    assert report["saved"] == -4.
+
+
+def test_negftmonitor(tmp_path):
+
+    from aftershoq.interface.inegf import NegftMonitor
+    from aftershoq.numerics.runplatf import Pool
+    model = Inegf(pltfm = Pool(Ncores = 2))
+    model.merit = model.merits["(max gain)/(current density)"]
+    model.numpar["Nefield"] = 100
+    monitor = NegftMonitor(model, fraction = 0.5, best = 10., interval = 0.05)
+
+    structs = [Structure(EV2416()) for _ in range(2)]
+    procs = []
+    files = []
+    for s, gain in zip(structs, [1.0, 20.0]):
+        filename = writenegft(model, s, tmp_path, "")
+        files.append(filename)
+        # a NEGF sweep which writes one bias point every 20 ms
+        line = "0.050 0.010 0.0 1.0 " + str(gain) + " 0.0 1e-5 0.0 0"
+        script = "for i in $(seq 100); do echo " + line + " >> negft.dat; " + \
+            "sleep 0.02; done"
+        procs.append(model.pltfm.submitjob("sh", ["-c", script],
+                                           os.path.dirname(filename)))
+        monitor.watch(s, str(tmp_path), procs[-1])
+    assert model.pltfm.waitall(procs, 10)
+    monitor.stop()
+
+    # the uncompetitive structure is stopped early, with a censored merit
+    assert structs[0].censored and procs[0].returncode != 0
+    assert structs[0].merit == 1.0
+    assert len(readnegft(files[0])) < 100
+    assert not structs[1].censored and procs[1].returncode == 0
+    assert monitor.best == 20.0
+    assert len(readnegft(files[1])) == 100
+
+
+def test_negftmonitor_negative(tmp_path):
+
+    from aftershoq.interface.inegf import NegftMonitor
+    from aftershoq.numerics.runplatf import Pool
+    model = Inegf(pltfm = Pool(Ncores = 2))
+    model.merit = model.merits["max gain"]
+    model.numpar["Nefield"] = 100
+    # for negative merits, the threshold is -10 - 0.5*10 = -15
+    monitor = NegftMonitor(model, fraction = 0.5, best = -10., interval = 0.05)
+
+    structs = [Structure(EV2416()) for _ in range(2)]
+    procs = []
+    for s, gain in zip(structs, [-30.0, -12.0]):
+        filename = writenegft(model, s, tmp_path, "")
+        line = "0.050 0.010 0.0 1.0 " + str(gain) + " 0.0 1e-5 0.0 0"
+        script = "for i in $(seq 100); do echo " + line + " >> negft.dat; " + \
+            "sleep 0.02; done"
+        procs.append(model.pltfm.submitjob("sh", ["-c", script],
+                                           os.path.dirname(filename)))
+        monitor.watch(s, str(tmp_path), procs[-1])
+    assert model.pltfm.waitall(procs, 10)
+    monitor.stop()
+
+    assert structs[0].censored and structs[0].merit == -30.0
+    assert not structs[1].censored and procs[1].returncode == 0
+    # the partial merits are computed without writing any file
+    assert not os.path.exists(os.path.join(str(tmp_path), structs[0].dirname,
+                                           model.datpath, "gain_interp.dat"))
+    # flat sweeps grow at the floor, else as the finished full sweeps
+    assert len(monitor.profiles) == 1
+    assert np.isclose(monitor.growth([(20, -20.)], 80, 100, -10.), 1.6)
+    monitor.profiles.append([(10, 0.), (50, 1.), (100, 5.)])
+    assert monitor.growth([(20, -20.)], 80, 100, -10.) == 5.
+
+
+fakenegft = """#!/usr/bin/env python3
+# fake NEGF program: current peak at 63.7 mV, one eins folder per bias
+import os
+lines = open("negft7.inp").read().splitlines()
+e0, de, N = lines[3].split()[:3]
+with open("negft.dat", "w") as f:
+    f.write("# eFd omega eFacd j gain dk konv errdyn ierror\\n")
+    for i in range(int(N)):
+        e = float(e0) + i*float(de)
+        j = 1/(1 + ((e - 0.0637)/0.01)**2)
+        f.write(f"{e} 0.010 0.0 {j} 1.0 0.0 1e-5 0.0 0\\n")
+        os.makedirs(f"eins/{e*1000:.1f}_10.0_0.0")
+"""
+
+
+def test_adaptive_sweep(tmp_path):
+
+    from aftershoq.numerics.runplatf import Pool
+    model = Inegf(pltfm = Pool(Ncores = 4))
+    model.prognegft = str(tmp_path / "negft")
+    (tmp_path / "negft").write_text(fakenegft)
+    os.chmod(model.prognegft, 0o755)
+    s = Structure(EV2416())
+    spath = str(tmp_path / s.dirname)
+    os.makedirs(spath)
+    (tmp_path / s.dirname / "scatt3.inp").write_text("# scatt3\n 1 10 1\n")
+    (tmp_path / s.dirname / "gw.inp").write_text("gw\n")
+
+    numpar = dict(model.numpar, efield0 = 0., defield = 0.001, Nefield = 101)
+    efields = model.runAdaptive(spath, numpar, "IV")
+    assert len(efields) < 20
+
+    res = model.getresults(s, str(tmp_path), datpath = "IV")
+    assert list(res[:,0]) == efields
+    assert abs(res[np.argmax(res[:,3]), 0] - 0.0637) < 0.001
+    # refined points start from the eins files of their neighbours
+    with open(os.path.join(spath, "IV", "bias", "62.500", "negft7.inp")) as f:
+        lines = f.read().splitlines()
+    assert lines[10] == ".TRUE." and lines[11].endswith("_10.0_0.0/")
+    assert len(os.listdir(os.path.join(spath, "IV", "eins"))) == len(efields)
+
+
+def test_chunked_sweep(tmp_path):
+
+    from aftershoq.numerics.runplatf import Pool
+    model = Inegf(pltfm = Pool(Ncores = 4))
+    model.merit = model.merits["(max gain)/(current density)"]
+    model.prognegft = str(tmp_path / "negft")
+    (tmp_path / "negft").write_text(fakenegft)
+    os.chmod(model.prognegft, 0o755)
+    model.numpar.update(efield0 = 0.050, defield = 0.001, Nefield = 10)
+    model.Nchunks = 3
+    s = Structure(EV2416())
+    spath = str(tmp_path / s.dirname)
+    os.makedirs(os.path.join(spath, model.datpath))
+    (tmp_path / s.dirname / "scatt3.inp").write_text("# scatt3\n 1 10 1\n")
+    (tmp_path / s.dirname / "gw.inp").write_text("gw\n")
+
+    procs = model.startNEGF(spath, s)
+    assert len(procs) == 3
+    model.waitforproc(1)
+
+    res = model.getresults(s, str(tmp_path))
+    assert np.allclose(res[:,0], 0.050 + 0.001*np.arange(10))
+    assert len(os.listdir(os.path.join(spath, model.datpath, "eins"))) == 10
+    # gain/j is largest where j is smallest, at 50 mV
+    assert np.isclose(model.getMerit(s, str(tmp_path)), 1 + 1.37**2)
+
+
+fakewannier = """#!/usr/bin/env python3
+# fake Wannier program: takes as long as given in the file delay
+import os, time
+if os.path.exists("delay"):
+    time.sleep(float(open("delay").read()))
+open("scatt3.inp", "w").write("# scatt3\\n 1 10 1\\n")
+open("gw.inp", "w").write("gw\\n")
+open("wannier.done", "w").write(str(time.time()))
+"""
+
+
+def fakeprograms(model, path):
+    for name, script in [("wannier", fakewannier), ("negft", fakenegft)]:
+        prog = os.path.join(str(path), name)
+        with open(prog, 'w') as f:
+            f.write(script)
+        os.chmod(prog, 0o755)
+    model.progwann = os.path.join(str(path), "wannier")
+    model.prognegft = os.path.join(str(path), "negft")
+
+
+def test_pipeline_wannier_negf(tmp_path):
+
+    from aftershoq.numerics.runplatf import Pool
+    model = Inegf(pltfm = Pool(Ncores = 2))
+    fakeprograms(model, tmp_path)
+    model.numpar.update(efield0 = 0.050, defield = 0.001, Nefield = 3)
+    structs = [Structure(EV2416()) for _ in range(2)]
+    for s, delay in zip(structs, ["0", "1.5"]):
+        os.makedirs(str(tmp_path / s.dirname))
+        (tmp_path / s.dirname / "delay").write_text(delay)
+
+    model.runStructures(structs, str(tmp_path))
+    model.waitforproc(0.1)
+
+    # the NEGF program of the fast structure ran while the Wannier program
+    # of the slow one was still running
+    negft = [os.path.join(str(tmp_path), s.dirname, model.datpath, "negft.dat")
+             for s in structs]
+    slowwannier = float((tmp_path / structs[1].dirname / "wannier.done").read_text())
+    assert os.path.getmtime(negft[0]) < slowwannier
+    assert len(model.processes) == 4
+    assert all([len(readnegft(f)) == 3 for f in negft])
+
+
+def test_runstructseq_futures(tmp_path):
+
+    from aftershoq.numerics.runplatf import Pool
+    from concurrent import futures
+    model = Inegf(pltfm = Pool(Ncores = 2))
+    fakeprograms(model, tmp_path)
+    numparIV = dict(model.numpar, efield0 = 0.060, defield = 0.001,
+                    Nefield = 8)
+    numparGain = dict(numparIV, Nefield = 1)
+    structs = [Structure(EV2416()) for _ in range(3)]
+
+    seqfutures = model.runStructSeq(structs, str(tmp_path),
+                                    seq = [numparIV, numparGain])
+    assert len(seqfutures) == 3
+
+    done = []
+    for f in futures.as_completed(seqfutures, timeout = 60):
+        negft_iv, negft_gain = f.result()
+        done.append(seqfutures.index(f))
+        assert negft_iv.shape == (8, 5)
+        # the gain stage starts at the interpolated current peak
+        assert abs(negft_gain[0,0] - 0.0637) < 0.001
+    assert sorted(done) == [0, 1, 2]
+
+    # at most Platform.maxjobs() sequences run at the same time
+    import threading, time
+    lock = threading.Lock()
+    running = [0, 0]
+    def runSequence(*args):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+        return args[0].sid
+    model.runSequence = runSequence
+    seqfutures = model.runStructSeq(structs*2, str(tmp_path))
+    assert [f.result() for f in seqfutures] == [s.sid for s in structs*2]
+    assert running[1] == 2
+
+
+def test_runsequence_cached(tmp_path):
+
+    import pickle
+    from aftershoq.numerics.runplatf import Pool
+    from aftershoq.utils.simcache import SimCache
+    model = Inegf(pltfm = Pool(Ncores = 2))
+    model.simcache = SimCache(tmp_path / "cache")
+    fakeprograms(model, tmp_path)
+    numparIV = dict(model.numpar, efield0 = 0.060, defield = 0.001,
+                    Nefield = 4)
+    seq = [numparIV, dict(numparIV, Nefield = 1)]
+    s = Structure(EV2416())
+    negft_iv, negft_gain = model.runSequence(s, str(tmp_path / "run"), seq)
+    assert not s.cached
+
+    # the same sequence is restored from the cache instead of being run
+    def submitjob(*args):
+        raise AssertionError("the sequence is run again")
+    model.pltfm.submitjob = submitjob
+    s2 = Structure(s)
+    cached_iv, cached_gain = model.runSequence(s2, str(tmp_path / "new"), seq)
+    assert s2.cached
+    assert np.allclose(cached_iv, negft_iv)
+    assert np.allclose(cached_gain, negft_gain)
+
+    # the thread pools and result stores are not pickled
+    del model.pltfm.submitjob
+    model.runStructSeq([], str(tmp_path))
+    model.resultstore(tmp_path)
+    copy = pickle.loads(pickle.dumps(model))
+    assert copy.pools == {} and copy.stores == {}
+    assert copy.numpar == model.numpar
@@ -0,0 +1,35 @@
+# test the ARD kernels of aftershoq.numerics.kernels
+
+from aftershoq.numerics.kernels import Kernel, sqdist
+import numpy as np
+
+
+def test_sqdist():
+
+    rng = np.random.default_rng(1)
+    x1 = rng.uniform(0, 100, (7, 3)); x2 = rng.uniform(0, 100, (5, 3))
+    ls = np.array([1., 10., 100.])
+    ref = np.sum(((x1[:,np.newaxis,:] - x2[np.newaxis,:,:])/ls)**2, axis=2)
+
+    out = np.empty((7, 5))
+    assert sqdist(x1, x2, ls, out = out) is out
+    assert np.allclose(out, ref)
+    assert np.allclose(sqdist(x1[:,0], x2[:,0], 2.),
+                       np.subtract.outer(x1[:,0], x2[:,0])**2/4.)
+    assert np.all(np.diag(sqdist(x1, x1, ls)) == 0.)
+
+
+def test_kernel_derivatives():
+
+    rng = np.random.default_rng(2)
+    x = rng.uniform(0, 5, (6, 2))
+    theta = [1.5, 0.8, 2., 0.1]
+    for family in Kernel.families:
+        kernel = Kernel(family)
+        K, dK = kernel.evaluate(x, x, theta[0], theta[1:3], theta[3],
+                                wrt = [0, 2, 3])
+        assert np.allclose(K, kernel(x, x, theta[0], theta[1:3], theta[3]))
+        for i, dKi in dK:
+            th = list(theta); th[i] += 1e-6
+            num = (kernel(x, x, th[0], th[1:3], th[3]) - K)/1e-6
+            assert np.allclose(dKi, num, atol = 1e-4), (family, i)
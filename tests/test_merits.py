@@ -0,0 +1,30 @@
+# test the vectorized merit functions of bias and frequency sweeps
+
+import aftershoq.utils.merits as mf
+import numpy as np
+
+
+def test_gain_merits():
+
+    omega = np.linspace(0, 1, 101)
+    x = (omega - 0.5)/0.2
+    # three biases: a gain peak, only losses, and a single crossing
+    efd = np.repeat([0.05, 0.06, 0.07], len(omega))
+    gain = np.concatenate((1 - x**2, -1 - x**2, x))
+    omega = np.tile(omega, 3)
+
+    starts, ids = mf.segments(efd)
+    assert list(starts) == [0, 101, 202]
+    assert ids[100] == 0 and ids[101] == 1
+
+    widths = mf.gainwidths(efd, omega, gain, losses = 0.1)
+    assert np.isclose(widths[0], 0.4*np.sqrt(0.9), atol = 1e-3)
+    assert list(widths[1:]) == [0., 0.]
+    assert mf.gainfwhm(efd, omega, gain, 0.1) == widths[0]
+
+    sums = [np.sum(gain[i:i+101])*0.01 for i in starts]
+    assert np.allclose(mf.gainintegrals(efd, omega, gain), sums)
+    assert np.isclose(mf.gainintegral(efd, omega, gain),
+                      max(sums)/np.max(np.abs(gain)))
+
+    assert mf.maxgainj([1., 4., 2.], [1., 2., 0.5]) == 4.
@@ -0,0 +1,120 @@
+# test the indexed results store and its results.log compatibility
+
+from aftershoq.qcls import EV2416
+from aftershoq.structure import Structure
+from aftershoq.interface import Interface
+from aftershoq.utils.resultstore import SQLiteStore, structrecord
+
+
+def test_sqlite_store(tmp_path):
+
+    s0 = EV2416()
+    Nl, Ndop = len(s0.layers), len(s0.dopings)
+
+    # a results.log written by an earlier campaign is imported
+    old = Structure(s0)
+    old.merit = "NO CONV"
+    with open(tmp_path / "results.log", 'w') as f:
+        f.write("# Results for structures:\n")
+        f.write("old " + old.merit + " ")
+        [f.write(str(l.width) + " ") for l in old.layers]
+        [f.write(str(v) + " ") for d in old.dopings for v in d]
+        [f.write(str(l.material.x) + " ") for l in old.layers]
+        f.write("\n")
+
+    store = SQLiteStore(tmp_path)
+    assert store.getmerit("old") == "NO CONV"
+    assert store.get("old", Nl, Ndop)["widths"] == [l.width for l in old.layers]
+
+    structs = [Structure(s0) for _ in range(3)]
+    for i, s in enumerate(structs):
+        s.layers[0].width += i
+        s.merit = 0.5*i
+    store.add([structrecord(s) for s in structs])
+    # the first result of a structure is kept
+    structs[0].merit = 7
+    store.add([structrecord(structs[0])])
+
+    assert store.getmerit(structs[1].sid) == "0.5"
+    assert store.getmerit(structs[0].sid) == "0.0"
+    assert store.getmerit("missing") is None
+    assert [r["sid"] for r in store.records()] == \
+        ["old"] + [str(s.sid) for s in structs]
+
+    # export to the legacy format, and read it back in a new store
+    store.export(tmp_path / "export.log")
+    store.close()
+    (tmp_path / "new").mkdir()
+    (tmp_path / "export.log").rename(tmp_path / "new" / "results.log")
+    copy = SQLiteStore(tmp_path / "new")
+    assert len(copy.records()) == 4
+    assert copy.getmerit(structs[2].sid) == "1.0"
+
+    s = Interface.loadStructure(str(tmp_path), s0, structs[2].sid)
+    assert s.layers[0].width == structs[2].layers[0].width
+    assert s.dopings == structs[2].dopings
+    assert Interface.loadStructure(str(tmp_path), s0, "missing") is None
+
+    # loading structures writes nothing
+    (tmp_path / "log").mkdir()
+    store = SQLiteStore(tmp_path)
+    store.export(tmp_path / "log" / "results.log")
+    store.close()
+    loaded = Interface.loadAllStructures(str(tmp_path / "log"), s0)
+    assert len(loaded) == 3
+    assert loaded[2].layers[0].width == structs[2].layers[0].width
+    assert not (tmp_path / "log" / SQLiteStore.dbname).exists()
+    assert Interface.loadAllStructures(str(tmp_path / "empty"), s0) == []
+    assert Interface.loadStructure(str(tmp_path / "empty"), s0, "old") is None
+    assert not (tmp_path / "empty").exists()
+
+    model = Interface()
+    assert model.storedMerit(structs[1], tmp_path) == "0.5"
+    assert model.resultstore(tmp_path / "empty", create = False) is None
+
+
+def test_censored(tmp_path):
+
+    import sqlite3
+
+    s0 = EV2416()
+    structs = [Structure(s0) for _ in range(2)]
+    for s, censored in zip(structs, [True, False]):
+        s.merit = 1.5
+        s.censored = censored
+    store = SQLiteStore(tmp_path)
+    store.add([structrecord(s) for s in structs])
+    assert [r["censored"] for r in store.records()] == [True, False]
+
+    # through results.log, where the flag is a comment after the columns
+    store.export()
+    store.close()
+    lines = (tmp_path / "results.log").read_text().splitlines()[-2:]
+    assert lines[0].endswith("# censored")
+    assert len(lines[0].split("#")[0].split()) == len(lines[1].split())
+    (tmp_path / "copy").mkdir()
+    (tmp_path / "results.log").rename(tmp_path / "copy" / "results.log")
+    copy = SQLiteStore(tmp_path / "copy")
+    assert copy.get(structs[0].sid)["censored"]
+    assert not copy.get(structs[1].sid)["censored"]
+    Nl, Ndop = len(s0.layers), len(s0.dopings)
+    assert copy.get(structs[0].sid, Nl, Ndop)["x"] == \
+        [l.material.x for l in s0.layers]
+    copy.close()
+
+    # a database without the column is upgraded
+    (tmp_path / "old").mkdir()
+    db = sqlite3.connect(str(tmp_path / "old" / SQLiteStore.dbname))
+    db.execute("CREATE TABLE results (sid TEXT PRIMARY KEY, merit TEXT, "
+               "fields TEXT)")
+    [db.execute(table) for table in SQLiteStore.schema[1:]]
+    db.execute("INSERT INTO results VALUES ('old', '2.0', '')")
+    db.commit()
+    db.close()
+    old = SQLiteStore(tmp_path / "old", readonly = True)
+    assert not old.get("old")["censored"]
+    old.close()
+    old = SQLiteStore(tmp_path / "old")
+    old.add([structrecord(structs[0])])
+    assert old.get(structs[0].sid)["censored"]
+    old.close()
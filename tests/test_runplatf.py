@@ -0,0 +1,474 @@
+# test the run platforms: job pools and completion notification
+
+from aftershoq.numerics.runplatf import Pool, Local, Platform, Euler, Slurm
+from aftershoq.numerics.runplatf import parsejobid, AsyncPoolJob
+from aftershoq.interface import Interface
+import time
+import asyncio
+import pickle
+import os
+
+stubs = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs")
+
+
+def test_pool_limits_running_jobs(tmp_path):
+
+    pool = Pool(Ncores=2)
+    jobs = [pool.submitjob("sleep", ["0.3"], str(tmp_path)) for _ in range(5)]
+
+    assert len(pool.running) == 2
+    assert pool.queued() == 3
+    assert jobs[4].pid is None
+
+    while any([pool.jobstatus(j) for j in jobs]):
+        assert len(pool.running) <= 2
+        time.sleep(0.05)
+
+    assert pool.queued() == 0
+    assert all([j.returncode == 0 for j in jobs])
+
+
+def test_pool_priority(tmp_path):
+
+    pool = Pool(Ncores=1)
+    first = pool.submitjob("sleep", ["0.2"], str(tmp_path))
+    low = pool.submitjob("true", [], str(tmp_path), priority=1)
+    high = pool.submitjob("true", [], str(tmp_path), priority=-1)
+
+    high.wait()
+    assert first.poll() is not None
+    assert low.pid is None or low.pid > high.pid
+    low.wait()
+
+
+def test_pool_packs_cores(tmp_path):
+
+    pool = Pool(Ncores=4, Nproc=1)
+    big = pool.submitjob("sleep", ["0.3"], str(tmp_path), Nproc=3)
+    wide = pool.submitjob("sleep", ["0.1"], str(tmp_path), Nproc=2)
+    small = pool.submitjob("sleep", ["0.1"], str(tmp_path))
+
+    # the serial job is packed next to the 3-core job, the 2-core job waits
+    assert small.pid is not None and wide.pid is None
+    assert pool.utilisation() == 1.
+    assert wide.skipped == 1
+
+    with pool.reserve(2):
+        # the reservation needs the cores of the 3-core job
+        assert big.poll() is not None
+        assert pool.usedcores() <= 4
+    wide.wait()
+    assert pool.utilisation() == 0.
+    assert 0. < pool.utilisation(average=True) < 1.
+
+    strict = Pool(Ncores=2, backfill=0)
+    strict.submitjob("sleep", ["0.2"], str(tmp_path))
+    strict.submitjob("sleep", ["0.1"], str(tmp_path), Nproc=2)
+    last = strict.submitjob("true", [], str(tmp_path))
+    assert last.pid is None
+    last.wait()
+
+
+def test_pool_pins_jobs(tmp_path):
+
+    if not hasattr(os, "sched_getaffinity"):
+        return
+    cpu = sorted(os.sched_getaffinity(0))[0]
+    pool = Pool(Ncores=1, pin=True)
+    job = pool.submitjob("sh", ["-c", "grep Cpus_allowed_list /proc/self/status > aff"],
+                         str(tmp_path))
+    job.wait()
+    assert (tmp_path / "aff").read_text().split()[-1] == str(cpu)
+    with pool.reserve(1) as cpus:
+        assert cpus == [cpu]
+
+
+def test_pool_pins_within_affinity(tmp_path, monkeypatch):
+
+    if not hasattr(os, "sched_getaffinity"):
+        return
+    import aftershoq.utils.systemutil as su
+    allowed = sorted(os.sched_getaffinity(0))
+    # more cores than this process may use
+    pool = Pool(Ncores=len(allowed) + 3, pin=True)
+    assert pool.Ncores == len(allowed)
+    job = pool.submitjob("sh", ["-c", "grep Cpus_allowed_list /proc/self/status > aff"],
+                         str(tmp_path), Nproc=len(allowed) + 3)
+    assert job.wait() == 0
+    assert (tmp_path / "aff").exists()
+
+    # pinned from the parent without taskset
+    monkeypatch.setattr(su.shutil, "which", lambda prog: None)
+    pool = Pool(Ncores=1, pin=True)
+    job = pool.submitjob("sleep", ["0.2"], str(tmp_path))
+    assert sorted(os.sched_getaffinity(job.pid)) == allowed[:1]
+    assert job.wait() == 0
+
+
+def test_waitforproc_with_pool(tmp_path):
+
+    model = Interface(pltfm=Pool(Ncores=2))
+    model.processes = [model.pltfm.submitjob("sleep", ["0.1"], str(tmp_path))
+                       for _ in range(4)]
+    model.waitforproc(0.05)
+
+    assert all([p.returncode == 0 for p in model.processes])
+
+
+def test_on_complete_and_waitany(tmp_path):
+
+    pltfm = Local()
+    done = []
+    fast = pltfm.submitjob("true", [], str(tmp_path))
+    slow = pltfm.submitjob("sleep", ["1"], str(tmp_path))
+    pltfm.on_complete(fast, lambda p: done.append(p))
+
+    t0 = time.time()
+    finished = pltfm.waitany([fast, slow])
+    assert finished == [fast]
+    assert done == [fast]
+    assert time.time() - t0 < 0.5
+
+    assert not pltfm.waitall([slow], timeout=0.1)
+    assert pltfm.waitall([slow])
+
+
+def test_waitall_follows_growing_list(tmp_path):
+
+    pltfm = Pool(Ncores=1)
+    procs = [pltfm.submitjob("true", [], str(tmp_path))]
+
+    def next_stage(p):
+        procs.append(pltfm.submitjob("sleep", ["0.2"], str(tmp_path)))
+
+    pltfm.on_complete(procs[0], next_stage)
+    assert pltfm.waitall(procs, timeout=5)
+    assert len(procs) == 2
+    assert procs[1].returncode == 0
+
+
+def test_polling_platform(tmp_path):
+
+    class Polled(Platform):
+        def jobstatus(self, proc):
+            return proc.poll() is None
+
+    pltfm = Polled()
+    pltfm.pollinterval = 0.05
+    proc = Local().submitjob("sleep", ["0.1"], str(tmp_path))
+    assert pltfm.waitall([proc], timeout=5)
+
+
+def test_submitjob_async(tmp_path):
+
+    async def run(pltfm, N):
+        return await asyncio.gather(*[pltfm.submitjob_async("sleep", ["0.2"],
+                                      str(tmp_path)) for _ in range(N)])
+
+    t0 = time.time()
+    procs = asyncio.run(run(Local(), 20))
+    assert all([p.returncode == 0 for p in procs])
+    assert time.time() - t0 < 2
+
+    pool = Pool(Ncores=2)
+    t0 = time.time()
+    procs = asyncio.run(run(pool, 4))
+    assert all([p.returncode == 0 for p in procs])
+    assert time.time() - t0 > 0.39
+    assert len(pool.running) == 0 and pool.queued() == 0
+
+
+def test_submitjob_async_cancel(tmp_path):
+
+    pool = Pool(Ncores=1)
+
+    async def run():
+        tasks = [asyncio.ensure_future(pool.submitjob_async("sleep", ["0.2"],
+                 str(tmp_path))) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        [t.cancel() for t in tasks[1:]]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return tasks
+
+    tasks = asyncio.run(run())
+    assert tasks[0].result().returncode == 0
+    assert all([t.cancelled() for t in tasks[1:]])
+    assert len(pool.running) == 0 and pool.queued() == 0
+
+    # a job queued by a coroutine whose event loop is gone
+    job = pool.submitjob("sleep", ["0.2"], str(tmp_path))
+    loop = asyncio.new_event_loop()
+    loop.close()
+    pool.enqueue(AsyncPoolJob(pool, "true", [], str(tmp_path), 1, 1, loop), 0)
+    assert pool.waitall([job], 5)
+    pool.schedule()
+    assert len(pool.running) == 0 and pool.queued() == 0
+
+
+def test_euler_job_array(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("FAKE_LSF_DIR", str(tmp_path / "lsf"))
+    euler = Euler(1, "00:10", Euler.paral_modes["SERIAL"])
+    euler.subcommand = os.path.join(stubs, "bsub")
+    euler.statcommand = os.path.join(stubs, "bjobs")
+    euler.pollinterval = 0.1
+
+    dirs = [tmp_path / str(i) for i in range(4)]
+    [d.mkdir() for d in dirs]
+    jobs = [euler.submitjob("sh", ["-c", "sleep 0.5; touch done"], str(d))
+            for d in dirs]
+    jobs.append(euler.submitjob("false", [], str(dirs[0])))
+    assert jobs[0].jobid is None
+
+    assert euler.waitall(jobs, 10)
+    assert all([(d / "done").exists() for d in dirs])
+    assert [j.returncode for j in jobs] == [0, 0, 0, 0, 1]
+    assert len(set([j.jobid for j in jobs])) == 2
+    assert [j.index for j in jobs] == [1, 2, 3, 4, None]
+
+    with open(tmp_path / "lsf" / "bsub.log") as f:
+        assert "[1-4]" in f.read()
+    with open(tmp_path / "lsf" / "bjobs.log") as f:
+        nquery = len(f.readlines())
+    # one status query per tick for all five jobs
+    assert 1 < nquery < 0.5 / euler.pollinterval * 5
+
+
+def test_euler_final_state(tmp_path, monkeypatch):
+
+    # finished jobs have left bjobs -a, and are found with bhist
+    monkeypatch.setenv("FAKE_LSF_DIR", str(tmp_path / "lsf"))
+    monkeypatch.setenv("FAKE_LSF_CLEAN", "1")
+    euler = Euler(1, "00:10", Euler.paral_modes["SERIAL"])
+    euler.subcommand = os.path.join(stubs, "bsub")
+    euler.statcommand = os.path.join(stubs, "bjobs")
+    euler.histcommand = os.path.join(stubs, "bhist")
+    euler.pollinterval = 0.1
+
+    jobs = [euler.submitjob("sh", ["-c", "sleep 0.3; exit 0"], str(tmp_path))
+            for _ in range(2)]
+    jobs.append(euler.submitjob("sh", ["-c", "sleep 0.3; exit 3"],
+                                str(tmp_path)))
+    assert euler.waitall(jobs, 10)
+    assert [j.returncode for j in jobs] == [0, 0, 3]
+    assert [j.index for j in jobs] == [1, 2, None]
+    with open(tmp_path / "lsf" / "bhist.log") as f:
+        assert "-n 0" in f.read()
+
+    # unknown to both
+    euler.histcommand = "false"
+    jobs = [euler.submitjob("true", [], str(tmp_path))]
+    assert euler.waitall(jobs, 10)
+    assert jobs[0].returncode == euler.unknowncode
+
+
+def test_slurm_job_array(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("FAKE_SLURM_DIR", str(tmp_path / "slurm"))
+    slurm = Slurm(2, "00:10", Slurm.paral_modes["OMP"])
+    slurm.subcommand = os.path.join(stubs, "sbatch")
+    slurm.statcommand = os.path.join(stubs, "squeue")
+    slurm.pollinterval = 0.1
+
+    dirs = [tmp_path / str(i) for i in range(3)]
+    [d.mkdir() for d in dirs]
+    jobs = [slurm.submitjob("sh", ["-c", "sleep 0.5; echo $OMP_NUM_THREADS > nt"],
+                            str(d)) for d in dirs]
+
+    assert slurm.waitall(jobs, 10)
+    assert all([(d / "nt").read_text().strip() == "2" for d in dirs])
+    assert len(set([j.jobid for j in jobs])) == 1
+    # sacct is not installed, so the final state is unknown
+    assert all([j.returncode == slurm.unknowncode for j in jobs])
+
+    with open(tmp_path / "slurm" / "sbatch.log") as f:
+        sub = f.read()
+    assert "--array=1-3" in sub
+    assert "--cpus-per-task=2" in sub and "--ntasks=1" in sub
+    assert "--time=00:10:00" in sub
+    with open(tmp_path / "slurm" / "squeue.log") as f:
+        assert 1 < len(f.readlines()) < 0.5 / slurm.pollinterval * 3
+
+
+def test_slurm_final_state(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("FAKE_SLURM_DIR", str(tmp_path / "slurm"))
+    slurm = Slurm(1, "00:10", Slurm.paral_modes["SERIAL"])
+    slurm.subcommand = os.path.join(stubs, "sbatch")
+    slurm.statcommand = os.path.join(stubs, "squeue")
+    slurm.acctcommand = os.path.join(stubs, "sacct")
+    slurm.pollinterval = 0.1
+
+    jobs = [slurm.submitjob("sh", ["-c", "sleep 0.3; exit " + c], str(tmp_path))
+            for c in ("0", "3")]
+    assert slurm.waitall(jobs, 10)
+    assert [j.returncode for j in jobs] == [0, 3]
+    with open(tmp_path / "slurm" / "sacct.log") as f:
+        assert "-j " + jobs[0].jobid in f.read()
+
+
+def test_killjob(tmp_path, monkeypatch):
+
+    pool = Pool(Ncores=1)
+    jobs = [pool.submitjob("sleep", ["10"], str(tmp_path)) for _ in range(2)]
+    done = []
+    pool.on_complete(jobs[1], lambda j: done.append(j))
+    # queued and running jobs
+    [pool.killjob(j) for j in reversed(jobs)]
+    assert pool.waitall(jobs, 5)
+    assert done == [jobs[1]] and jobs[1].pid is None
+    assert all([j.returncode != 0 for j in jobs])
+
+    monkeypatch.setenv("FAKE_SLURM_DIR", str(tmp_path / "slurm"))
+    slurm = Slurm(1, "00:10")
+    slurm.subcommand = os.path.join(stubs, "sbatch")
+    slurm.statcommand = os.path.join(stubs, "squeue")
+    slurm.killcommand = os.path.join(stubs, "scancel")
+    slurm.pollinterval = 0.1
+    jobs = [slurm.submitjob("sleep", ["10"], str(tmp_path)) for _ in range(3)]
+    slurm.killjob(jobs[2])
+    slurm.flush()
+    [slurm.killjob(j) for j in jobs[:2]]
+    t0 = time.time()
+    assert slurm.waitall(jobs, 5) and time.time() - t0 < 5
+    assert all([j.returncode != 0 for j in jobs])
+    with open(tmp_path / "slurm" / "scancel.log") as f:
+        assert f.read().split() == [jobs[0].jobid + "_1", jobs[0].jobid + "_2"]
+
+
+def test_pickle_platform(tmp_path):
+
+    from aftershoq.interface.inegf import Inegf
+
+    model = Inegf()
+    model.pltfm = Pool(Ncores=1)
+    job = model.pltfm.submitjob("true", [], str(tmp_path))
+    model.pltfm.on_complete(job, lambda j: None)
+
+    # the copy has its own, empty, synchronisation state
+    copy = pickle.loads(pickle.dumps(model.getMerit)).__self__
+    assert copy.pltfm.Ncores == 1
+    assert copy.pltfm.running == [] and copy.pltfm.callbacks == {}
+    assert copy.pltfm.cond is not model.pltfm.cond
+    model.pltfm.waitall([job])
+
+
+def test_slurm_parsejobid():
+
+    assert parsejobid("12") == [("12", None)]
+    assert parsejobid("12_3") == [("12", 3)]
+    assert parsejobid("12_[4-6,9%2]") == [("12", 4), ("12", 5), ("12", 6),
+                                          ("12", 9)]
+
+
+def test_remote_pool(tmp_path):
+
+    from aftershoq.numerics.remoteplatf import Worker, RemotePool
+    import subprocess
+    import sys
+
+    workers = [Worker("127.0.0.1:0", Pool(Ncores=1)).start() for _ in range(2)]
+    # a worker daemon in its own process, on a Unix socket
+    sockpath = str(tmp_path / "worker.sock")
+    daemon = subprocess.Popen([sys.executable, "-m",
+                               "aftershoq.numerics.remoteplatf", sockpath,
+                               "--ncores", "1"])
+    try:
+        t0 = time.time()
+        while not os.path.exists(sockpath) and time.time() - t0 < 10:
+            time.sleep(0.05)
+        assert os.stat(sockpath).st_mode & 0o777 == 0o600
+
+        remote = RemotePool([w.address for w in workers] + [sockpath])
+        assert remote.Ncores == 3
+
+        dirs = [tmp_path / str(i) for i in range(6)]
+        [d.mkdir() for d in dirs]
+        jobs = [remote.submitjob("sh", ["-c", "sleep 0.2; touch done"], d)
+                for d in dirs]
+        jobs.append(remote.submitjob("false", [], tmp_path))
+
+        # balanced over the three workers
+        assert sorted([len([j for j in jobs[:6] if j.worker is w])
+                       for w in remote.workers]) == [2, 2, 2]
+
+        assert remote.waitall(jobs, 10)
+        assert all([(d / "done").exists() for d in dirs])
+        assert [j.returncode for j in jobs] == [0]*6 + [1]
+        remote.close()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        [w.shutdown() for w in workers]
+
+
+def test_remote_pool_token(tmp_path):
+
+    from aftershoq.numerics.remoteplatf import Worker, RemotePool
+    import pytest
+
+    # workers without a token only listen on the loopback interface
+    with pytest.raises(ValueError):
+        Worker("0.0.0.0:0", Pool(Ncores=1))
+
+    workers = [Worker("127.0.0.1:0", Pool(Ncores=1), token="s3cret").start()
+               for _ in range(2)]
+    try:
+        with pytest.raises(ConnectionError):
+            RemotePool([workers[0].address], token="wrong")
+
+        remote = RemotePool([w.address for w in workers], token="s3cret")
+
+        class Broken(object):
+            # a socket which cannot send any more
+            def __init__(self, sock):
+                self.sock = sock
+            def sendall(self, data):
+                raise BrokenPipeError()
+            def shutdown(self, how):
+                self.sock.shutdown(how)
+            def close(self):
+                self.sock.close()
+
+        # a failed submission is sent to the next worker
+        lost = remote.workers[0]
+        lost.sock = Broken(lost.sock)
+        job = remote.submitjob("true", [], tmp_path)
+        assert job.worker is remote.workers[1] and not lost.alive
+        assert lost.jobs == {} and lost.used == 0
+        assert remote.Ncores == 1
+        assert remote.waitall([job], 5) and job.returncode == 0
+
+        # a failed kill fails the jobs of the worker, which kills them
+        job = remote.submitjob("sleep", ["10"], tmp_path)
+        remote.workers[1].sock = Broken(remote.workers[1].sock)
+        remote.killjob(job)
+        assert remote.waitall([job], 5) and job.returncode == -1
+        assert not remote.workers[1].alive
+        t0 = time.time()
+        while workers[1].platform.usedcores() > 0 and time.time() - t0 < 5:
+            workers[1].platform.schedule()
+            time.sleep(0.05)
+        assert workers[1].platform.usedcores() == 0
+        remote.close()
+    finally:
+        [w.shutdown() for w in workers]
+
+
+def test_pickle_remote_pool(tmp_path):
+
+    from aftershoq.numerics.remoteplatf import Worker, RemotePool
+
+    worker = Worker("127.0.0.1:0", Pool(Ncores=1)).start()
+    try:
+        remote = RemotePool([worker.address])
+        copy = pickle.loads(pickle.dumps(remote))
+        # the copy connects to the workers when it is used
+        assert copy.workers == [] and copy.addresses == [worker.address]
+        job = copy.submitjob("true", [], tmp_path)
+        assert copy.Ncores == 1 and len(copy.workers) == 1
+        assert copy.waitall([job], 5) and job.returncode == 0
+        copy.close()
+        remote.close()
+    finally:
+        worker.shutdown()
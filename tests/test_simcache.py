@@ -0,0 +1,62 @@
+# test the content-addressed cache of simulation outputs
+
+from aftershoq.interface import Inegf
+from aftershoq.qcls import EV2416
+from aftershoq.structure import Structure
+from aftershoq.utils.simcache import SimCache
+import os
+
+
+def test_simcache(tmp_path):
+
+    cache = SimCache(tmp_path / "cache", maxsize = 2500)
+    model = Inegf()
+    s = Structure(EV2416())
+
+    key = cache.key(s, model.numpar, model.programs())
+    # the key only depends on the inputs of the simulation
+    assert cache.key(Structure(s), model.numpar, model.programs()) == key
+    numpar = dict(model.numpar, Nper = 2)
+    assert cache.key(s, numpar, model.programs()) != key
+    s2 = Structure(s)
+    s2.layers[0].width += 0.1
+    assert cache.key(s2, model.numpar, model.programs()) != key
+
+    keys = []
+    for i in range(3):
+        src = tmp_path / ("run" + str(i))
+        os.makedirs(src / "Run")
+        (src / "Run" / "negft.dat").write_text(str(i)*1000)
+        keys.append("key" + str(i))
+        if i == 2:
+            # restoring key0 makes key1 the least recently used entry
+            assert cache.restore(keys[0], tmp_path / "dest") == {"merit": 0}
+            assert (tmp_path / "dest" / "Run" / "negft.dat").read_text() == "0"*1000
+        cache.store(keys[i], src, {"merit": i})
+    assert keys[1] not in cache
+    assert keys[0] in cache and keys[2] in cache
+    assert cache.size() <= 2500
+    assert cache.restore(keys[1], tmp_path / "dest") is None
+
+    # the cache is found again by a new instance
+    assert keys[2] in SimCache(tmp_path / "cache")
+
+
+def test_inegf_cached(tmp_path):
+
+    model = Inegf()
+    model.simcache = SimCache(tmp_path / "cache", link = True)
+    model.merit = model.merits["(max gain)/(current density)"]
+    s = Structure(EV2416())
+    s.merit = 0.7
+    s.cachekey = model.cachekey(s)
+    src = tmp_path / "old" / s.dirname
+    os.makedirs(src / model.datpath)
+    (src / model.datpath / "negft.dat").write_text("# negft\n")
+    model.storeCached(s, src)
+
+    # a copy of the structure is restored instead of being run
+    s2 = Structure(s)
+    assert model.runStructures([s2], str(tmp_path / "new")) == []
+    assert s2.cached and s2.merit == 0.7
+    assert (tmp_path / "new" / s2.dirname / model.datpath / "negft.dat").exists()
@@ -3,7 +3,7 @@
 from aftershoq.qcls import EV2416
 from aftershoq.structure import Sgenerator
 from aftershoq.interface import Inegf
-import threading
+from concurrent import futures
 import time
 import os
 
@@ -45,9 +45,8 @@ if __name__ == "__main__":
 
     print("Done")
 
-    for tt in t:
-        print(f"Joining thread {t}")
-        tt.join()
+    for tt in futures.as_completed(t):
+        print(f"Finished sequence {t.index(tt)}")
 
     model.gatherResults(sg.structures, path)
 